@@ -10,14 +10,45 @@ Carnivore() should be instantiated.
 __author__ = "Aleksander Hykkerud and Daniel Hjertholm"
 
 import slump as sl
-import fitness as ft 
+try:
+    import fitness as ft 
+except ImportError:
+    # The Cython extension has not been built
+    import pyfitness as ft
+
+# Counters for the lazy fitness evaluation. 'invalidations' counts calls to 
+# update_fitness(), 'recomputations' counts actual calls to new_fitness().
+_fitness_counters = {'invalidations': 0, 'recomputations': 0, 'avoided': 0}
+
+def use_fitness_module(module):
+    """
+    Compute fitness with new_fitness() of module from now on.
+    
+    Parameters:
+    module (fitness or pyfitness, required)
+    """
+    
+    global ft
+    ft = module
+
+def fitness_module():
+    """Return the module used to compute fitness."""
+    
+    return ft
 
 class Animal(object):
     """
     Represents an animal. 
     
     Superclass for specific animal types.
+    
+    The state is kept in __slots__, so that animals carry no __dict__.
     """
+    
+    __slots__ = ('_weight', '_age', '_last_moved', '_fitness')
+    
+    # Row of the species in the species table, set by species.register()
+    species = None
         
     def __init__(self, weight, age=0):
         """
@@ -37,7 +68,6 @@ class Animal(object):
         self._age = age
         self._last_moved = 0
         self._fitness = None
-        self.update_fitness()
     
     def __str__(self):
         """Return a simple string representation of the animal."""
@@ -55,6 +85,52 @@ class Animal(object):
         return (self.__class__.__name__ + 
                 "({0}, {1})".format(self.weight(), self.age()))
 
+    @classmethod
+    def from_state(cls, weight, age, fitness=None):
+        """
+        Return animal with the given state, e.g. read from a checkpoint.
+        
+        Unlike the constructor, the weight is not checked, as the animal 
+        may have lost weight since it was born.
+        
+        Parameters:
+        weight (required)
+        age (required)
+        fitness (cached fitness, optional. If omitted, it is computed when 
+                 needed.)
+        """
+        
+        animal = cls.__new__(cls)
+        animal._weight = weight
+        animal._age = age
+        animal._last_moved = 0
+        animal._fitness = fitness
+        return animal
+
+    @staticmethod
+    def fitness_counters():
+        """
+        Return a copy of the lazy fitness counters.
+        
+        Return value: dict with the number of fitness invalidations, the number
+        of actual recomputations, and the number of recomputations avoided.
+        
+        A recomputation is avoided when the fitness is invalidated while it 
+        is already out of date, since the animal was born or last changed, 
+        without having been read: computing the fitness at every change 
+        would have computed a value that was never used.
+        """
+        
+        return dict(_fitness_counters)
+    
+    @staticmethod
+    def reset_fitness_counters():
+        """Reset the lazy fitness counters to zero."""
+        
+        _fitness_counters['invalidations'] = 0
+        _fitness_counters['recomputations'] = 0
+        _fitness_counters['avoided'] = 0
+    
     @staticmethod
     def update_params(params):
         """
@@ -78,8 +154,28 @@ class Animal(object):
         return self._age
     
     def fitness(self):
-        """Return animals fitness."""
+        """
+        Return animals fitness.
+        
+        The fitness is recomputed only if age or weight has changed since
+        the last call, otherwise the cached value is returned.
+        """
         
+        if self._fitness is None:
+            self._fitness = ft.new_fitness(self)
+            _fitness_counters['recomputations'] += 1
+        return self._fitness
+    
+    def cached_fitness(self, stale=None):
+        """
+        Return the cached fitness without computing it.
+        
+        Parameters:
+        stale (value returned if the fitness is out of date, optional)
+        """
+        
+        if self._fitness is None:
+            return stale
         return self._fitness
     
     def last_moved(self):
@@ -89,15 +185,19 @@ class Animal(object):
         
     def update_fitness(self):
         """
-        Update animals _fitness variable.
+        Mark animals _fitness variable as out of date.
         
-        This method will call the method new_fitness() in the cython 
-        module fitness.pyx. 
+        The fitness is not computed here. It is computed by fitness(), using 
+        the method new_fitness() in the cython module fitness.pyx, the next 
+        time it is read. 
         
         Should be called every time age or weight is changed.
         """
       
-        self._fitness = ft.new_fitness(self)
+        if self._fitness is None:
+            _fitness_counters['avoided'] += 1
+        self._fitness = None
+        _fitness_counters['invalidations'] += 1
         
     def birth(self, animal_count_in_region):
         """
@@ -171,6 +271,8 @@ class Animal(object):
 
 class Herbivore(Animal):
     """Represents a herbivore."""
+    
+    __slots__ = ()
 
     def __init__(self, weight, age=0):
         """
@@ -208,6 +310,8 @@ class Herbivore(Animal):
 
 class Carnivore(Animal):
     """Represents a carnivore."""
+    
+    __slots__ = ()
 
     def __init__(self, weight, age=0):
         """
@@ -253,12 +357,13 @@ class Carnivore(Animal):
             herbivores.remove(prey)
             return prey.weight()
             
-    def hunt(self, herbivores):
+    def hunt(self, herbivores, events=None):
         """
         Hunt herbivores in the region.
         
         Parameters: 
         herbivores (list of herbivores in the region, required)
+        events (eventlog.EventLog object kills are logged to, optional)
         """
 
         eaten_this_year = 0
@@ -272,11 +377,11 @@ class Carnivore(Animal):
                 break
             elif 0 < fit_diff < self.params['DeltaPhiMax']:
                 prob = (fit_diff / self.params['DeltaPhiMax'])
-                if sl.random() < prob:
-                    eaten_this_year += self._eat(prey, 
-                                                 eaten_this_year, 
-                                                 herbivores)
-            else:
-                eaten_this_year += self._eat(prey, eaten_this_year, herbivores)
+                if sl.random() >= prob:
+                    continue
+            eaten = self._eat(prey, eaten_this_year, herbivores)
+            eaten_this_year += eaten
+            if events is not None:
+                events.kill(self, prey, eaten)
 
 
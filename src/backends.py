@@ -0,0 +1,143 @@
+#!/usr/env/bin python
+"""
+This module provides the registry of compute backends.
+
+A backend selects how fitness is computed, which predation kernel is used
+(see hunting), and how animals are stored unless a storage is given:
+
+    python  pure Python fitness and kernel, animals as objects
+    cython  fitness and kernel compiled from fitness.pyx and predation.pyx,
+            animals as objects
+    numpy   vectorized phases on columnar storage, pure Python kernel
+    numba   vectorized phases on columnar storage, kernel compiled by Numba
+
+A backend is available when what it needs can be imported. Selecting an
+unavailable backend falls back along FALLBACK, with a warning, ending at
+'python', which is always available.
+
+The selection holds for the whole process, as the animal parameters do.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import collections
+import warnings
+import animaltypes as ani
+import hunting as hnt
+import pyfitness
+
+NAMES = ('python', 'cython', 'numpy', 'numba')
+
+FALLBACK = {'cython': 'python',
+            'numba': 'numpy',
+            'numpy': 'python'}
+
+STORAGE = {'python': 'objects',
+           'cython': 'objects',
+           'numpy': 'memory',
+           'numba': 'memory'}
+
+# Backends tried in turn when none is asked for
+DEFAULT = ('cython', 'python')
+
+
+def _load_python():
+    """Return (fitness module, predation kernel) of the python backend."""
+
+    return (pyfitness, hnt.hunt_cell_python)
+
+
+def _load_cython():
+    """Return (fitness module, predation kernel) of the cython backend."""
+
+    import fitness
+    if not fitness.__file__.endswith(tuple(_extension_suffixes())):
+        raise ImportError('The fitness extension has not been built')
+    return (fitness, hnt.compiled_kernel())
+
+
+def _load_numba():
+    """Return (fitness module, predation kernel) of the numba backend."""
+
+    return (pyfitness, hnt.numba_kernel())
+
+
+def _extension_suffixes():
+    """Return the file name endings of compiled extension modules."""
+
+    import importlib.machinery
+    return importlib.machinery.EXTENSION_SUFFIXES
+
+
+_LOADERS = {'python': _load_python,
+            'cython': _load_cython,
+            'numpy': _load_python,
+            'numba': _load_numba}
+
+# Loaded backends, None for those that could not be loaded
+_loaded = {}
+
+_active = None
+
+
+def _load(name):
+    """Return (fitness module, kernel) of a backend, or None."""
+
+    if name not in _loaded:
+        try:
+            _loaded[name] = _LOADERS[name]()
+        except ImportError:
+            _loaded[name] = None
+    return _loaded[name]
+
+
+def available():
+    """Return OrderedDict {<backend>: True if available}."""
+
+    return collections.OrderedDict((name, _load(name) is not None)
+                                   for name in NAMES)
+
+
+def select(name=None):
+    """
+    Use a backend from now on.
+
+    Return value: the name of the backend in use, which differs from name
+    if it was not available.
+
+    Parameters:
+    name (one of NAMES, optional. If omitted, the first available of
+          DEFAULT is used.)
+    """
+
+    global _active
+    if name is None:
+        chosen = [backend for backend in DEFAULT
+                  if _load(backend) is not None][0]
+    else:
+        if name not in _LOADERS:
+            raise ValueError('No backend called {}. Choose one of {}'
+                             .format(name, NAMES))
+        chosen = name
+        while _load(chosen) is None:
+            chosen = FALLBACK[chosen]
+        if chosen != name:
+            warnings.warn('Backend {0} is not available, using {1}'
+                          .format(name, chosen))
+    (fitness_module, kernel) = _load(chosen)
+    ani.use_fitness_module(fitness_module)
+    hnt.use_kernel(kernel)
+    _active = chosen
+    return chosen
+
+
+def active():
+    """Return the name of the backend in use, or None if none selected."""
+
+    return _active
+
+
+def storage(name):
+    """Return the animal storage used by a backend by default."""
+
+    return STORAGE[name]
@@ -0,0 +1,85 @@
+'''
+:mod:`bench_engines` compares the compute backends on the same scenario.
+
+Every available backend (see backends) simulates the same years from the
+same seed and deployment, in a fresh Python interpreter. The median time of
+a number of runs is reported for each, together with the speedup over the
+'python' backend and the final animal counts. Backends that are not
+available are listed as such.
+
+Run from the directory containing slogstorm.py and mapfile.txt.
+'''
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import subprocess
+import sys
+import backends as bk
+
+_RUNS = 3
+_YEARS = 50
+
+_CHILD = '''
+import time
+import slump as sl
+import slogstorm
+sl.seed(1)
+sim = slogstorm.InputHandler(mapfile='mapfile.txt', headless=True,
+                             engine={engine!r})
+sim.deploy_animals(
+    [{{'loc': (2, 2),
+      'pop': [{{'species': 'Herbivore', 'age': 5, 'weight': 20.}}] * 150}},
+     {{'loc': (2, 2),
+      'pop': [{{'species': 'Carnivore', 'age': 5, 'weight': 20.}}] * 20}}])
+start = time.time()
+sim.run_simulation({years})
+counts = sim._simulation.count_by_species()
+print(sim.engine(), time.time() - start, counts['herbivores'],
+      counts['carnivores'])
+'''
+
+
+def _median(values):
+    """Return the median of a list of numbers."""
+
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(engine, runs=_RUNS, years=_YEARS):
+    """
+    Return tuple (median time, herbivores, carnivores) of simulating years
+    years with a backend.
+
+    Parameters:
+    engine (name of the backend, required)
+    runs (number of fresh interpreters to measure, optional)
+    years (number of years to simulate, optional)
+    """
+
+    times = []
+    for run in range(runs):
+        output = subprocess.check_output(
+                [sys.executable, '-c', _CHILD.format(engine=engine,
+                                                      years=years)])
+        (used, seconds, herbivores, carnivores) = output.split()[-4:]
+        if used.decode() != engine:
+            raise RuntimeError('Backend {0} ran as {1}'
+                               .format(engine, used.decode()))
+        times.append(float(seconds))
+    return (_median(times), int(herbivores), int(carnivores))
+
+
+if __name__ == '__main__':
+
+    results = {}
+    for engine, is_available in bk.available().items():
+        if not is_available:
+            print('{0:8s}  not available'.format(engine))
+            continue
+        results[engine] = measure(engine)
+        (seconds, herbivores, carnivores) = results[engine]
+        print('{0:8s}  {1:7.3f} s  {2:6.2f}x  herbivores {3:6d}  '
+              'carnivores {4:6d}'
+              .format(engine, seconds, results['python'][0] / seconds,
+                      herbivores, carnivores))
@@ -0,0 +1,123 @@
+'''
+:mod:`bench_eventlog` measures the cost of the event log and the speed of
+replay.
+
+Three times are reported, as the median of a number of runs:
+
+  - simulation with checkpoints
+  - simulation with checkpoints and the event log
+  - replay of the last simulated year from the event log
+
+The logging overhead is the relative difference of the first two, and is
+compared with _OVERHEAD_TARGET. The replay is compared with simulating
+the years since the last checkpoint again.
+
+Run from the directory containing slogstorm.py and mapfile.txt.
+'''
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import slump as sl
+import slogstorm as slog
+
+# Target for the relative overhead of the event log
+_OVERHEAD_TARGET = 0.15
+
+_RUNS = 3
+_YEARS = 60
+_CHECKPOINT_INTERVAL = 20
+
+_DEPLOYMENTS = [
+    {'loc': (2, 2),
+     'pop': [{'species': 'Herbivore', 'age': 5, 'weight': 20.}] * 150},
+    {'loc': (2, 2),
+     'pop': [{'species': 'Carnivore', 'age': 5, 'weight': 20.}] * 20}]
+
+
+def _median(values):
+    """Return the median of a list of numbers."""
+
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _simulate(directory, log):
+    """
+    Return time used to simulate _YEARS years with checkpoints, and the
+    event log if log is True.
+    """
+
+    sl.seed(1)
+    sim = slog.InputHandler(mapfile='mapfile.txt', headless=True)
+    sim.deploy_animals(_DEPLOYMENTS)
+    sim.enable_checkpoints(directory, _CHECKPOINT_INTERVAL)
+    if log:
+        sim.enable_event_log(os.path.join(directory, 'events.log'))
+    start = time.time()
+    sim.run_simulation(_YEARS)
+    seconds = time.time() - start
+    sim.close_event_log()
+    return seconds
+
+
+def _replay(directory, year):
+    """Return time used to rebuild a year from the event log."""
+
+    sim = slog.InputHandler(mapfile='mapfile.txt', headless=True)
+    sim.enable_checkpoints(directory, _CHECKPOINT_INTERVAL)
+    start = time.time()
+    sim.replay(year, os.path.join(directory, 'events.log'))
+    return time.time() - start
+
+
+def measure(runs=_RUNS):
+    """
+    Return dict with median times for plain and logged simulation and for
+    replay, and the size of the log.
+
+    Parameters:
+    runs (number of runs to measure, optional)
+    """
+
+    results = {'plain': [], 'logged': [], 'replay': []}
+    size = 0
+    for run in range(runs):
+        directory = tempfile.mkdtemp(prefix='slogstorm')
+        try:
+            results['plain'].append(_simulate(directory, False))
+            shutil.rmtree(directory)
+            os.makedirs(directory)
+            results['logged'].append(_simulate(directory, True))
+            # The worst case: all years since the previous checkpoint
+            results['replay'].append(_replay(directory, _YEARS - 1))
+            size = os.path.getsize(os.path.join(directory, 'events.log'))
+        finally:
+            shutil.rmtree(directory)
+
+    times = dict((k, _median(v)) for k, v in results.items())
+    times['overhead'] = times['logged'] / times['plain'] - 1
+    times['log_bytes'] = size
+    return times
+
+
+if __name__ == '__main__':
+
+    times = measure()
+    resimulated = ((_YEARS - 1) % _CHECKPOINT_INTERVAL) / float(_YEARS)
+    print('{0} years with checkpoints:  {1:7.3f} s'.format(_YEARS,
+                                                          times['plain']))
+    print('with event log:             {0:7.3f} s  ({1:+.1%}, target '
+          '{2:.0%})'.format(times['logged'], times['overhead'],
+                            _OVERHEAD_TARGET))
+    print('event log size:             {0:7d} bytes'.format(
+            times['log_bytes']))
+    print('replay of year {0}:          {1:7.3f} s  (simulating again: '
+          '~{2:.3f} s)'.format(_YEARS - 1, times['replay'],
+                               resimulated * times['plain']))
+    if times['overhead'] > _OVERHEAD_TARGET:
+        sys.exit(1)
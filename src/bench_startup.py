@@ -0,0 +1,96 @@
+'''
+:mod:`bench_startup` measures how long it takes to get a headless BioSim
+simulation going.
+
+Every measurement is done in a fresh Python interpreter, so that nothing is
+already imported or cached. Three times are reported, as the median of a
+number of runs:
+
+  - import: ``import slogstorm``
+  - construction: ``InputHandler(mapfile='mapfile.txt', headless=True)``
+  - cold start: interpreter start, import, construction and one simulated
+    year with a few animals deployed
+
+The cold start is compared with _COLD_START_TARGET. The script also checks
+that matplotlib was not imported by the headless run.
+
+Run from the directory containing slogstorm.py and mapfile.txt.
+'''
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import subprocess
+import sys
+import time
+
+# Target for the cold start of a headless simulation, in seconds
+_COLD_START_TARGET = 0.5
+
+_RUNS = 5
+
+_CHILD = '''
+import sys
+import time
+start = time.time()
+import slogstorm
+imported = time.time()
+sim = slogstorm.InputHandler(mapfile='mapfile.txt', headless=True)
+constructed = time.time()
+sim.set_plot_update_interval(1)
+sim.deploy_animals(
+    [{'loc': (2, 2),
+      'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 4},
+     {'loc': (2, 2),
+      'pop': [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 4}])
+sim.run_simulation(1)
+simulated = time.time()
+print(imported - start, constructed - imported, simulated - start,
+      int('matplotlib' in sys.modules))
+'''
+
+
+def _median(values):
+    """Return the median of a list of numbers."""
+
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(runs=_RUNS):
+    """
+    Return dict with median import, construction and cold start times.
+
+    Parameters:
+    runs (number of fresh interpreters to measure, optional)
+    """
+
+    results = {'import': [], 'construction': [], 'cold_start': []}
+    matplotlib_imported = False
+    for run in range(runs):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', _CHILD])
+        total = time.time() - start
+        (t_import, t_construct,
+         t_in_child, t_matplotlib) = output.split()[-4:]
+        results['import'].append(float(t_import))
+        results['construction'].append(float(t_construct))
+        # Include interpreter start-up, which the child cannot time itself
+        results['cold_start'].append(total)
+        matplotlib_imported = matplotlib_imported or bool(int(t_matplotlib))
+
+    times = dict((k, _median(v)) for k, v in results.items())
+    times['matplotlib_imported'] = matplotlib_imported
+    return times
+
+
+if __name__ == '__main__':
+
+    times = measure()
+    print('import slogstorm:      {0:7.3f} s'.format(times['import']))
+    print('InputHandler():        {0:7.3f} s'.format(times['construction']))
+    print('cold start, 1 year:    {0:7.3f} s  (target {1:.3f} s)'
+          .format(times['cold_start'], _COLD_START_TARGET))
+    if times['matplotlib_imported']:
+        print('matplotlib was imported by a headless run')
+    if times['cold_start'] > _COLD_START_TARGET or times['matplotlib_imported']:
+        sys.exit(1)
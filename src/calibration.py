@@ -0,0 +1,398 @@
+#!/usr/env/bin python
+"""
+This module provides parameter calibration against observed time series.
+
+Calibrator() runs approximate Bayesian computation by sequential Monte
+Carlo (ABC-SMC). The parameters to calibrate are given uniform priors, and
+every candidate parameter set is simulated headless, starting from the same
+deployment. A candidate is accepted when the distance between its simulated
+and the observed herbivore and carnivore counts is within the tolerance of
+the current generation. The tolerance is lowered from one generation to the
+next.
+
+Candidates are simulated in parallel worker processes. A candidate run is
+aborted as soon as its partial distance exceeds the current tolerance. As
+the partial distance never decreases, an aborted candidate would not have
+been accepted anyway.
+
+Example:
+
+    calibrator = Calibrator(observed,
+                            {'herbivores': {'beta': (0.2, 0.6)},
+                             'carnivores': {'F': (10, 30)}},
+                            deployments, mapfile='mapfile.txt')
+    result = calibrator.run(particles=100, generations=5)
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import multiprocessing as mp
+import time
+import numpy as np
+import slump as sl
+import earlystop as stp
+import slogstorm as slog
+
+# InputHandler methods used to set the parameters of each group
+_SETTERS = {'herbivores': 'set_herbivore_parameters',
+            'carnivores': 'set_carnivore_parameters',
+            'jungle': 'set_jungle_parameters',
+            'savannah': 'set_savannah_parameters'}
+
+
+class TrajectoryDistance(stp.Criterion):
+    """
+    Distance between simulated and observed counts, used as early stop
+    criterion.
+
+    The distance is the root mean square over the observed years of the
+    differences between simulated and observed counts, with each species
+    scaled by its mean observed count. The partial distance after some
+    years only includes the differences so far, and never decreases.
+    """
+
+    def __init__(self, observed, tolerance=np.inf):
+        """
+        Initialize a trajectory distance.
+
+        Parameters:
+        observed (array of shape (years, 2) with observed herbivore and
+                  carnivore counts after each year, required)
+        tolerance (the run is stopped when the partial distance exceeds
+                   this, optional)
+        """
+
+        self._observed = np.asarray(observed, dtype=float)
+        self._scale = np.maximum(self._observed.mean(axis=0), 1.)
+        self._tolerance = tolerance
+        self.reset(0, 0)
+
+    def reset(self, herbivores, carnivores):
+        """
+        Prepare for a new simulation run.
+
+        Parameters:
+        herbivores (number of herbivores when the run starts, required)
+        carnivores (number of carnivores when the run starts, required)
+        """
+
+        self._squares = 0.
+        self._years = 0
+
+    def _add(self, herbivores, carnivores):
+        """Add the squared, scaled differences of the next observed year."""
+
+        error = ((np.array([herbivores, carnivores]) -
+                  self._observed[self._years]) / self._scale)
+        self._squares += float(np.sum(error ** 2))
+        self._years += 1
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Return reason to stop after this year, or None.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        if self._years < len(self._observed):
+            self._add(herbivores, carnivores)
+        if self.distance() > self._tolerance:
+            return 'distance above tolerance'
+        return None
+
+    def finish(self):
+        """
+        Count all remaining observed years as years without animals, and
+        return the distance.
+
+        Used when a run ended early because all animals died.
+        """
+
+        while self._years < len(self._observed):
+            self._add(0, 0)
+        return self.distance()
+
+    def distance(self):
+        """Return the distance so far."""
+
+        return np.sqrt(self._squares / len(self._observed))
+
+
+def _simulate(task):
+    """
+    Simulate one candidate parameter set.
+
+    Runs in a worker process, or in the calling process when there is a
+    single one. The random generator is seeded for the run. It, the
+    parameters and the backend are restored afterwards, see
+    slogstorm.process_state().
+
+    Return value: (distance, simulated years). The distance is inf if the
+    run was aborted.
+
+    Parameters:
+    task (tuple (mapstr, mapfile, deployments, parameters, observed,
+          tolerance, seed), required)
+    """
+
+    (mapstr, mapfile, deployments, parameters,
+     observed, tolerance, seed) = task
+    state = slog.process_state()
+    sl.seed(seed)
+    try:
+        sim = slog.InputHandler(mapstr=mapstr, mapfile=mapfile,
+                                headless=True)
+        for group in parameters:
+            getattr(sim, _SETTERS[group])(parameters[group])
+        sim.deploy_animals(deployments)
+
+        distance = TrajectoryDistance(observed, tolerance)
+        sim.set_stop_criteria(criteria=[distance])
+        result = sim.run_simulation(len(observed))
+    finally:
+        slog.set_process_state(state)
+    if result['stop_reason'] == 'distance above tolerance':
+        return (np.inf, result['years'])
+    return (distance.finish(), result['years'])
+
+
+class Calibrator(object):
+    """Calibrates simulation parameters with ABC-SMC."""
+
+    def __init__(self, observed, priors, deployments, mapstr=None,
+                 mapfile=None, processes=None, seed=None):
+        """
+        Initialize a calibrator.
+
+        Parameters:
+        observed (sequence of (<herbivores>, <carnivores>) counts after each
+                  simulated year, required)
+        priors (dict {<group>: {<parameter>: (<low>, <high>)}}, where group
+                is 'herbivores', 'carnivores', 'jungle' or 'savannah'.
+                Uniform priors are used, required)
+        deployments (animals to deploy before each run, in the format used
+                     by InputHandler.deploy_animals(), required)
+        mapstr (string describing the map, see InputHandler)
+        mapfile (location of file containing mapstr)
+        processes (number of worker processes, optional. If omitted, one
+                   per CPU is used. With 1, candidates are simulated in
+                   this process.)
+        seed (seed for the calibration, optional)
+
+        One of mapstr and mapfile must be given.
+        """
+
+        self._observed = np.asarray(observed, dtype=float)
+        if self._observed.ndim != 2 or self._observed.shape[1] != 2:
+            raise ValueError('Observed counts must have shape (years, 2)')
+
+        self._names = []
+        low = []
+        high = []
+        for group in sorted(priors):
+            if group not in _SETTERS:
+                raise KeyError('No parameter group called {}'.format(group))
+            for name in sorted(priors[group]):
+                bounds = priors[group][name]
+                if bounds[0] >= bounds[1]:
+                    raise ValueError('Prior of {} is empty'.format(name))
+                self._names.append((group, name))
+                low.append(bounds[0])
+                high.append(bounds[1])
+        self._low = np.array(low, dtype=float)
+        self._high = np.array(high, dtype=float)
+
+        self._deployments = deployments
+        self._mapstr = mapstr
+        self._mapfile = mapfile
+        self._processes = processes or mp.cpu_count()
+        self._random = np.random.RandomState(seed)
+
+    def _parameters(self, theta):
+        """Return parameter dicts for InputHandler from a parameter vector."""
+
+        parameters = {}
+        for (group, name), value in zip(self._names, theta):
+            parameters.setdefault(group, {})[name] = float(value)
+        return parameters
+
+    def _evaluate(self, pool, thetas, tolerance):
+        """
+        Return list of (distance, simulated years) for parameter vectors.
+
+        Parameters:
+        pool (worker pool, or None to simulate in this process, required)
+        thetas (list of parameter vectors, required)
+        tolerance (runs are aborted above this distance, required)
+        """
+
+        tasks = [(self._mapstr, self._mapfile, self._deployments,
+                  self._parameters(theta), self._observed, tolerance,
+                  self._random.randint(2 ** 31)) for theta in thetas]
+        if pool is None:
+            return [_simulate(task) for task in tasks]
+        return pool.map(_simulate, tasks)
+
+    def _propose(self, count, particles, weights, scale):
+        """
+        Return parameter vectors drawn from the previous generation and
+        perturbed, all inside the prior bounds.
+
+        Parameters:
+        count (number of vectors, required)
+        particles (previous particles, or None for the first generation,
+                   required)
+        weights (weights of the previous particles, required)
+        scale (standard deviations of the perturbation kernel, required)
+        """
+
+        if particles is None:
+            return list(self._random.uniform(self._low, self._high,
+                                             (count, len(self._low))))
+        proposals = []
+        while len(proposals) < count:
+            theta = (particles[self._random.choice(len(particles),
+                                                   p=weights)] +
+                     self._random.normal(0, scale))
+            if np.all(theta >= self._low) and np.all(theta <= self._high):
+                proposals.append(theta)
+        return proposals
+
+    def run(self, particles=100, generations=5, quantile=0.5,
+            final_tolerance=0., batch_size=None, max_simulations=None):
+        """
+        Run the calibration.
+
+        The first generation is drawn from the priors without tolerance.
+        The tolerance of every following generation is the given quantile
+        of the distances accepted in the previous one.
+
+        When max_simulations candidates have been simulated, the run stops
+        and the last complete generation is returned, with 'exhausted' set.
+        The generation that could not be completed is discarded.
+
+        Return value: dict with
+            'samples': list of parameter dicts of the last generation
+            'weights': importance weights of the samples
+            'distances': distances of the samples
+            'tolerances': tolerance used in each complete generation
+            'exhausted': True if max_simulations stopped the run early
+            'simulations', 'aborted', 'simulated_years': totals
+            'seconds': wall clock time
+            'simulations_per_second', 'years_per_second': throughput
+
+        Parameters:
+        particles (number of accepted samples per generation, optional)
+        generations (max number of generations, optional)
+        quantile (quantile of accepted distances giving the next
+                  tolerance, optional)
+        final_tolerance (stop when the tolerance reaches this, optional)
+        batch_size (candidates evaluated at a time, optional. If omitted,
+                    four per worker process.)
+        max_simulations (max number of candidates simulated in all,
+                         optional. If omitted, generations run until they
+                         are complete, however long that takes.)
+        """
+
+        if not 0 < quantile <= 1:
+            raise ValueError('Quantile must be in (0, 1]')
+        # The first generation has no tolerance, so particles simulations
+        # always complete it
+        if max_simulations is not None and max_simulations < particles:
+            raise ValueError('max_simulations must be at least particles')
+        if batch_size is None:
+            batch_size = 4 * self._processes
+
+        start = time.time()
+        totals = {'simulations': 0, 'aborted': 0, 'simulated_years': 0}
+        tolerances = []
+        tolerance = np.inf
+        thetas = None
+        weights = None
+        scale = None
+        distances = []
+        exhausted = False
+
+        if self._processes == 1:
+            pool = None
+        else:
+            pool = mp.get_context('spawn').Pool(self._processes)
+        try:
+            for generation in range(generations):
+                accepted = []
+                accepted_distances = []
+                while len(accepted) < particles:
+                    count = batch_size
+                    if max_simulations is not None:
+                        count = min(count,
+                                    max_simulations - totals['simulations'])
+                    if count == 0:
+                        exhausted = True
+                        break
+                    batch = self._propose(count, thetas, weights, scale)
+                    for theta, (distance, years) in zip(
+                            batch, self._evaluate(pool, batch, tolerance)):
+                        totals['simulations'] += 1
+                        totals['simulated_years'] += years
+                        if distance == np.inf:
+                            totals['aborted'] += 1
+                        elif (distance <= tolerance and
+                              len(accepted) < particles):
+                            accepted.append(theta)
+                            accepted_distances.append(distance)
+                if exhausted:
+                    break
+                tolerances.append(tolerance)
+                distances = accepted_distances
+
+                accepted = np.array(accepted)
+                weights = self._weights(accepted, thetas, weights, scale)
+                thetas = accepted
+                # Perturbation kernel with twice the weighted variance
+                mean = np.dot(weights, thetas)
+                scale = np.sqrt(2 * np.dot(weights, (thetas - mean) ** 2))
+                scale = np.maximum(scale, 1e-12 * (self._high - self._low))
+
+                tolerance = float(np.percentile(distances, 100 * quantile))
+                if tolerance <= final_tolerance:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        seconds = time.time() - start
+        result = {'samples': [self._parameters(theta) for theta in thetas],
+                  'weights': weights,
+                  'distances': np.array(distances),
+                  'tolerances': tolerances,
+                  'exhausted': exhausted,
+                  'seconds': seconds,
+                  'simulations_per_second': totals['simulations'] / seconds,
+                  'years_per_second': totals['simulated_years'] / seconds}
+        result.update(totals)
+        return result
+
+    def _weights(self, thetas, previous, previous_weights, scale):
+        """
+        Return normalized importance weights of accepted parameter vectors.
+
+        Parameters:
+        thetas (accepted parameter vectors, required)
+        previous (particles of the previous generation, or None, required)
+        previous_weights (weights of the previous particles, required)
+        scale (standard deviations of the perturbation kernel, required)
+        """
+
+        if previous is None:
+            return np.ones(len(thetas)) / len(thetas)
+        # The priors are uniform, so the weight is the inverse of the
+        # density of the proposal mixture.
+        kernel = np.exp(-0.5 * np.sum(((thetas[:, np.newaxis, :] -
+                                        previous[np.newaxis, :, :]) /
+                                       scale) ** 2, axis=2))
+        weights = 1. / np.dot(kernel, previous_weights)
+        return weights / weights.sum()
@@ -0,0 +1,303 @@
+#!/usr/env/bin python
+"""
+This module provides full and incremental (delta) checkpoints.
+
+Checkpointer writes the state of a terrain to a directory: the food of
+every cell and the cell, weight, age and fitness of every animal. The
+first checkpoint is a full base. The following ones are compressed deltas,
+holding only the cells whose food or animals changed since the previous
+checkpoint. Ocean, Mountain and empty Desert cells are therefore only
+written once.
+
+The state of any checkpointed year is rebuilt from the nearest base and
+the deltas after it. Every delta records the year of the checkpoint it was
+written against, and a chain that does not link up is refused. Checkpoints
+later than the state a new checkpoint is written against are removed
+first: after a restore, simulating on starts a new timeline, and the
+checkpoints of the old one no longer apply.
+
+merge() writes the state of a year as a new base, so that the chain of
+deltas before it is no longer needed.
+
+Files are named base_<year>.npz and delta_<year>.npz.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import os
+import re
+import numpy as np
+import columnar as col
+
+SPECIES = col.SPECIES
+COLUMNS = tuple(column for column, dtype in col.COLUMNS)
+
+_FILE_NAME = re.compile(r'^(base|delta)_(\d+)\.npz$')
+
+
+def _offsets(cells, n_cells):
+    """Return array with the first row of every cell, and the row count."""
+
+    return np.searchsorted(cells, np.arange(n_cells + 1))
+
+
+def _changed_cells(previous, current, n_cells):
+    """
+    Return bool array marking the cells whose animals differ.
+
+    Parameters:
+    previous (dict of columns sorted by cell, required)
+    current (dict of columns sorted by cell, required)
+    n_cells (number of cells in the map, required)
+    """
+
+    prev_offsets = _offsets(previous['cell'], n_cells)
+    cur_offsets = _offsets(current['cell'], n_cells)
+    prev_counts = np.diff(prev_offsets)
+    cur_counts = np.diff(cur_offsets)
+    changed = prev_counts != cur_counts
+
+    # Compare the rows of cells with the same number of animals
+    same = np.flatnonzero(~changed & (cur_counts > 0))
+    counts = cur_counts[same]
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                 counts)
+    prev_rows = np.repeat(prev_offsets[same], counts) + within
+    cur_rows = np.repeat(cur_offsets[same], counts) + within
+    differs = np.zeros(len(cur_rows), dtype=bool)
+    for column in COLUMNS[1:]:
+        differs |= previous[column][prev_rows] != current[column][cur_rows]
+    changed[np.repeat(same, counts)[differs]] = True
+    return changed
+
+
+def _select(columns, cells):
+    """Return dict with the rows of columns whose cell is in cells."""
+
+    keep = np.isin(columns['cell'], cells)
+    return dict((column, columns[column][keep]) for column in COLUMNS)
+
+
+class Checkpointer(object):
+    """Writes and reads base and delta checkpoints in a directory."""
+
+    def __init__(self, directory, base_interval=None):
+        """
+        Initialize a checkpointer.
+
+        Existing checkpoints in the directory can be read, but the next
+        checkpoint written is a full base.
+
+        Parameters:
+        directory (directory for the checkpoint files, required)
+        base_interval (write a full base instead of a delta every
+                       base_interval checkpoints, optional. If omitted,
+                       only the first checkpoint is a base.)
+        """
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._base_interval = base_interval
+        self._since_base = 0
+
+        # State written by the last save(), used to find changed cells
+        self._last = None
+
+    def _path(self, kind, year):
+        """Return path of a checkpoint file."""
+
+        return os.path.join(self._directory,
+                            '{0}_{1:06d}.npz'.format(kind, year))
+
+    def checkpoints(self):
+        """Return sorted list of (year, 'base' or 'delta') in the directory."""
+
+        found = []
+        for name in os.listdir(self._directory):
+            match = _FILE_NAME.match(name)
+            if match:
+                found.append((int(match.group(2)), match.group(1)))
+        return sorted(found)
+
+    def years(self):
+        """Return sorted list of checkpointed years."""
+
+        return sorted(set(year for year, kind in self.checkpoints()))
+
+    @staticmethod
+    def state(terrain, year):
+        """
+        Return dict with the current state of a terrain.
+
+        Parameters:
+        terrain (terrain object, required)
+        year (the current year, required)
+        """
+
+        state = {'year': year,
+                 'dims': np.array(terrain.terrain_dimensions()),
+                 'food': np.array(terrain.food(), dtype=float)}
+        for species in SPECIES:
+            columns = terrain.animal_columns(species)
+            state[species] = dict((column, np.array(columns[column]))
+                                  for column in COLUMNS)
+        return state
+
+    def save(self, terrain, year):
+        """
+        Write a checkpoint of a terrain.
+
+        Return value: 'base' or 'delta', the kind of checkpoint written.
+
+        Parameters:
+        terrain (terrain object, required)
+        year (the current year, required)
+        """
+
+        state = self.state(terrain, year)
+        # Remove the checkpoints of a timeline left by restore()
+        since = year if self._last is None else self._last['year']
+        for y, kind in self.checkpoints():
+            if y > since:
+                os.remove(self._path(kind, y))
+        if (self._last is None or
+            (self._base_interval is not None and
+             self._since_base >= self._base_interval)):
+            self._write_base(state)
+            kind = 'base'
+        else:
+            self._write_delta(state)
+            kind = 'delta'
+        self._last = state
+        return kind
+
+    def _write_base(self, state):
+        """Write a full base checkpoint of a state."""
+
+        arrays = {'year': state['year'], 'dims': state['dims'],
+                  'food': state['food']}
+        for species in SPECIES:
+            for column in COLUMNS:
+                arrays[species + '_' + column] = state[species][column]
+        np.savez_compressed(self._path('base', state['year']), **arrays)
+        self._since_base = 0
+
+    def _write_delta(self, state):
+        """Write the cells that changed since the last saved state."""
+
+        n_cells = state['food'].size
+        changed = (state['food'] != self._last['food']).reshape(-1)
+        for species in SPECIES:
+            changed |= _changed_cells(self._last[species], state[species],
+                                      n_cells)
+        cells = np.flatnonzero(changed)
+
+        arrays = {'year': state['year'], 'parent': self._last['year'],
+                  'cells': cells, 'food': state['food'].reshape(-1)[cells]}
+        for species in SPECIES:
+            rows = _select(state[species], cells)
+            for column in COLUMNS:
+                arrays[species + '_' + column] = rows[column]
+        np.savez_compressed(self._path('delta', state['year']), **arrays)
+        self._since_base += 1
+
+    def _read_base(self, year):
+        """Return state stored in a base checkpoint."""
+
+        with np.load(self._path('base', year)) as data:
+            state = {'year': int(data['year']), 'dims': data['dims'],
+                     'food': data['food']}
+            for species in SPECIES:
+                state[species] = dict((column,
+                                       data[species + '_' + column])
+                                      for column in COLUMNS)
+        return state
+
+    def _apply_delta(self, state, year):
+        """Apply a delta checkpoint to a state, in place."""
+
+        with np.load(self._path('delta', year)) as data:
+            if int(data['parent']) != state['year']:
+                raise ValueError(
+                        'Delta of year {0} was written against year {1}, '
+                        'not {2}'.format(year, int(data['parent']),
+                                         state['year']))
+            cells = data['cells']
+            state['year'] = int(data['year'])
+            state['food'].reshape(-1)[cells] = data['food']
+            for species in SPECIES:
+                columns = state[species]
+                keep = ~np.isin(columns['cell'], cells)
+                for column in COLUMNS:
+                    columns[column] = np.concatenate(
+                            (columns[column][keep],
+                             data[species + '_' + column]))
+                order = np.argsort(columns['cell'], kind='stable')
+                for column in COLUMNS:
+                    columns[column] = columns[column][order]
+
+    def load(self, year):
+        """
+        Return the state of a checkpointed year.
+
+        The state is a dict with 'year', 'dims', 'food' and, for each
+        species, a dict with the columns cell, weight, age and fitness.
+
+        Parameters:
+        year (a checkpointed year, required)
+        """
+
+        chain = [(y, kind) for y, kind in self.checkpoints() if y <= year]
+        bases = [i for i, (y, kind) in enumerate(chain) if kind == 'base']
+        if year not in self.years() or not bases:
+            raise KeyError('No checkpoint of year {}'.format(year))
+        start = bases[-1]
+        state = self._read_base(chain[start][0])
+        for y, kind in chain[start + 1:]:
+            if kind == 'delta':
+                self._apply_delta(state, y)
+        return state
+
+    def restore(self, terrain, year):
+        """
+        Set the food and animals of a terrain to a checkpointed year.
+
+        Parameters:
+        terrain (terrain object, required)
+        year (a checkpointed year, required)
+        """
+
+        state = self.load(year)
+        if tuple(state['dims']) != tuple(terrain.terrain_dimensions()):
+            raise ValueError('Checkpoint is for a different map')
+        terrain.food()[:] = state['food']
+        terrain.load_animals(dict((species, state[species])
+                                  for species in SPECIES))
+        self._last = state
+        return state
+
+    def merge(self, year=None, prune=False):
+        """
+        Write the state of a year as a new base.
+
+        Deltas after the year still apply. With prune, the checkpoints
+        before the year are removed.
+
+        Parameters:
+        year (a checkpointed year, optional. If omitted, the last one.)
+        prune (if True, remove older checkpoints, optional)
+        """
+
+        if year is None:
+            year = self.years()[-1]
+        state = self.load(year)
+        self._write_base(state)
+        if os.path.exists(self._path('delta', year)):
+            os.remove(self._path('delta', year))
+        if prune:
+            for y, kind in self.checkpoints():
+                if y < year:
+                    os.remove(self._path(kind, y))
+        if self._last is not None and self._last['year'] == year:
+            self._since_base = 0
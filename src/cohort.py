@@ -0,0 +1,587 @@
+#!/usr/env/bin python
+"""
+This module provides a cohort based simulation engine.
+
+CohortSimulator() is an alternative to Simulator() for very large
+populations. Instead of one object per animal, every cell holds the number
+of animals of each species binned by (age, weight). Births, deaths and
+migration are binomial draws per bin, and nutrition and predation are
+applied per bin in fitness order. The running time therefore grows with
+the number of bins, not with the number of animals.
+
+The engine uses the same parameter dictionaries as InputHandler (the
+params attributes of the animal and region classes) and the same map as
+Terrain.
+
+Several stochastic replicates of the same scenario can be run at once. All
+state arrays then carry a leading replicate axis, and every yearly phase
+advances all replicates in the same NumPy operations.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import numpy as np
+import slump as sl
+import animaltypes as ani
+import regiontypes as lnd
+
+
+def _fitness_table(params, ages, weights):
+    """
+    Return matrix with fitness for every (age, weight) bin.
+
+    Parameters:
+    params (parameter dictionary of the species, required)
+    ages (array with the age of each age bin, required)
+    weights (array with the weight of each weight bin, required)
+    """
+
+    def helper(att1, att2, phi):
+        """Return 1 / (1 + e**(phi*(att1-att2)))."""
+
+        with np.errstate(over='ignore'):
+            return 1.0 / (1 + np.exp(phi * (att1 - att2)))
+
+    ages = ages[:, np.newaxis]
+    table = (helper(ages, params['a_half'], params['phi_age']) *
+             helper(weights, params['w_half_low'], -params['phi_low']) *
+             helper(weights, params['w_half_high'], params['phi_high']))
+    table[:, weights < params['w_min']] = 0
+    return table
+
+
+def _binomial(counts, prob):
+    """
+    Return binomial draws for all bins, drawing only for non-empty bins.
+
+    Parameters:
+    counts (int array with the number of trials, required)
+    prob (success probabilities, broadcastable to counts, required)
+    """
+
+    drawn = np.zeros_like(counts)
+    occupied = np.flatnonzero(counts)
+    if len(occupied):
+        prob = np.broadcast_to(prob, counts.shape)
+        drawn.flat[occupied] = sl.binomial(
+                counts.flat[occupied],
+                prob[np.unravel_index(occupied, counts.shape)])
+    return drawn
+
+
+def _scatter(counts, targets, size):
+    """
+    Return array of given size where counts are summed at their targets.
+
+    Parameters:
+    counts (int array, required)
+    targets (flat target index of each count, required)
+    size (size of the returned array, required)
+    """
+
+    scattered = np.zeros(size, dtype=np.int64)
+    np.add.at(scattered, targets, counts)
+    return scattered
+
+
+def _rebin(counts, new_weights, weights):
+    """
+    Return counts redistributed on the weight bins.
+
+    The animals in counts[..., b] are assumed to weigh new_weights[..., b].
+    Every group is split between the two nearest weight bins, with the
+    fraction going to the upper bin drawn binomially, so that the mean
+    weight is preserved in expectation.
+
+    Parameters:
+    counts (int array with weight bins along the last axis, required)
+    new_weights (array broadcastable to counts, required)
+    weights (array with the weight of each weight bin, required)
+    """
+
+    occupied = np.flatnonzero(counts)
+    if len(occupied) == 0:
+        return np.zeros_like(counts)
+    n_bins = len(weights)
+    new_weights = np.broadcast_to(new_weights, counts.shape)
+    new_weights = new_weights[np.unravel_index(occupied, counts.shape)]
+    pos = np.clip((new_weights - weights[0]) /
+                  (weights[1] - weights[0]), 0, n_bins - 1)
+    lower = np.floor(pos).astype(int)
+    upper = np.minimum(lower + 1, n_bins - 1)
+    count = counts.flat[occupied]
+    upper_count = sl.binomial(count, pos - lower)
+
+    # Move the groups along the last axis only
+    row_start = occupied - occupied % n_bins
+    return (_scatter(count - upper_count, row_start + lower, counts.size) +
+            _scatter(upper_count, row_start + upper, counts.size)
+            ).reshape(counts.shape)
+
+
+class CohortSimulator(object):
+    """Handles a simulation where animals are aggregated in cohorts."""
+
+    def __init__(self, terrain, age_classes=50, weight_classes=60,
+                 max_weight=120., replicates=1):
+        """
+        Initialize cohort simulator object.
+
+        Parameters:
+        terrain (terrain object giving the map, required)
+        age_classes (number of age bins, optional. Animals older than
+                     age_classes-1 are kept in the last bin.)
+        weight_classes (number of weight bins, optional)
+        max_weight (weight of the heaviest weight bin, optional)
+        replicates (number of replicates to simulate at once, optional)
+        
+        With more than one replicate, the count methods return arrays 
+        with one entry per replicate along the first axis.
+        """
+
+        if age_classes < 2 or weight_classes < 2:
+            raise ValueError('Need at least two age and weight classes')
+        if replicates < 1 or type(replicates) != int:
+            raise ValueError('Replicates must be a positive int')
+
+        self._terrain = terrain
+        self._map_dims = terrain.terrain_dimensions()
+        self._year = 0
+        self._replicates = replicates
+
+        self._ages = np.arange(age_classes)
+        self._weights = np.linspace(0, max_weight, weight_classes)
+
+        # Only livable cells are simulated. self._cells holds the flat map
+        # index of each simulated cell.
+        livable = np.array([cell._livable for cell in
+                            np.ravel(terrain.terrain_map())])
+        self._cells = np.flatnonzero(livable)
+        codes = np.ravel(terrain.map_codes())[self._cells]
+        self._jungle = codes == 'J'
+        self._savannah = codes == 'S'
+
+        # Simulated cell index of the neighbouring cells, in the same order
+        # as used by Region.migration_cycle(). Neighbours that cannot be
+        # entered are replaced by the cell itself.
+        index = np.full(livable.size, -1)
+        index[self._cells] = np.arange(len(self._cells))
+        columns = self._map_dims[1]
+        neighbours = index[np.column_stack((self._cells + columns,
+                                            self._cells - columns,
+                                            self._cells + 1,
+                                            self._cells - 1))]
+        self._neighbours = np.where(neighbours < 0,
+                                    np.arange(len(self._cells))[:, np.newaxis],
+                                    neighbours)
+        self._index = index
+
+        n_cells = len(self._cells)
+        self._food = np.zeros((replicates, n_cells))
+        self._food[:, self._jungle] = lnd.Jungle.params['fmax']
+        self._food[:, self._savannah] = lnd.Savannah.params['fmax']
+
+        shape = (replicates, n_cells, age_classes, weight_classes)
+        self._herbivores = np.zeros(shape, dtype=np.int64)
+        self._carnivores = np.zeros(shape, dtype=np.int64)
+
+        # Yearly totals per replicate, and optionally counts per cell.
+        self._history_h = []
+        self._history_c = []
+        self._cell_history_h = []
+        self._cell_history_c = []
+
+    def bin_count(self):
+        """Return the number of bins per species and cell."""
+
+        return len(self._ages) * len(self._weights)
+
+    def deploy_animals(self, deployments):
+        """
+        Deploy animals on the terrain.
+
+        Parameters:
+        deployments (list containing deployments, in the same format as
+                     for InputHandler.deploy_animals(), required)
+        """
+
+        for deployment in deployments:
+            for k in deployment:
+                if k not in ['loc', 'pop']:
+                    raise KeyError('No parameter called {}'.format(k))
+            coord = (deployment['loc'][0] - 1, deployment['loc'][1] - 1)
+            if min(coord) < 0:
+                raise AttributeError('Cannot place animals in {}'
+                                     .format(coord))
+            cell = self._index[np.ravel_multi_index(coord, self._map_dims)]
+            if cell < 0:
+                raise AttributeError('Cannot place animals in {}'.format(
+                        self._terrain.terrain_map()[coord]))
+            for animal in deployment['pop']:
+                for k in animal:
+                    if k not in ['species', 'age', 'weight']:
+                        raise KeyError('No parameter called {}'.format(k))
+                if animal['species'] == 'Herbivore':
+                    counts, params = self._herbivores, ani.Herbivore.params
+                elif animal['species'] == 'Carnivore':
+                    counts, params = self._carnivores, ani.Carnivore.params
+                else:
+                    raise ValueError('No species called {}'.
+                                     format(animal['species']))
+                if animal['age'] < 0 or type(animal['age']) != int:
+                    raise ValueError('Age must be non-negative int')
+                if animal['weight'] < params['w_min']:
+                    raise ValueError(
+                            "Animal weight can't be smaller than min_weight")
+
+                age = min(animal['age'], len(self._ages) - 1)
+                single = np.zeros((self._replicates, len(self._weights)),
+                                  dtype=np.int64)
+                single[:, 0] = 1
+                counts[:, cell, age] += _rebin(single, animal['weight'],
+                                               self._weights)
+
+    def _unsort(self, matrix, order):
+        """
+        Return (cell, bin) matrix sorted by order in state array form.
+
+        Parameters:
+        matrix (matrix with one row per cell and replicate and columns in 
+                given order, required)
+        order (the column order used, required)
+        """
+
+        unsorted = np.empty_like(matrix)
+        unsorted[:, order] = matrix
+        return unsorted.reshape(self._herbivores.shape)
+
+    def regrowth(self):
+        """Do one cycle (one year) of regrowth in all cells."""
+
+        self._food[:, self._jungle] = lnd.Jungle.params['fmax']
+        self._food[:, self._savannah] += (lnd.Savannah.params['alpha'] *
+                                          (lnd.Savannah.params['fmax'] -
+                                           self._food[:, self._savannah]))
+
+    def nutrition(self):
+        """
+        Do one cycle (one year) of nutrition uptake in all cells.
+
+        Herbivore bins eat in order of decreasing fitness until the food
+        in the cell is exhausted. Carnivore bins then hunt in order of
+        decreasing fitness, see _hunt().
+        """
+
+        params = ani.Herbivore.params
+        phi = _fitness_table(params, self._ages, self._weights)
+        order = np.argsort(-phi.ravel(), kind='stable')
+
+        # One row per cell and replicate
+        food = self._food.reshape(-1)
+        herbs = self._herbivores.reshape(len(food), -1)[:, order]
+        demand_before = (np.cumsum(herbs, axis=1) - herbs) * params['F']
+        available = food[:, np.newaxis] - demand_before
+        fed = np.clip(np.floor(available / params['F']), 0, herbs)
+        fed = fed.astype(np.int64)
+        rest = available - fed * params['F']
+        partial = (fed < herbs) & (rest > 0)
+        food -= np.minimum(food, herbs.sum(axis=1) * params['F'])
+
+        # Return to (cell, age, weight) layout
+        rest = np.where(partial, rest, 0)
+        fed, partial, rest = [self._unsort(matrix, order)
+                              for matrix in (fed, partial.astype(np.int64),
+                                             rest)]
+
+        self._herbivores = (self._herbivores - fed - partial +
+                            _rebin(fed,
+                                   self._weights + params['beta'] *
+                                   params['F'],
+                                   self._weights) +
+                            _rebin(partial,
+                                   self._weights + params['beta'] * rest,
+                                   self._weights))
+        self._hunt()
+
+    def _hunt(self):
+        """
+        Let all carnivore bins hunt in order of decreasing fitness.
+
+        All carnivores in a bin hunt together. They meet the herbivore bins
+        in order of increasing fitness, the number of kills in each
+        herbivore bin is drawn binomially with the kill probability of
+        Carnivore.hunt(), and the hunt stops when the bin's combined
+        appetite is met. The eaten amount is shared equally by the
+        carnivores in the bin.
+        """
+
+        params = ani.Carnivore.params
+        phi_c = _fitness_table(params, self._ages, self._weights).ravel()
+        phi_h = _fitness_table(ani.Herbivore.params,
+                               self._ages, self._weights).ravel()
+        order_h = np.argsort(phi_h, kind='stable')
+
+        # One row per cell and replicate
+        n_rows = self._food.size
+        herbs = self._herbivores.reshape(n_rows, -1)[:, order_h]
+        carns = self._carnivores.reshape(n_rows, -1)
+        prey_weight = np.tile(self._weights, len(self._ages))[order_h]
+        eat = np.minimum(prey_weight, params['F'])
+        gain = np.zeros(carns.shape)
+
+        occupied = np.flatnonzero(carns.any(axis=0))
+        for k in occupied[np.argsort(-phi_c[occupied], kind='stable')]:
+            cells = np.flatnonzero(carns[:, k])
+            fit_diff = phi_c[k] - phi_h[order_h]
+            if params['DeltaPhiMax'] > 0:
+                prob = np.clip(fit_diff / params['DeltaPhiMax'], 0, 1)
+            else:
+                prob = (fit_diff > 0).astype(float)
+            if not prob.any():
+                continue
+
+            kills = _binomial(herbs[cells], prob)
+            appetite = carns[cells, k][:, np.newaxis] * params['F']
+            eaten_before = np.cumsum(kills * eat, axis=1) - kills * eat
+            with np.errstate(divide='ignore', invalid='ignore'):
+                allowed = np.where(eat > 0,
+                                   np.ceil((appetite - eaten_before) / eat),
+                                   kills)
+            kills = np.where(eaten_before >= appetite, 0,
+                             np.minimum(kills, allowed)).astype(np.int64)
+            eaten = np.minimum((kills * eat).sum(axis=1), appetite[:, 0])
+            herbs[cells] -= kills
+            gain[cells, k] = params['beta'] * eaten / carns[cells, k]
+
+        self._herbivores = self._unsort(herbs, order_h)
+        self._carnivores = _rebin(self._carnivores,
+                                  (self._weights +
+                                   gain.reshape(self._carnivores.shape)),
+                                  self._weights)
+
+    def _breed(self, counts, params):
+        """
+        Return counts after one cycle (one year) of breeding.
+
+        Parameters:
+        counts (count array of one species, required)
+        params (parameter dictionary of the species, required)
+        """
+
+        phi = _fitness_table(params, self._ages, self._weights)
+        mature = counts[..., 1:, :].sum(axis=(-2, -1))
+        prob = np.clip(params['gamma'] * phi *
+                       (mature - 1)[..., np.newaxis, np.newaxis], 0, 1)
+        prob[..., 0, :] = 0
+        prob[..., self._weights < (params['w_min'] +
+                                   params['zeta'] * params['w_birth'])] = 0
+        parents = _binomial(counts, prob)
+
+        newborns = np.zeros_like(counts)
+        newborns[..., 0, 0] = parents.sum(axis=(-2, -1))
+        return (counts - parents +
+                _rebin(parents,
+                       self._weights - params['zeta'] * params['w_birth'],
+                       self._weights) +
+                _rebin(newborns, params['w_birth'], self._weights))
+
+    def breeding(self):
+        """Do one cycle (one year) of breeding in all cells."""
+
+        self._herbivores = self._breed(self._herbivores, ani.Herbivore.params)
+        self._carnivores = self._breed(self._carnivores, ani.Carnivore.params)
+
+    def _migrate(self, counts, params):
+        """
+        Return counts after one cycle (one year) of migration.
+
+        The movers in each bin are drawn binomially and split between the
+        four directions. Movers heading for a cell that cannot be entered
+        stay where they are.
+
+        Parameters:
+        counts (count array of one species, required)
+        params (parameter dictionary of the species, required)
+        """
+
+        phi = _fitness_table(params, self._ages, self._weights)
+        movers = _binomial(counts, np.clip(params['mu'] * phi, 0, 1))
+        new_counts = (counts - movers).reshape(-1)
+        bins = self.bin_count()
+        for direction in range(4):
+            if direction < 3:
+                moved = _binomial(movers, 1.0 / (4 - direction))
+            else:
+                moved = movers
+            movers = movers - moved
+            occupied = np.flatnonzero(moved)
+            replicate, cells = np.divmod(occupied // bins, len(self._cells))
+            target = (replicate * len(self._cells) + 
+                      self._neighbours[cells, direction])
+            new_counts += _scatter(moved.flat[occupied],
+                                   target * bins + occupied % bins,
+                                   counts.size)
+        return new_counts.reshape(counts.shape)
+
+    def migration(self):
+        """Do one cycle (one year) of migration in all cells."""
+
+        self._herbivores = self._migrate(self._herbivores,
+                                         ani.Herbivore.params)
+        self._carnivores = self._migrate(self._carnivores,
+                                         ani.Carnivore.params)
+
+    def _decay(self, counts, params):
+        """
+        Return counts after aging, weightloss and death.
+
+        Parameters:
+        counts (count array of one species, required)
+        params (parameter dictionary of the species, required)
+        """
+
+        aged = np.zeros_like(counts)
+        aged[..., 1:, :] = counts[..., :-1, :]
+        aged[..., -1, :] += counts[..., -1, :]
+
+        aged = _rebin(aged, self._weights * (1 - params['sigma']),
+                      self._weights)
+
+        phi = _fitness_table(params, self._ages, self._weights)
+        prob = np.where(self._weights < params['w_min'], 1,
+                        np.clip(params['omega'] * (1 - phi), 0, 1))
+        return aged - _binomial(aged, prob)
+
+    def decay(self):
+        """Do aging, weightloss and death cycles in all cells."""
+
+        self._herbivores = self._decay(self._herbivores, ani.Herbivore.params)
+        self._carnivores = self._decay(self._carnivores, ani.Carnivore.params)
+
+    def run_simulation(self, years, record_cells=False):
+        """
+        Run the main simulation loop.
+
+        The yearly totals of every replicate are recorded, see 
+        count_history(). The simulation stops early if all replicates 
+        have died out.
+
+        Parameters:
+        years (number of years to simulate, required)
+        record_cells (if True, the counts in every cell are recorded each 
+                      year as well, see cell_history(). Optional.)
+        """
+
+        if years < 0:
+            raise ValueError('Cannot simulate negative years')
+        if type(years) != int:
+            raise TypeError('Years must be integer')
+
+        for self._year in range(self._year + 1, self._year + 1 + years):
+            # With counter based random streams, each phase of the year 
+            # draws from its own stream. All cells share cell index 0.
+            sl.select_stream(self._year, 0, 0)
+            self.regrowth()
+            self.nutrition()
+            self.breeding()
+            sl.select_stream(self._year, 0, 1)
+            self.migration()
+            sl.select_stream(self._year, 0, 2)
+            self.decay()
+
+            self._history_h.append(self._herbivores.sum(axis=(1, 2, 3)))
+            self._history_c.append(self._carnivores.sum(axis=(1, 2, 3)))
+            if record_cells:
+                cells = self._cell_counts()
+                self._cell_history_h.append(cells['herbivores'])
+                self._cell_history_c.append(cells['carnivores'])
+            if not (self._history_h[-1].any() or self._history_c[-1].any()):
+                break
+
+    def _per_replicate(self, values):
+        """
+        Return values for a single run, or for all replicates.
+
+        Parameters:
+        values (array with one entry per replicate along the first axis,
+                required)
+        """
+
+        if self._replicates == 1:
+            if np.ndim(values) == 1:
+                return values[0].item()
+            return values[0]
+        return values
+
+    def _cell_counts(self):
+        """Return map sized count matrices with a leading replicate axis."""
+
+        shape = (self._replicates, self._map_dims[0] * self._map_dims[1])
+        herbmat = np.zeros(shape)
+        carnmat = np.zeros(shape)
+        herbmat[:, self._cells] = self._herbivores.sum(axis=(2, 3))
+        carnmat[:, self._cells] = self._carnivores.sum(axis=(2, 3))
+        shape = (self._replicates,) + tuple(self._map_dims)
+        return {'herbivores': herbmat.reshape(shape),
+                'carnivores': carnmat.reshape(shape)}
+
+    def replicates(self):
+        """Return the number of replicates."""
+
+        return self._replicates
+
+    def current_year(self):
+        """Return the current year."""
+
+        return self._year
+
+    def animal_count(self):
+        """Return total animal count."""
+
+        counts = (self._herbivores.sum(axis=(1, 2, 3)) +
+                  self._carnivores.sum(axis=(1, 2, 3)))
+        return self._per_replicate(counts)
+
+    def count_by_species(self):
+        """Return animal count by species."""
+
+        return {'herbivores': self._per_replicate(
+                        self._herbivores.sum(axis=(1, 2, 3))),
+                'carnivores': self._per_replicate(
+                        self._carnivores.sum(axis=(1, 2, 3)))}
+
+    def count_by_cell(self):
+        """Return herbivore and carnivore counts for each cell."""
+
+        cells = self._cell_counts()
+        return {'herbivores': self._per_replicate(cells['herbivores']),
+                'carnivores': self._per_replicate(cells['carnivores'])}
+
+    def count_history(self):
+        """
+        Return recorded yearly totals.
+
+        Return value: dict with herbivore and carnivore arrays of shape
+        (replicates, years), one column per simulated year.
+        """
+
+        shape = (self._replicates, 0)
+        return {'herbivores': (np.column_stack(self._history_h)
+                               if self._history_h else np.zeros(shape)),
+                'carnivores': (np.column_stack(self._history_c)
+                               if self._history_c else np.zeros(shape))}
+
+    def cell_history(self):
+        """
+        Return recorded counts per cell.
+
+        Return value: dict with herbivore and carnivore arrays of shape
+        (replicates, years, rows, columns), for the years simulated with
+        record_cells set.
+        """
+
+        shape = (self._replicates, 0) + tuple(self._map_dims)
+        return {'herbivores': (np.stack(self._cell_history_h, axis=1)
+                               if self._cell_history_h else np.zeros(shape)),
+                'carnivores': (np.stack(self._cell_history_c, axis=1)
+                               if self._cell_history_c else np.zeros(shape))}
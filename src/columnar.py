@@ -0,0 +1,825 @@
+#!/usr/env/bin python
+"""
+This module provides columnar storage of animals, and the yearly phases of
+the simulation working on it.
+
+ColumnStore keeps the state of all animals of one species in four columns,
+cell (flat map index), weight, age and fitness, sorted by cell. The columns
+are NumPy arrays, or np.memmap files when a directory is given, so that
+populations larger than the memory can be simulated.
+
+ColumnarAnimals holds a ColumnStore per row of the species table for a
+Terrain, and does the yearly phases by streaming over the stores in chunks
+of whole cells, running the same kernels for every species of a diet. A
+phase reads the current columns chunk by chunk and writes new ones, so
+that only one chunk is held in memory at a time. The animals follow the
+same rules as the Animal objects in animaltypes.
+
+When counter based random streams are in use (see slump.seed_streams()),
+every chunk draws its numbers from the stream of (year, chunk, phase), so
+results depend on the chunk size.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import os
+import numpy as np
+import slump as sl
+import regiontypes as lnd
+import hunting as hnt
+import species as spc
+
+# Species covered by the counts and by checkpoints. ColumnarAnimals holds
+# every species of the species table.
+SPECIES = ('herbivores', 'carnivores')
+COLUMNS = (('cell', 'int64'),
+           ('weight', 'float64'),
+           ('age', 'int64'),
+           ('fitness', 'float64'))
+
+# Same values as Terrain.PHASE_*
+_PHASE_GROWTH = 0
+_PHASE_MIGRATION = 1
+_PHASE_DECAY = 2
+
+# Flat index offsets of the four neighbours, in the order used by
+# Region.migration_cycle(), as multiples of (columns, 1).
+_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+def _params(species):
+    """Return the parameter dict of a species."""
+
+    return spc.row(species).params()
+
+
+def fitness(params, weight, age):
+    """
+    Return array with the fitness of animals.
+
+    Same formula as fitness.new_fitness().
+
+    Parameters:
+    params (parameter dict of the species, required)
+    weight (array of weights, required)
+    age (array of ages, required)
+    """
+
+    with np.errstate(over='ignore'):
+        fit = (1. / (1 + np.exp(params['phi_age'] *
+                                (age - params['a_half']))) /
+               (1 + np.exp(-params['phi_low'] *
+                           (weight - params['w_half_low']))) /
+               (1 + np.exp(params['phi_high'] *
+                           (weight - params['w_half_high']))))
+    return np.where(weight < params['w_min'], 0., fit)
+
+
+def _take(animals, index):
+    """Return dict with the rows index of each column."""
+
+    return dict((column, values[index]) for column, values in animals.items())
+
+
+def _group_start(cells):
+    """Return for each row of sorted cells the index of the first row with
+    the same cell."""
+
+    return np.searchsorted(cells, cells, side='left')
+
+
+def _row_offsets(cells, n_cells):
+    """
+    Return the offsets of rows sorted by cell, as ColumnStore.offsets().
+
+    Parameters:
+    cells (cell column, sorted, required)
+    n_cells (number of cells in the map, required)
+    """
+
+    return np.concatenate(([0], np.cumsum(np.bincount(cells,
+                                                      minlength=n_cells))))
+
+
+def _chunk_offsets(store, rows):
+    """
+    Return the offsets of a store relative to a chunk of its rows, with
+    empty slices for cells outside the chunk.
+
+    Parameters:
+    store (ColumnStore, required)
+    rows (tuple (<first row>, <row after last>) of the chunk, required)
+    """
+
+    return np.clip(store.offsets() - rows[0], 0, rows[1] - rows[0])
+
+
+def _merge_sorted(first, second):
+    """
+    Return dict with the rows of two dicts of columns sorted by cell,
+    merged in one pass and still sorted by cell.
+
+    Within a cell, the rows of first come before those of second.
+    """
+
+    positions_first = (np.arange(len(first['cell'])) +
+                       np.searchsorted(second['cell'], first['cell'],
+                                       side='left'))
+    positions_second = (np.arange(len(second['cell'])) +
+                        np.searchsorted(first['cell'], second['cell'],
+                                        side='right'))
+    merged = {}
+    for column in first:
+        merged[column] = np.empty(len(first[column]) + len(second[column]),
+                                  dtype=first[column].dtype)
+        merged[column][positions_first] = first[column]
+        merged[column][positions_second] = second[column]
+    return merged
+
+
+def _feed(herbivores, food, feeding, params, offsets):
+    """
+    Let herbivores eat, in order of descending fitness within each cell.
+
+    Parameters:
+    herbivores (dict of columns, sorted by cell, required)
+    food (flat array with the food of every cell, changed in place,
+          required)
+    feeding (flat bool array, True where animals feed, required)
+    params (herbivore parameters, required)
+    offsets (row of herbivores where each cell's slice starts, required)
+    """
+
+    if len(herbivores['cell']) == 0:
+        return herbivores
+    order = np.lexsort((-herbivores['fitness'], herbivores['cell']))
+    herbivores = _take(herbivores, order)
+    cells = herbivores['cell']
+    rank = np.arange(len(cells)) - offsets[cells]
+    appetite = params['F']
+    eaten = np.clip(food[cells] - rank * appetite, 0, appetite)
+    eaten[~feeding[cells]] = 0
+    np.subtract.at(food, cells, eaten)
+
+    fed = eaten > 0
+    herbivores['weight'][fed] += params['beta'] * eaten[fed]
+    herbivores['fitness'][fed] = fitness(params, herbivores['weight'][fed],
+                                         herbivores['age'][fed])
+    return herbivores
+
+
+def _hunt(carnivores, herbivores, feeding, params, carnivore_offsets,
+          herbivore_offsets, intake=None):
+    """
+    Let carnivores hunt herbivores in every cell.
+
+    Return value: (carnivores, surviving herbivores, intake), with intake
+    in the order of the returned carnivores.
+
+    Parameters:
+    carnivores (dict of columns, sorted by cell, required)
+    herbivores (dict of columns, sorted by cell, required)
+    feeding (flat bool array, True where animals feed, required)
+    params (carnivore parameters, required)
+    carnivore_offsets (row of carnivores where each cell's slice starts,
+                       and the row after the last, required)
+    herbivore_offsets (the same for herbivores, required)
+    intake (amount each carnivore has eaten this year, e.g. of another
+            prey species, optional. Carnivores eat at most F a year in
+            total.)
+    """
+
+    if intake is None:
+        intake = np.zeros(len(carnivores['cell']))
+    if len(carnivores['cell']) == 0 or len(herbivores['cell']) == 0:
+        return carnivores, herbivores, intake
+    order = np.lexsort((-carnivores['fitness'], carnivores['cell']))
+    carnivores = _take(carnivores, order)
+    intake = intake[order]
+    herbivores = _take(herbivores,
+                       np.lexsort((herbivores['fitness'],
+                                   herbivores['cell'])))
+    alive = np.ones(len(herbivores['cell']), dtype=bool)
+    hunted = False
+    hunting = np.flatnonzero(feeding &
+                             (np.diff(carnivore_offsets) > 0) &
+                             (np.diff(herbivore_offsets) > 0))
+    for cell in hunting:
+        (c_start, c_stop) = carnivore_offsets[cell:cell + 2]
+        (h_start, h_stop) = herbivore_offsets[cell:cell + 2]
+        (killer, eaten, gains) = hnt.hunt_cell(
+                herbivores['fitness'][h_start:h_stop],
+                herbivores['weight'][h_start:h_stop],
+                carnivores['weight'][c_start:c_stop],
+                carnivores['age'][c_start:c_stop], intake[c_start:c_stop],
+                sl.bit_generator(), params)
+        carnivores['weight'][c_start:c_stop] += gains
+        killed = killer >= 0
+        intake[c_start:c_stop] += np.bincount(killer[killed],
+                                              weights=eaten[killed],
+                                              minlength=c_stop - c_start)
+        alive[h_start:h_stop] = killer < 0
+        hunted = True
+    if hunted:
+        carnivores['fitness'] = fitness(params, carnivores['weight'],
+                                        carnivores['age'])
+    return carnivores, _take(herbivores, alive), intake
+
+
+def _breed(animals, params):
+    """
+    Let mature animals give birth.
+
+    Return value: dict of columns with the newborns added, sorted by cell.
+
+    Parameters:
+    animals (dict of columns, sorted by cell, required)
+    params (parameters of the species, required)
+    """
+
+    count = len(animals['cell'])
+    if count == 0:
+        return animals
+    cells = animals['cell']
+    mature = animals['age'] > 0
+    first = cells[0]
+    mature_in_cell = np.bincount(cells[mature] - first,
+                                 minlength=cells[-1] - first + 1)
+    probability = (params['gamma'] * animals['fitness'] *
+                   (mature_in_cell[cells - first] - 1))
+    births = (mature &
+              (animals['weight'] >= params['w_min'] +
+               params['zeta'] * params['w_birth']) &
+              (sl.random(count) < probability))
+    if not births.any():
+        return animals
+
+    animals['weight'][births] -= params['zeta'] * params['w_birth']
+    animals['fitness'][births] = fitness(params, animals['weight'][births],
+                                         animals['age'][births])
+    newborn_count = int(births.sum())
+    newborns = {'cell': cells[births],
+                'weight': np.ones(newborn_count) * params['w_birth'],
+                'age': np.zeros(newborn_count, dtype=np.int64)}
+    newborns['fitness'] = fitness(params, newborns['weight'],
+                                  newborns['age'])
+    return _merge_sorted(animals, newborns)
+
+
+def neighbour_table(rows, columns):
+    """
+    Return array of shape (cells, 4) with the flat index of the four
+    neighbours of every cell, in the order of _DIRECTIONS.
+
+    Neighbours outside the map are replaced by the cell itself.
+
+    Parameters:
+    rows (number of rows in the map, required)
+    columns (number of columns in the map, required)
+    """
+
+    (row, column) = np.divmod(np.arange(rows * columns), columns)
+    table = np.empty((rows * columns, len(_DIRECTIONS)), dtype=np.int64)
+    for k, (step_row, step_column) in enumerate(_DIRECTIONS):
+        to_row = row + step_row
+        to_column = column + step_column
+        inside = ((0 <= to_row) & (to_row < rows) &
+                  (0 <= to_column) & (to_column < columns))
+        table[:, k] = np.where(inside, to_row * columns + to_column,
+                               row * columns + column)
+    return table
+
+
+def destinations(cells, fitness, params, livable, neighbours):
+    """
+    Return array with the cell of every animal after migration.
+
+    Whether each animal moves and its direction are drawn with one vector
+    draw each. Animals heading for a cell that cannot be entered stay.
+
+    Parameters:
+    cells (flat map index of every animal, required)
+    fitness (fitness of every animal, required)
+    params (parameters of the species, required)
+    livable (flat bool array, True where animals may enter, required)
+    neighbours (neighbour table, see neighbour_table(), required)
+    """
+
+    count = len(cells)
+    moving = sl.random(count) < params['mu'] * fitness
+    targets = neighbours[cells, sl.randint(4, count)]
+    return np.where(moving & livable[targets], targets, cells)
+
+
+def _decay(animals, params):
+    """
+    Age animals, let them lose weight, and remove the dead.
+
+    Return value: dict of columns with the survivors.
+
+    Parameters:
+    animals (dict of columns, required)
+    params (parameters of the species, required)
+    """
+
+    count = len(animals['cell'])
+    if count == 0:
+        return animals
+    animals['age'] += 1
+    animals['weight'] -= params['sigma'] * animals['weight']
+    animals['fitness'] = fitness(params, animals['weight'], animals['age'])
+    dies = ((animals['weight'] < params['w_min']) |
+            (sl.random(count) < params['omega'] * (1 - animals['fitness'])))
+    return _take(animals, ~dies)
+
+
+class ColumnStore(object):
+    """
+    State of all animals of one species, in columns sorted by cell.
+
+    New columns are written with begin(), write() or write_at(), and
+    commit(). When memory mapped, two sets of files are used in turn, so
+    that the current columns can be read while the new ones are written.
+    """
+
+    def __init__(self, species, n_cells, directory=None):
+        """
+        Initialize an empty column store.
+
+        Parameters:
+        species (name of the species, used in file names, required)
+        n_cells (number of cells in the map, required)
+        directory (directory for np.memmap files, optional. If omitted,
+                   the columns are held in memory.)
+        """
+
+        self._species = species
+        self._n_cells = n_cells
+        self._directory = directory
+        self._generation = 0
+        self._columns = self._allocate(0)
+        self._count = 0
+        self._new = None
+        self._new_count = 0
+
+        # Compressed sparse row offsets: the animals of cell k are in rows
+        # _offsets[k] to _offsets[k + 1]. Counted while new columns are
+        # written, so the cell column never has to be read back.
+        self._offsets = np.zeros(n_cells + 1, dtype=np.int64)
+        self._new_counts = None
+
+        # Deployed animals not yet merged into the columns
+        self._pending = []
+
+    def _allocate(self, capacity):
+        """Return dict with new, empty columns with room for capacity rows."""
+
+        self._generation += 1
+        columns = {}
+        for column, dtype in COLUMNS:
+            if self._directory is None:
+                columns[column] = np.empty(capacity, dtype=dtype)
+            else:
+                path = os.path.join(self._directory, '{0}_{1}_{2}.dat'.format(
+                        self._species, column, self._generation % 2))
+                columns[column] = np.memmap(path, dtype=dtype, mode='w+',
+                                            shape=(max(capacity, 1),))
+        return columns
+
+    def paths(self):
+        """Return list of the files holding the current columns."""
+
+        if self._directory is None:
+            return []
+        return [self._columns[column].filename for column, dtype in COLUMNS]
+
+    def count(self):
+        """Return the number of animals, including those not yet merged."""
+
+        return self._count + len(self._pending)
+
+    def append(self, cell, weight, age, params):
+        """
+        Add an animal. It is merged into the columns by merge().
+
+        Parameters:
+        cell (flat map index, required)
+        weight (weight of the animal, required)
+        age (age of the animal, required)
+        params (parameters of the species, required)
+        """
+
+        self._pending.append((cell, weight, age,
+                              hnt.fitness_scalar(params, weight, age)))
+
+    def merge(self, chunk_rows):
+        """
+        Merge the added animals into the columns, keeping them sorted.
+
+        Parameters:
+        chunk_rows (max number of rows read at a time, required)
+        """
+
+        if not self._pending:
+            return
+        pending = sorted(self._pending, key=lambda row: row[0])
+        self._pending = []
+        added = dict((column, np.array([row[k] for row in pending],
+                                       dtype=dtype))
+                     for k, (column, dtype) in enumerate(COLUMNS))
+
+        cells = self.cells()
+        self.begin(self._count + len(pending))
+        self.write_at(np.arange(len(pending)) +
+                      np.searchsorted(cells, added['cell'], side='right'),
+                      added)
+        for start in range(0, self._count, chunk_rows):
+            stop = min(start + chunk_rows, self._count)
+            rows = self.read(start, stop)
+            self.write_at(np.arange(start, stop) +
+                          np.searchsorted(added['cell'], rows['cell'],
+                                          side='left'),
+                          rows)
+        self.commit(self._count + len(pending))
+
+    def cells(self):
+        """Return the cell column, without animals not yet merged."""
+
+        return self._columns['cell'][:self._count]
+
+    def offsets(self):
+        """
+        Return array with the first row of every cell, and the number of
+        rows at the end, without animals not yet merged.
+
+        The rows of cell k are offsets[k] to offsets[k + 1], and
+        np.diff(offsets) is the number of animals in each cell.
+        """
+
+        return self._offsets
+
+    def read(self, start, stop):
+        """
+        Return dict with in-memory copies of rows start to stop.
+
+        Parameters:
+        start (first row, required)
+        stop (row after the last, required)
+        """
+
+        return dict((column, np.array(self._columns[column][start:stop]))
+                    for column, dtype in COLUMNS)
+
+    def set_cells(self, start, stop, cells):
+        """
+        Overwrite the cells of rows start to stop of the current columns.
+
+        The columns are no longer sorted, and the offsets no longer valid,
+        until they are regrouped.
+        """
+
+        self._columns['cell'][start:stop] = cells
+
+    def begin(self, capacity):
+        """
+        Start writing new columns.
+
+        Parameters:
+        capacity (max number of rows that will be written, required)
+        """
+
+        self._new = self._allocate(capacity)
+        self._new_count = 0
+        self._new_counts = np.zeros(self._n_cells, dtype=np.int64)
+
+    def write(self, rows):
+        """
+        Append rows to the new columns.
+
+        Parameters:
+        rows (dict of columns, required)
+        """
+
+        count = len(rows['cell'])
+        for column, dtype in COLUMNS:
+            self._new[column][self._new_count:self._new_count + count] = (
+                    rows[column])
+        self._new_count += count
+        self._new_counts += np.bincount(rows['cell'],
+                                        minlength=self._n_cells)
+
+    def write_at(self, positions, rows):
+        """
+        Write rows at the given positions of the new columns.
+
+        Parameters:
+        positions (row positions, required)
+        rows (dict of columns, required)
+        """
+
+        for column, dtype in COLUMNS:
+            self._new[column][positions] = rows[column]
+        self._new_counts += np.bincount(rows['cell'],
+                                        minlength=self._n_cells)
+
+    def commit(self, count=None):
+        """
+        Replace the current columns by the new ones.
+
+        Parameters:
+        count (number of rows in the new columns, optional. If omitted,
+               the number of rows appended by write() is used.)
+        """
+
+        if count is None:
+            count = self._new_count
+        for column, dtype in COLUMNS:
+            if isinstance(self._new[column], np.memmap):
+                self._new[column].flush()
+        self._columns = self._new
+        self._count = count
+        self._offsets[1:] = np.cumsum(self._new_counts)
+        self._new = None
+        self._new_counts = None
+
+
+class ColumnarAnimals(object):
+    """Animals of a terrain in column stores, and the phases of a year."""
+
+    def __init__(self, terrain, directory=None, chunk_size=1000000):
+        """
+        Initialize columnar animal storage for a terrain.
+
+        Parameters:
+        terrain (terrain object, required)
+        directory (directory for np.memmap files, optional. If omitted,
+                   the columns are held in memory.)
+        chunk_size (approximate max number of animals held in memory at a
+                    time, optional)
+        """
+
+        if chunk_size < 1:
+            raise ValueError('Chunk size must be positive')
+        self._terrain = terrain
+        self._chunk_size = int(chunk_size)
+        (self._rows, self._columns) = terrain.terrain_dimensions()
+        self._n_cells = self._rows * self._columns
+
+        regions = terrain.terrain_map().reshape(-1)
+        self._livable = terrain.livable()
+        self._neighbours = terrain.neighbours()
+        # Animals feed where the region does the regular nutrition cycle
+        self._feeding = np.array(
+                [celle.__class__.nutrition_cycle is
+                 lnd.Region.nutrition_cycle for celle in regions])
+
+        # Names of all species, in table order
+        self._species = spc.names()
+        self._stores = dict((species,
+                             ColumnStore(species, self._n_cells, directory))
+                            for species in self._species)
+
+    def store(self, species):
+        """Return the ColumnStore of a species."""
+
+        return self._stores[species]
+
+    def deploy(self, index, animal):
+        """
+        Add an animal to the cell at index.
+
+        Parameters:
+        index (index (<row>, <column>) of the cell, required)
+        animal (animal object, required)
+        """
+
+        if not self._livable[index[0] * self._columns + index[1]]:
+            raise AttributeError('Cannot place animals in {}'.format(
+                    self._terrain.terrain_map()[tuple(index)]))
+        species = spc.of(animal)
+        self._stores[species.name].append(
+                index[0] * self._columns + index[1], animal.weight(),
+                animal.age(), species.params())
+
+    def load(self, columns):
+        """
+        Replace all animals.
+
+        Parameters:
+        columns (dict {<species>: dict of columns sorted by cell}, required.
+                 Species left out get no animals.)
+        """
+
+        for species in self._species:
+            store = self._stores[species]
+            store._pending = []
+            if species in columns:
+                store.begin(len(columns[species]['cell']))
+                store.write(columns[species])
+            else:
+                store.begin(0)
+            store.commit()
+
+    def _merge(self):
+        """Merge deployed animals into the columns."""
+
+        for species in self._species:
+            self._stores[species].merge(self._chunk_size)
+
+    def _cell_counts(self, species):
+        """Return flat array with the number of animals in each cell."""
+
+        return np.diff(self._stores[species].offsets())
+
+    def _chunks(self):
+        """
+        Return list of chunks of whole cells.
+
+        Each chunk is a dict {species: (first row, row after last)}, with
+        at most about chunk_size animals in total. Empty chunks are left
+        out.
+        """
+
+        counts = sum(self._cell_counts(species) for species in self._species)
+        first_row = np.cumsum(counts) - counts
+        chunk_of_cell = first_row // self._chunk_size
+        edges = np.concatenate(([0],
+                                np.flatnonzero(np.diff(chunk_of_cell)) + 1,
+                                [self._n_cells]))
+        bounds = dict((species, self._stores[species].offsets()[edges])
+                      for species in self._species)
+        chunks = []
+        for k in range(len(edges) - 1):
+            chunk = dict((species, (bounds[species][k],
+                                    bounds[species][k + 1]))
+                         for species in self._species)
+            if any(stop > start for start, stop in chunk.values()):
+                chunks.append(chunk)
+        return chunks
+
+    def growth(self, year=None):
+        """
+        Perform nutrition and breeding cycles. Regrowth is done by the
+        terrain.
+
+        Parameters:
+        year (the current year, optional)
+        """
+
+        self._merge()
+        food = self._terrain.food().reshape(-1)
+        table = spc.table()
+        stores = [self._stores[species.name] for species in table]
+        chunks = self._chunks()
+        # Every animal gives birth at most once a year
+        for store in stores:
+            store.begin(2 * store.count())
+        for k, chunk in enumerate(chunks):
+            if year is not None:
+                sl.select_stream(year, k, _PHASE_GROWTH)
+            rows = [store.read(*chunk[species.name])
+                    for species, store in zip(table, stores)]
+            # Offsets of the cell slices within the rows of this chunk.
+            # Cells outside the chunk get empty slices.
+            offsets = [_chunk_offsets(store, chunk[species.name])
+                       for species, store in zip(table, stores)]
+            for species in spc.grazers():
+                i = species.index
+                rows[i] = _feed(rows[i], food, self._feeding,
+                                species.params(), offsets[i])
+            for species in spc.predators():
+                i = species.index
+                intake = None
+                for prey in species.prey:
+                    if offsets[prey] is None:
+                        offsets[prey] = _row_offsets(rows[prey]['cell'],
+                                                     self._n_cells)
+                    (rows[i], rows[prey], intake) = _hunt(
+                            rows[i], rows[prey], self._feeding,
+                            species.params(), offsets[i], offsets[prey],
+                            intake)
+                    # Killed prey are gone, so its offsets are recounted
+                    # if another predator hunts it
+                    offsets[prey] = None
+            for species, store in zip(table, stores):
+                store.write(_breed(rows[species.index], species.params()))
+        for store in stores:
+            store.commit()
+
+    def migration(self, year):
+        """
+        Perform migration cycle.
+
+        The destination of every animal is written to the cell column, and
+        the columns are then regrouped by cell with a counting sort.
+
+        Parameters:
+        year (the current year, required)
+        """
+
+        self._merge()
+        counts = dict((species, np.zeros(self._n_cells, dtype=np.int64))
+                      for species in self._species)
+        for k, chunk in enumerate(self._chunks()):
+            if year is not None:
+                sl.select_stream(year, k, _PHASE_MIGRATION)
+            for species in self._species:
+                (start, stop) = chunk[species]
+                store = self._stores[species]
+                rows = store.read(start, stop)
+                cells = destinations(rows['cell'], rows['fitness'],
+                                     _params(species), self._livable,
+                                     self._neighbours)
+                store.set_cells(start, stop, cells)
+                counts[species] += np.bincount(cells,
+                                               minlength=self._n_cells)
+        for species in self._species:
+            self._regroup(self._stores[species], counts[species])
+
+    def _regroup(self, store, counts):
+        """
+        Sort the columns of a store by cell, with a counting sort.
+
+        The relative order of the animals within a cell is kept.
+
+        Parameters:
+        store (ColumnStore whose cell column is no longer sorted, required)
+        counts (number of animals in each cell, required)
+        """
+
+        total = store.count()
+        next_free = np.cumsum(counts) - counts
+        store.begin(total)
+        for start in range(0, total, self._chunk_size):
+            rows = store.read(start, min(start + self._chunk_size, total))
+            rows = _take(rows, np.argsort(rows['cell'], kind='stable'))
+            cells = rows['cell']
+            store.write_at(next_free[cells] +
+                           np.arange(len(cells)) - _group_start(cells), rows)
+            next_free += np.bincount(cells, minlength=self._n_cells)
+        store.commit(total)
+
+    def decay(self, year=None):
+        """
+        Perform aging, weightloss and death cycles.
+
+        Parameters:
+        year (the current year, optional)
+        """
+
+        self._merge()
+        for species in self._species:
+            self._stores[species].begin(self._stores[species].count())
+        for k, chunk in enumerate(self._chunks()):
+            if year is not None:
+                sl.select_stream(year, k, _PHASE_DECAY)
+            for species in self._species:
+                store = self._stores[species]
+                store.write(_decay(store.read(*chunk[species]),
+                                   _params(species)))
+        for species in self._species:
+            self._stores[species].commit()
+
+    def animal_counts(self):
+        """Return tuple with the number of herbivores and carnivores."""
+
+        return tuple(self._stores[species].count() for species in SPECIES)
+
+    def species_counts(self):
+        """Return dict with the number of animals of every species."""
+
+        return dict((species, self._stores[species].count())
+                    for species in self._species)
+
+    def count_matrices(self):
+        """
+        Return matrices with the number of herbivores and carnivores in
+        each cell.
+        """
+
+        self._merge()
+        return tuple(self._cell_counts(species).reshape(self._rows,
+                                                        self._columns)
+                     for species in SPECIES)
+
+    def animal_columns(self, species):
+        """
+        Return dict with the cell, weight, age and fitness columns of a
+        species.
+
+        The columns may be memory mapped. They are valid until the next
+        phase.
+
+        Parameters:
+        species (name of the species, e.g. 'herbivores', required)
+        """
+
+        self._merge()
+        store = self._stores[species]
+        return dict((column, store._columns[column][:store.count()])
+                    for column, dtype in COLUMNS)
+
+    def bytes_per_animal(self):
+        """Return the number of bytes used per animal."""
+
+        return sum(np.dtype(dtype).itemsize for column, dtype in COLUMNS)
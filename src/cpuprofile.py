@@ -0,0 +1,376 @@
+#!/usr/env/bin python
+"""
+This module provides statistical CPU profiling of the simulation.
+
+SamplingProfiler samples the call stack of the simulating thread every
+interval seconds of CPU time, instead of tracing every call as cProfile
+does. The simulation therefore runs at close to full speed, also when it
+makes millions of small calls such as weight() and fitness().
+
+When started from the main thread on a system with setitimer(), samples
+are taken by a SIGPROF handler in the profiled thread itself. Otherwise a
+background thread samples it, which must win the GIL to do so, and so
+samples mostly where NumPy releases it. A signal is handled only between
+two Python instructions, so a sample may come late, e.g. after a long
+NumPy call. Every sample is therefore weighted by the time measured since
+the previous sample, not by the interval, and all results are in seconds.
+
+The simulator tells the profiler which phase of the year it is in through
+run(), as with memprofile.PhaseMemoryProfiler. Samples taken outside the
+phases, e.g. while drawing, count as phase 'other'.
+
+Results can be written as
+
+    collapsed stacks    one line per stack, 'phase;frame;frame weight',
+                        with the weight in microseconds, as read by flame
+                        graph tools
+    speedscope JSON     one sampled profile per phase, opened at
+                        https://www.speedscope.app
+
+report() summarizes the time per phase and the functions most often on
+top of the stack.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import collections
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+OTHER = 'other'
+
+_SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+
+def _frame_name(frame):
+    """Return (<function>, <file>, <first line>) of a stack frame."""
+
+    code = frame.f_code
+    return (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+def _label(frame):
+    """Return a frame as 'function (file:line)'."""
+
+    return '{0} ({1}:{2})'.format(frame[0], os.path.basename(frame[1]),
+                                  frame[2])
+
+
+class SamplingProfiler(object):
+    """Counts the call stacks seen at regular intervals, per phase."""
+
+    def __init__(self, interval=0.005):
+        """
+        Initialize a profiler. Sampling is started by start().
+
+        Parameters:
+        interval (seconds between samples, optional)
+        """
+
+        if interval <= 0:
+            raise ValueError('Interval must be positive')
+        self._interval = interval
+        self._counts = collections.Counter()
+        self._seconds = collections.Counter()
+        # Reentrant, as the signal handler may interrupt the thread holding
+        # it
+        self._lock = threading.RLock()
+        self._phase = OTHER
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+        # The SIGPROF handler replaced while sampling from the signal
+        self._previous_handler = None
+        self._timer = False
+        self._last = None
+        # The last stack sampled in each phase
+        self._last_keys = {}
+
+    def start(self):
+        """Start sampling the stack of the calling thread."""
+
+        if self.running():
+            return
+        self._target = threading.current_thread().ident
+        self._last = time.perf_counter()
+        if (hasattr(signal, 'setitimer') and
+                threading.current_thread() is threading.main_thread()):
+            self._previous_handler = signal.signal(signal.SIGPROF,
+                                                   self._handle_signal)
+            signal.setitimer(signal.ITIMER_PROF, self._interval,
+                             self._interval)
+            self._timer = True
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop,
+                                        name='cpu-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling. The samples are kept."""
+
+        if self._timer:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+            self._previous_handler = None
+            self._timer = False
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        """Return True if the profiler is started."""
+
+        return self._timer or self._thread is not None
+
+    def sampling_thread(self):
+        """
+        Return True if samples are taken by a background thread instead of
+        from SIGPROF.
+        """
+
+        return self._thread is not None
+
+    def run(self, phase, function, *args):
+        """
+        Call function(*args), counting the samples taken meanwhile as phase.
+
+        Return value: the return value of function.
+
+        Parameters:
+        phase (name of the phase, required)
+        function (function to call, required)
+        args (arguments for function, optional)
+        """
+
+        outer = self._phase
+        self._switch(phase)
+        try:
+            return function(*args)
+        finally:
+            self._switch(outer)
+
+    def _switch(self, phase):
+        """
+        Make phase the current one. When sampling from SIGPROF, the time
+        since the last sample is first counted for the phase left, as a
+        signal due in it may only be handled after the switch. It is added
+        to the last stack sampled in that phase, or to the calling stack if
+        none was.
+        """
+
+        if self._timer:
+            key = self._last_keys.get(self._phase)
+            if key is None:
+                self._record(sys._getframe())
+            else:
+                with self._lock:
+                    self._seconds[key] += self._elapsed()
+        self._phase = phase
+
+    def _sample_loop(self):
+        """Take samples until stopped. Runs in the sampling thread."""
+
+        while not self._stop.wait(self._interval):
+            self.sample()
+
+    def _handle_signal(self, signum, frame):
+        """Take a sample. Runs in the profiled thread, on SIGPROF."""
+
+        self._record(frame)
+
+    def sample(self):
+        """Count the current stack of the profiled thread once."""
+
+        self._record(sys._current_frames().get(self._target))
+
+    def _record(self, frame):
+        """
+        Count the stack of a frame, weighted by the seconds since the
+        previous sample.
+        """
+
+        seconds = self._elapsed()
+        stack = []
+        while frame is not None:
+            # Leave out the profiler itself, and samples taken while the
+            # profiled thread waits in stop()
+            if frame.f_code.co_filename == __file__:
+                if frame.f_code.co_name == 'stop':
+                    return
+            else:
+                stack.append(_frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            stack.reverse()
+            key = (self._phase, tuple(stack))
+            with self._lock:
+                self._counts[key] += 1
+                self._seconds[key] += seconds
+            self._last_keys[self._phase] = key
+
+    def _elapsed(self):
+        """Return the seconds since the previous sample, and restart."""
+
+        now = time.perf_counter()
+        seconds = self._interval
+        if self._last is not None:
+            seconds = now - self._last
+        self._last = now
+        return seconds
+
+    def _samples(self):
+        """
+        Return list of ((<phase>, <stack>), <count>, <seconds>) of the
+        samples.
+        """
+
+        with self._lock:
+            return [(key, count, self._seconds[key])
+                    for key, count in list(self._counts.items())]
+
+    def samples(self):
+        """Return the number of samples taken."""
+
+        return sum(count for key, count, seconds in self._samples())
+
+    def seconds(self):
+        """Return the seconds measured by the samples taken."""
+
+        return sum(seconds for key, count, seconds in self._samples())
+
+    def interval(self):
+        """Return the seconds between samples."""
+
+        return self._interval
+
+    def reset(self):
+        """Forget the samples taken."""
+
+        with self._lock:
+            self._counts = collections.Counter()
+            self._seconds = collections.Counter()
+            self._last_keys = {}
+
+    def phases(self):
+        """Return dict with the seconds measured in each phase."""
+
+        totals = collections.Counter()
+        for (phase, stack), count, seconds in self._samples():
+            totals[phase] += seconds
+        return dict(totals)
+
+    def functions(self, phase=None):
+        """
+        Return list of (<function label>, <self seconds>, <total seconds>),
+        most self seconds first.
+
+        Self seconds are those of the samples with the function on top of
+        the stack, total seconds those of the samples with the function
+        anywhere on the stack.
+
+        Parameters:
+        phase (count only samples of this phase, optional)
+        """
+
+        own = collections.Counter()
+        total = collections.Counter()
+        for (sample_phase, stack), count, seconds in self._samples():
+            if phase is not None and sample_phase != phase:
+                continue
+            own[stack[-1]] += seconds
+            for frame in set(stack):
+                total[frame] += seconds
+        return sorted(((_label(frame), own[frame], total[frame])
+                       for frame in total),
+                      key=lambda row: (-row[1], -row[2], row[0]))
+
+    def collapsed(self):
+        """
+        Return the samples as collapsed stacks, one line per stack, with the
+        phase as the root frame and the weight in microseconds.
+        """
+
+        lines = ['{0};{1} {2}'.format(phase, ';'.join(_label(frame)
+                                                     for frame in stack),
+                                      int(round(seconds * 1e6)))
+                 for (phase, stack), count, seconds in self._samples()]
+        return '\n'.join(sorted(lines)) + '\n'
+
+    def speedscope(self, name='biosim'):
+        """
+        Return dict in the speedscope file format, with one sampled profile
+        per phase, weighted by the measured seconds.
+
+        Parameters:
+        name (name of the profile, optional)
+        """
+
+        frames = []
+        index = {}
+        profiles = {}
+        for (phase, stack), count, seconds in sorted(self._samples()):
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({'name': frame[0], 'file': frame[1],
+                                   'line': frame[2]})
+            profile = profiles.setdefault(phase, {
+                    'type': 'sampled', 'name': phase, 'unit': 'seconds',
+                    'startValue': 0, 'endValue': 0,
+                    'samples': [], 'weights': []})
+            profile['samples'].append([index[frame] for frame in stack])
+            profile['weights'].append(seconds)
+            profile['endValue'] += seconds
+        return {'$schema': _SPEEDSCOPE_SCHEMA,
+                'name': name,
+                'exporter': 'cpuprofile',
+                'shared': {'frames': frames},
+                'profiles': [profiles[phase] for phase in sorted(profiles)]}
+
+    def write(self, path):
+        """
+        Write the samples to a file, as speedscope JSON if path ends with
+        .json and as collapsed stacks otherwise.
+
+        Parameters:
+        path (path of the file, required)
+        """
+
+        with open(path, 'w') as output:
+            if path.endswith('.json'):
+                json.dump(self.speedscope(), output)
+            else:
+                output.write(self.collapsed())
+
+    def report(self, top=15):
+        """
+        Return text with the share of the time spent in each phase, and
+        the functions with the most self time.
+
+        Parameters:
+        top (number of functions listed, optional)
+        """
+
+        samples = self.samples()
+        if samples == 0:
+            return 'No samples'
+        seconds = self.seconds()
+        lines = ['{0} samples, {1:.2f} s'.format(samples, seconds),
+                 '{0:40s} {1:>8s} {2:>7s}'.format('phase', 'seconds', '%')]
+        for phase, spent in sorted(self.phases().items(),
+                                   key=lambda item: -item[1]):
+            lines.append('{0:40s} {1:8.3f} {2:7.1f}'
+                         .format(phase, spent, 100. * spent / seconds))
+        lines.append('{0:40s} {1:>8s} {2:>7s}'.format('function', 'self s',
+                                                       'total %'))
+        for label, own, total in self.functions()[:top]:
+            lines.append('{0:40s} {1:8.3f} {2:7.1f}'
+                         .format(label[:40], own, 100. * total / seconds))
+        return '\n'.join(lines)
@@ -0,0 +1,248 @@
+#!/usr/env/bin python
+"""
+This module provides criteria for ending a simulation early.
+
+Each criterion is given the total herbivore and carnivore counts after
+every simulated year, and returns a string describing why the simulation
+should stop, or None to go on.
+
+Extinction() stops when all animals, or a single species, have died out.
+Stationarity() stops when the counts have stayed within a narrow band over
+a rolling window of years. StableCycle() stops when the counts repeat
+themselves with a fixed period over a rolling window of years.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import collections
+import numpy as np
+
+
+class Criterion(object):
+    """
+    Superclass for early stop criteria.
+
+    Subclasses override reset() and update().
+    """
+
+    def reset(self, herbivores, carnivores):
+        """
+        Prepare for a new simulation run.
+
+        Parameters:
+        herbivores (number of herbivores when the run starts, required)
+        carnivores (number of carnivores when the run starts, required)
+        """
+
+        pass
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Return reason to stop after this year, or None.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        return None
+
+
+class Extinction(Criterion):
+    """Stops when all animals or a single species have died out."""
+
+    SPECIES = ('all', 'any', 'herbivores', 'carnivores')
+
+    def __init__(self, species='all'):
+        """
+        Initialize an extinction criterion.
+
+        Parameters:
+        species ('all' to stop when no animals are left, 'any' to stop when
+                 either species has died out, or 'herbivores' or
+                 'carnivores', optional)
+
+        A single species only counts as extinct if it was present earlier
+        in the run.
+        """
+
+        if species not in self.SPECIES:
+            raise ValueError('Species must be one of {}'.format(self.SPECIES))
+        self._species = species
+        self._present = {'herbivores': False, 'carnivores': False}
+
+    def reset(self, herbivores, carnivores):
+        """
+        Prepare for a new simulation run.
+
+        Parameters:
+        herbivores (number of herbivores when the run starts, required)
+        carnivores (number of carnivores when the run starts, required)
+        """
+
+        self._present = {'herbivores': herbivores > 0,
+                         'carnivores': carnivores > 0}
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Return reason to stop after this year, or None.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        if self._species == 'all':
+            if herbivores == 0 and carnivores == 0:
+                return 'all animals extinct'
+            return None
+
+        counts = {'herbivores': herbivores, 'carnivores': carnivores}
+        if self._species == 'any':
+            candidates = ('herbivores', 'carnivores')
+        else:
+            candidates = (self._species,)
+        for species in candidates:
+            if self._present[species] and counts[species] == 0:
+                return '{} extinct'.format(species)
+        for species in counts:
+            if counts[species] > 0:
+                self._present[species] = True
+        return None
+
+
+class _WindowCriterion(Criterion):
+    """Superclass for criteria looking at a rolling window of counts."""
+
+    def __init__(self, window, history):
+        """
+        Initialize a window criterion.
+
+        Parameters:
+        window (number of years in the window, required)
+        history (number of years to keep, at least window, required)
+        """
+
+        if window < 2 or int(window) != window:
+            raise ValueError('Window must be an int of at least 2')
+        self._window = int(window)
+        self._history = int(history)
+        self.reset(0, 0)
+
+    def reset(self, herbivores, carnivores):
+        """
+        Prepare for a new simulation run.
+
+        Parameters:
+        herbivores (number of herbivores when the run starts, required)
+        carnivores (number of carnivores when the run starts, required)
+        """
+
+        self._counts = collections.deque(maxlen=self._history)
+
+    def _record(self, herbivores, carnivores):
+        """
+        Add this year's counts. Return array of shape (years, 2) with the
+        kept counts, or None if fewer than the needed years are kept.
+        """
+
+        self._counts.append((herbivores, carnivores))
+        if len(self._counts) < self._history:
+            return None
+        return np.array(self._counts, dtype=float)
+
+
+class Stationarity(_WindowCriterion):
+    """
+    Stops when the counts of both species have stayed within a narrow band
+    over the last window years.
+    """
+
+    def __init__(self, window=50, tolerance=0.05):
+        """
+        Initialize a stationarity criterion.
+
+        Parameters:
+        window (number of years in the window, optional)
+        tolerance (max spread (max - min) of each count, relative to its
+                   mean over the window, optional)
+        """
+
+        if tolerance < 0:
+            raise ValueError('Tolerance must be non-negative')
+        self._tolerance = tolerance
+        _WindowCriterion.__init__(self, window, window)
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Return reason to stop after this year, or None.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        counts = self._record(herbivores, carnivores)
+        if counts is None:
+            return None
+        spread = counts.max(axis=0) - counts.min(axis=0)
+        if np.all(spread <= self._tolerance * counts.mean(axis=0)):
+            return 'stationary for {} years'.format(self._window)
+        return None
+
+
+class StableCycle(_WindowCriterion):
+    """
+    Stops when the counts of both species have repeated themselves with a
+    fixed period over the last window years.
+
+    The counts of at least one species must vary by more than the tolerance
+    over the window. Constant counts, including those of extinct species,
+    are left to Stationarity and Extinction.
+    """
+
+    def __init__(self, window=50, max_period=20, tolerance=0.05):
+        """
+        Initialize a stable cycle criterion.
+
+        Parameters:
+        window (number of years in the window, optional)
+        max_period (longest period in years looked for, optional)
+        tolerance (max mean absolute difference between counts one period
+                   apart, relative to the mean count over the window,
+                   optional)
+        """
+
+        if max_period < 2 or int(max_period) != max_period:
+            raise ValueError('Max period must be an int of at least 2')
+        if tolerance < 0:
+            raise ValueError('Tolerance must be non-negative')
+        self._max_period = int(max_period)
+        self._tolerance = tolerance
+        _WindowCriterion.__init__(self, window, window + max_period)
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Return reason to stop after this year, or None.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        counts = self._record(herbivores, carnivores)
+        if counts is None:
+            return None
+        recent = counts[-self._window:]
+        limit = self._tolerance * recent.mean(axis=0)
+        if not np.any(recent.std(axis=0) > limit):
+            return None
+        for period in range(2, self._max_period + 1):
+            earlier = counts[-self._window - period:-period]
+            if np.all(np.abs(recent - earlier).mean(axis=0) <= limit):
+                return 'stable cycle with period {} years'.format(period)
+        return None
@@ -0,0 +1,341 @@
+#!/usr/env/bin python
+"""
+This module provides a binary log of simulation events, and replay of it.
+
+EventLog records births, deaths, kills, migrations, feedings and
+deployments as fixed size binary records, through a buffer that is written
+to file in blocks. Each record holds the year, the cell (flat map index)
+and the ids of the animals involved.
+
+Animal ids are only valid between two sync records. A sync is written
+together with each checkpoint, and numbers the animals in the order
+Checkpointer stores them: all herbivores cell by cell, then all
+carnivores, then any further species in the order of the species table.
+Animals born or deployed later get the next free ids.
+
+replay() rebuilds the state of any year from the nearest synced checkpoint
+and the events after it. Regrowth, aging and weight loss are deterministic
+and redone, everything random is read from the log. This is faster than
+simulating the years again, as no fitness is computed and no random
+numbers are drawn.
+
+Only terrains holding their animals as objects can be logged.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import numpy as np
+import species as spc
+
+MAGIC = b'SLOGEVT1'
+
+RECORD = np.dtype([('year', '<i4'),
+                   ('kind', 'u1'),
+                   ('species', 'u1'),
+                   ('cell', '<i4'),
+                   ('target', '<i4'),
+                   ('animal', '<i8'),
+                   ('other', '<i8'),
+                   ('value', '<f8')])
+
+# Record kinds. GROWTH and DECAY mark the start of the growth and decay
+# phases of a year.
+SYNC, GROWTH, DECAY, DEPLOY, FEED, KILL, BIRTH, MOVE, DEATH = range(9)
+
+KINDS = ('sync', 'growth', 'decay', 'deploy', 'feed', 'kill', 'birth',
+         'move', 'death')
+
+
+class EventLog(object):
+    """Writes simulation events to a binary file."""
+
+    def __init__(self, path, buffer_size=65536):
+        """
+        Initialize an event log. An existing file is overwritten.
+
+        Parameters:
+        path (path of the log file, required)
+        buffer_size (number of records kept before they are written,
+                     optional)
+        """
+
+        if buffer_size < 1:
+            raise ValueError('Buffer size must be positive')
+        self._path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._buffer = []
+        self._buffer_size = int(buffer_size)
+        self._written = 0
+
+        self._ids = {}
+        self._next_id = 0
+        self._year = 0
+        self._cell = -1
+        self._map_columns = 0
+
+    def path(self):
+        """Return the path of the log file."""
+
+        return self._path
+
+    def records(self):
+        """Return the number of records logged so far."""
+
+        return self._written + len(self._buffer)
+
+    def _add(self, kind, species, target, animal, other, value):
+        """Add a record for the current year and cell."""
+
+        self._buffer.append((self._year, kind, species, self._cell, target,
+                             animal, other, value))
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def _id(self, animal):
+        """Return id of an animal, giving it a new one if it has none."""
+
+        animal_id = self._ids.get(animal)
+        if animal_id is None:
+            animal_id = self._new_id(animal)
+        return animal_id
+
+    def _new_id(self, animal):
+        """Give an animal the next free id, and return it."""
+
+        animal_id = self._next_id
+        self._ids[animal] = animal_id
+        self._next_id += 1
+        return animal_id
+
+    def sync(self, terrain, year):
+        """
+        Renumber the animals of a terrain, in the order used by
+        Checkpointer, and write a sync record.
+
+        Parameters:
+        terrain (terrain object, required)
+        year (the current year, required)
+        """
+
+        self._year = year
+        self._cell = -1
+        self._map_columns = terrain.terrain_dimensions()[1]
+        self._ids = {}
+        self._next_id = 0
+        for species in spc.table():
+            for celle in terrain.terrain_map().flat:
+                for animal in celle.animals(species.index):
+                    self._new_id(animal)
+        self._add(SYNC, 0, -1, self._next_id, 0, 0.)
+
+    def at(self, cell):
+        """
+        Set the cell of the following events.
+
+        Parameters:
+        cell (flat map index, required)
+        """
+
+        self._cell = cell
+
+    def growth(self, year):
+        """Mark the start of the growth phase of a year."""
+
+        self._year = year
+        self._cell = -1
+        self._add(GROWTH, 0, -1, -1, 0, 0.)
+
+    def decay(self, year):
+        """Mark the start of the decay phase of a year."""
+
+        self._year = year
+        self._cell = -1
+        self._add(DECAY, 0, -1, -1, 0, 0.)
+
+    def deploy(self, animal, cell):
+        """
+        Log the deployment of a new animal.
+
+        Parameters:
+        animal (the deployed animal, required)
+        cell (flat map index, required)
+        """
+
+        self._cell = cell
+        self._add(DEPLOY, animal.species, -1, self._new_id(animal),
+                  animal.age(), animal.weight())
+
+    def feed(self, herbivore, amount):
+        """
+        Log a herbivore eating amount of food in the current cell.
+        """
+
+        self._add(FEED, 0, -1, self._id(herbivore), 0, amount)
+
+    def kill(self, carnivore, prey, amount):
+        """
+        Log a carnivore killing prey and eating amount of it.
+        """
+
+        self._add(KILL, carnivore.species, -1, self._id(carnivore),
+                  self._ids.pop(prey, -1), amount)
+
+    def birth(self, parent, child):
+        """Log the birth of child by parent."""
+
+        self._add(BIRTH, parent.species, -1, self._id(parent),
+                  self._new_id(child), child.weight())
+
+    def move(self, animal, destination):
+        """
+        Log an animal moving from the current cell.
+
+        Parameters:
+        animal (the animal, required)
+        destination (index (<row>, <column>) of the new cell, required)
+        """
+
+        self._add(MOVE, animal.species,
+                  destination[0] * self._map_columns + destination[1],
+                  self._id(animal), 0, 0.)
+
+    def death(self, animal):
+        """Log the death of an animal in the current cell."""
+
+        self._add(DEATH, animal.species, -1,
+                  self._ids.pop(animal, -1), 0, 0.)
+
+    def flush(self):
+        """Write the buffered records to file."""
+
+        if self._buffer:
+            np.array(self._buffer, dtype=RECORD).tofile(self._file)
+            self._written += len(self._buffer)
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        """Write the buffered records and close the file."""
+
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+def read(path):
+    """
+    Return structured array (dtype RECORD) with the records of a log file.
+
+    Parameters:
+    path (path of the log file, required)
+    """
+
+    with open(path, 'rb') as log_file:
+        if log_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an event log'.format(path))
+        return np.fromfile(log_file, dtype=RECORD)
+
+
+def _number(terrain):
+    """
+    Return list of the animals of a terrain, in the order used by
+    EventLog.sync(), so that an animal's position is its id.
+    """
+
+    animals = []
+    for species in spc.table():
+        for celle in terrain.terrain_map().flat:
+            animals.extend(celle.animals(species.index))
+    return animals
+
+
+def _relocate(terrain, moves):
+    """
+    Move animals to new cells, regrouped the same way as by
+    Terrain.migration().
+
+    Parameters:
+    terrain (terrain object, required)
+    moves (dict {<animal>: <flat index of new cell>}, required)
+    """
+
+    for species in spc.names():
+        (animals, cells) = terrain.species_animals(species)
+        terrain.relocate(species, [moves.get(animal, cell) for animal, cell
+                                   in zip(animals, cells)])
+
+
+def replay(terrain, checkpointer, path, year):
+    """
+    Set the food and animals of a terrain to their state at the end of a
+    year, from a checkpoint and an event log.
+
+    The terrain must have the same map and parameters as the logged run.
+
+    Return value: the year of the checkpoint replay started from.
+
+    Parameters:
+    terrain (terrain object holding animals as objects, required)
+    checkpointer (checkpoint.Checkpointer with the checkpoints written
+                  while logging, required)
+    path (path of the log file, required)
+    year (the year to rebuild, required)
+    """
+
+    records = read(path)
+    checkpointed = set(checkpointer.years())
+    syncs = [i for i in np.flatnonzero(records['kind'] == SYNC)
+             if records['year'][i] <= year and
+             records['year'][i] in checkpointed]
+    if not syncs:
+        raise KeyError('No checkpoint to replay year {} from'.format(year))
+    start = syncs[-1]
+    start_year = int(records['year'][start])
+    checkpointer.restore(terrain, start_year)
+
+    regions = terrain.terrain_map().reshape(-1)
+    animals = _number(terrain)
+    # Migrations of the current year, done together as in the simulation
+    moves = {}
+    for (record_year, kind, species, cell, target,
+         animal_id, other, value) in records[start + 1:].tolist():
+        if record_year > year:
+            break
+        if kind == MOVE:
+            moves[animals[animal_id]] = target
+            continue
+        if moves:
+            _relocate(terrain, moves)
+            moves = {}
+        if kind == FEED:
+            regions[cell]._food -= value
+            animals[animal_id].eat(value)
+        elif kind == KILL:
+            animals[animal_id].weightgain(
+                    animals[animal_id].params['beta'] * value)
+            regions[cell].dispatch(animals[other])
+        elif kind == BIRTH:
+            parent = animals[animal_id]
+            parent.birthloss()
+            child = parent.__class__(value)
+            regions[cell].deploy(child)
+            animals.append(child)
+        elif kind == DEATH:
+            regions[cell].dispatch(animals[animal_id])
+        elif kind == DEPLOY:
+            animal = spc.table()[species].animal_class.from_state(value,
+                                                                  other)
+            regions[cell].deploy(animal)
+            animals.append(animal)
+        elif kind == GROWTH:
+            terrain.regrowth()
+        elif kind == DECAY:
+            for celle in regions:
+                celle.aging_cycle()
+                celle.weightloss_cycle()
+        elif kind == SYNC:
+            animals = _number(terrain)
+    if moves:
+        _relocate(terrain, moves)
+    return start_year
@@ -0,0 +1,226 @@
+#!/usr/env/bin python
+"""
+This module provides the predation kernel, which lets the carnivores of one
+cell hunt its herbivores.
+
+Three versions of the kernel exist: compiled from predation.pyx when the
+extension has been built (see setup.no_py), compiled by Numba when it is
+installed (see numba_kernel()), and the pure Python hunt_cell_python().
+All follow the rules of Carnivore.hunt(), and give the same results for
+the same random numbers. hunt_cell is the kernel in use, see use_kernel()
+and backends.
+
+The kernel is given the NumPy bit generator to draw from, see
+slump.bit_generator(). Like Carnivore.hunt(), it draws a number only when a
+kill is uncertain, i.e. when the fitness difference is between 0 and
+DeltaPhiMax, and in the same order.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import math
+import numpy as np
+
+try:
+    import predation as _compiled
+except ImportError:
+    _compiled = None
+
+# Order of the carnivore parameters passed to the kernel loop
+_CONSTANTS = ('F', 'DeltaPhiMax', 'beta', 'w_min', 'phi_age', 'a_half',
+              'phi_low', 'w_half_low', 'phi_high', 'w_half_high')
+
+
+def _fitness_value(weight, age, w_min, phi_age, a_half, phi_low,
+                   w_half_low, phi_high, w_half_high):
+    """Return the fitness of an animal, from its parameters as numbers."""
+
+    if weight < w_min:
+        return 0.
+    return (1. / (1 + math.exp(min(phi_age * (age - a_half), 700.))) /
+            (1 + math.exp(min(-phi_low * (weight - w_half_low), 700.))) /
+            (1 + math.exp(min(phi_high * (weight - w_half_high), 700.))))
+
+
+def fitness_scalar(params, weight, age):
+    """
+    Return the fitness of a single animal.
+
+    Same formula as fitness.new_fitness(), in double precision.
+
+    Parameters:
+    params (parameter dict of the species, required)
+    weight (weight of the animal, required)
+    age (age of the animal, required)
+    """
+
+    return _fitness_value(weight, age, params['w_min'], params['phi_age'],
+                          params['a_half'], params['phi_low'],
+                          params['w_half_low'], params['phi_high'],
+                          params['w_half_high'])
+
+
+def _make_loop(jit):
+    """
+    Return the kernel loop, with it and the fitness function passed
+    through jit.
+
+    Parameters:
+    jit (decorator compiling a function, or returning it as it is,
+         required)
+    """
+
+    fitness_value = jit(_fitness_value)
+
+    def hunt_loop(prey_fitness, prey_weight, carnivore_weight,
+                  carnivore_age, carnivore_eaten, generator, constants,
+                  killer, eaten, gains):
+        """Fill killer, eaten and gains. See hunt_cell_python()."""
+
+        appetite = constants[0]
+        max_diff = constants[1]
+        beta = constants[2]
+        for i in range(len(carnivore_weight)):
+            weight = carnivore_weight[i]
+            fit = fitness_value(weight, carnivore_age[i], constants[3],
+                                constants[4], constants[5], constants[6],
+                                constants[7], constants[8], constants[9])
+            total = carnivore_eaten[i]
+            for j in range(len(prey_fitness)):
+                if killer[j] >= 0:
+                    continue
+                if total >= appetite:
+                    break
+                fit_diff = fit - prey_fitness[j]
+                if fit_diff <= 0:
+                    break
+                if (fit_diff < max_diff and
+                        generator.random() >= fit_diff / max_diff):
+                    continue
+                amount = min(prey_weight[j], appetite - total)
+                weight += beta * amount
+                total += amount
+                killer[j] = i
+                eaten[j] = amount
+                fit = fitness_value(weight, carnivore_age[i], constants[3],
+                                    constants[4], constants[5], constants[6],
+                                    constants[7], constants[8],
+                                    constants[9])
+            gains[i] = weight - carnivore_weight[i]
+
+    return jit(hunt_loop)
+
+
+def _run(loop, prey_fitness, prey_weight, carnivore_weight, carnivore_age,
+         carnivore_eaten, bit_generator, params):
+    """Return (killer, eaten, gains) from running a kernel loop."""
+
+    killer = np.full(len(prey_fitness), -1, dtype=np.int64)
+    eaten = np.zeros(len(prey_fitness))
+    gains = np.zeros(len(carnivore_weight))
+    loop(np.asarray(prey_fitness, dtype=float),
+         np.asarray(prey_weight, dtype=float),
+         np.asarray(carnivore_weight, dtype=float),
+         np.asarray(carnivore_age, dtype=float),
+         np.asarray(carnivore_eaten, dtype=float),
+         np.random.Generator(bit_generator),
+         np.array([params[name] for name in _CONSTANTS], dtype=float),
+         killer, eaten, gains)
+    return (killer, eaten, gains)
+
+
+_python_loop = _make_loop(lambda function: function)
+
+
+def hunt_cell_python(prey_fitness, prey_weight, carnivore_weight,
+                     carnivore_age, carnivore_eaten, bit_generator, params):
+    """
+    Let the carnivores of one cell hunt its herbivores.
+
+    Pure Python version of predation.hunt_cell(). The carnivores hunt one
+    by one, and each tries the remaining prey in order of ascending
+    fitness. A carnivore stops when it has eaten F this year, counting
+    what it ate before this hunt, e.g. of another prey species, or when its
+    fitness is not above that of the next prey. A kill is certain when the
+    fitness difference is at least DeltaPhiMax, and otherwise happens with
+    probability difference / DeltaPhiMax, decided by a number drawn from
+    bit_generator. The carnivore gains beta times the amount eaten, and its
+    fitness is updated after each kill.
+
+    Return value: tuple (killer, eaten, gains), where killer holds the
+    index of the carnivore that killed each prey, or -1 if it survived,
+    eaten the amount eaten of each prey, and gains the weight gained by
+    each carnivore.
+
+    Parameters:
+    prey_fitness (fitness of the herbivores, ascending, required)
+    prey_weight (weight of the herbivores, same order, required)
+    carnivore_weight (weight of the carnivores, descending fitness,
+                      required)
+    carnivore_age (age of the carnivores, same order, required)
+    carnivore_eaten (amount each carnivore has already eaten this year,
+                     same order, required)
+    bit_generator (numpy.random.BitGenerator to draw from, required)
+    params (carnivore parameters, required)
+    """
+
+    return _run(_python_loop, prey_fitness, prey_weight, carnivore_weight,
+                carnivore_age, carnivore_eaten, bit_generator, params)
+
+
+def compiled_kernel():
+    """
+    Return the kernel compiled from predation.pyx.
+
+    Raises ImportError if the extension has not been built.
+    """
+
+    if _compiled is None:
+        raise ImportError('The predation extension has not been built')
+    return _compiled.hunt_cell
+
+
+def numba_kernel():
+    """
+    Return the kernel compiled by Numba, with the same arguments as
+    hunt_cell_python().
+
+    Raises ImportError if Numba is not installed.
+    """
+
+    import numba
+    loop = _make_loop(numba.njit(nogil=True))
+
+    def hunt_cell_numba(prey_fitness, prey_weight, carnivore_weight,
+                        carnivore_age, carnivore_eaten, bit_generator,
+                        params):
+        """Let the carnivores of one cell hunt, see hunt_cell_python()."""
+
+        return _run(loop, prey_fitness, prey_weight, carnivore_weight,
+                    carnivore_age, carnivore_eaten, bit_generator, params)
+
+    return hunt_cell_numba
+
+
+def use_kernel(kernel):
+    """
+    Use kernel as hunt_cell from now on.
+
+    Parameters:
+    kernel (function with the arguments of hunt_cell_python(), required)
+    """
+
+    global hunt_cell
+    hunt_cell = kernel
+
+
+def compiled():
+    """Return True if a compiled kernel is in use."""
+
+    return hunt_cell is not hunt_cell_python
+
+
+if _compiled is not None:
+    hunt_cell = _compiled.hunt_cell
+else:
+    hunt_cell = hunt_cell_python
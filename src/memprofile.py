@@ -0,0 +1,163 @@
+#!/usr/env/bin python
+"""
+This module provides memory accounting for the simulation.
+
+animal_bytes() and region_bytes() estimate the number of bytes held by one
+animal or one region. Objects shared between instances, such as small ints,
+None, strings, tuples and class attributes, are not counted. Neither are
+the animals held by a region.
+
+PhaseMemoryProfiler uses tracemalloc to find the peak memory allocated
+during each phase of a simulated year.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import struct
+import sys
+import tracemalloc
+
+# Size of the reference held by a list or an object array
+POINTER_BYTES = struct.calcsize('P')
+
+
+def _attributes(obj):
+    """Return list with the attribute values of an object."""
+
+    values = []
+    for klass in type(obj).__mro__:
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                values.append(getattr(obj, name))
+    if hasattr(obj, '__dict__'):
+        values.extend(obj.__dict__.values())
+    return values
+
+
+def _own_bytes(value):
+    """
+    Return the bytes of an attribute value not shared with other objects.
+
+    Lists are counted without their items.
+    """
+
+    if isinstance(value, list):
+        return sys.getsizeof(value) - len(value) * POINTER_BYTES
+    if isinstance(value, bool):
+        return 0
+    if isinstance(value, int) and -5 <= value <= 256:
+        # Small ints are cached by the interpreter
+        return 0
+    if isinstance(value, (int, float)):
+        return sys.getsizeof(value)
+    return 0
+
+
+def object_bytes(obj):
+    """
+    Return the bytes held by an object and its attribute values.
+
+    Parameters:
+    obj (object to measure, required)
+    """
+
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size + sum(_own_bytes(value) for value in _attributes(obj))
+
+
+def animal_bytes(animal):
+    """
+    Return the bytes held by an animal, including its place in a region list.
+
+    Parameters:
+    animal (animal object, required)
+    """
+
+    return object_bytes(animal) + POINTER_BYTES
+
+
+def region_bytes(region):
+    """
+    Return the bytes held by a region, including its place in the terrain
+    array, but not counting its animals.
+
+    Parameters:
+    region (region object, required)
+    """
+
+    return object_bytes(region) + POINTER_BYTES
+
+
+class PhaseMemoryProfiler(object):
+    """Records peak memory use during each phase of the simulation."""
+
+    def __init__(self):
+        """Initialize a profiler. Tracing is started by start()."""
+
+        self._peaks = {}
+        self._running = False
+        self._started_tracing = False
+
+    def start(self):
+        """Start profiling, and start tracing memory allocations if needed."""
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._running = True
+
+    def stop(self):
+        """
+        Stop profiling, and stop tracing memory allocations if started by
+        this profiler. The recorded peaks are kept.
+        """
+
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self._running = False
+
+    def running(self):
+        """Return True if the profiler is started."""
+
+        return self._running
+
+    def run(self, phase, function, *args):
+        """
+        Call function(*args) and record its peak memory use, if started.
+
+        The peak is the largest number of bytes allocated on top of what was
+        allocated when the call started. For every phase the highest peak
+        seen so far is kept.
+
+        Return value: the return value of function.
+
+        Parameters:
+        phase (name of the phase, required)
+        function (function to call, required)
+        args (arguments for function, optional)
+        """
+
+        if not self._running:
+            return function(*args)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1] - before
+        self._peaks[phase] = max(peak, self._peaks.get(phase, 0))
+        return result
+
+    def peaks(self):
+        """Return dict with the peak bytes allocated during each phase."""
+
+        return dict(self._peaks)
+
+    def reset(self):
+        """Forget the recorded peaks."""
+
+        self._peaks = {}
@@ -0,0 +1,108 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+This module provides the compiled predation kernel.
+
+hunt_cell() follows hunting.hunt_cell_python(), and runs without the GIL.
+Random numbers are drawn through the C interface of the NumPy bit
+generator, while holding its lock.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import numpy as np
+from cpython.pycapsule cimport PyCapsule_GetPointer
+from libc.math cimport exp, fmin
+from libc.stdint cimport uint32_t, uint64_t
+
+
+# Same layout as bitgen_t in numpy/random/bitgen.h, so that the NumPy
+# headers are not needed to build the extension
+ctypedef struct bitgen_t:
+    void *state
+    uint64_t (*next_uint64)(void *st) noexcept nogil
+    uint32_t (*next_uint32)(void *st) noexcept nogil
+    double (*next_double)(void *st) noexcept nogil
+    uint64_t (*next_raw)(void *st) noexcept nogil
+
+
+cdef inline double _fitness(double weight, double age, double w_min,
+                            double phi_age, double a_half, double phi_low,
+                            double w_half_low, double phi_high,
+                            double w_half_high) noexcept nogil:
+    """Return the fitness of an animal, as hunting.fitness_scalar()."""
+
+    if weight < w_min:
+        return 0.
+    return (1. / (1 + exp(fmin(phi_age * (age - a_half), 700))) /
+            (1 + exp(fmin(-phi_low * (weight - w_half_low), 700))) /
+            (1 + exp(fmin(phi_high * (weight - w_half_high), 700))))
+
+
+def hunt_cell(prey_fitness, prey_weight, carnivore_weight, carnivore_age,
+              carnivore_eaten, bit_generator, params):
+    """
+    Let the carnivores of one cell hunt its herbivores.
+
+    See hunting.hunt_cell_python() for the rules, parameters and return
+    value.
+    """
+
+    cdef double[::1] p_fitness = np.ascontiguousarray(prey_fitness,
+                                                      dtype=np.float64)
+    cdef double[::1] p_weight = np.ascontiguousarray(prey_weight,
+                                                     dtype=np.float64)
+    cdef double[::1] c_weight = np.ascontiguousarray(carnivore_weight,
+                                                     dtype=np.float64)
+    cdef double[::1] c_age = np.ascontiguousarray(carnivore_age,
+                                                  dtype=np.float64)
+    cdef double[::1] c_eaten = np.ascontiguousarray(carnivore_eaten,
+                                                    dtype=np.float64)
+    cdef bitgen_t *rng = <bitgen_t *> PyCapsule_GetPointer(
+            bit_generator.capsule, "BitGenerator")
+
+    killer_array = np.full(p_fitness.shape[0], -1, dtype=np.int64)
+    eaten_array = np.zeros(p_fitness.shape[0])
+    gains_array = np.zeros(c_weight.shape[0])
+    cdef long long[::1] killer = killer_array
+    cdef double[::1] eaten = eaten_array
+    cdef double[::1] gains = gains_array
+
+    cdef double appetite = params['F']
+    cdef double max_diff = params['DeltaPhiMax']
+    cdef double beta = params['beta']
+    cdef double w_min = params['w_min']
+    cdef double phi_age = params['phi_age']
+    cdef double a_half = params['a_half']
+    cdef double phi_low = params['phi_low']
+    cdef double w_half_low = params['w_half_low']
+    cdef double phi_high = params['phi_high']
+    cdef double w_half_high = params['w_half_high']
+
+    cdef Py_ssize_t i, j
+    cdef double weight, fit, total, fit_diff, amount
+    with bit_generator.lock, nogil:
+        for i in range(c_weight.shape[0]):
+            weight = c_weight[i]
+            fit = _fitness(weight, c_age[i], w_min, phi_age, a_half,
+                           phi_low, w_half_low, phi_high, w_half_high)
+            total = c_eaten[i]
+            for j in range(p_fitness.shape[0]):
+                if killer[j] >= 0:
+                    continue
+                if total >= appetite:
+                    break
+                fit_diff = fit - p_fitness[j]
+                if fit_diff <= 0:
+                    break
+                if (fit_diff < max_diff and
+                        rng.next_double(rng.state) >= fit_diff / max_diff):
+                    continue
+                amount = fmin(p_weight[j], appetite - total)
+                weight += beta * amount
+                total += amount
+                killer[j] = i
+                eaten[j] = amount
+                fit = _fitness(weight, c_age[i], w_min, phi_age, a_half,
+                               phi_low, w_half_low, phi_high, w_half_high)
+            gains[i] = weight - c_weight[i]
+    return (killer_array, eaten_array, gains_array)
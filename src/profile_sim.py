@@ -1,99 +1,58 @@
 '''
-:mod:`profile_sim` runs a BioSim simulation 
+:mod:`profile_sim` runs a BioSim simulation with the sampling CPU profiler
 and illustrates how to use the resulting information.
 
-Original code written by Hans E Plesser. 
+Original code written by Hans E Plesser.
 Slight modification by Aleksander Hykkerud and Daniel Hjertholm.
 
+The profile is written as collapsed stacks to biosim.collapsed, for flame
+graph tools, and as speedscope JSON to biosim.speedscope.json, to be
+opened at https://www.speedscope.app. No external programs are needed.
+
 .. seealso::
 
-  - http://docs.python.org/library/profile.html
-  - http://www.doughellmann.com/PyMOTW/profile
+  - cpuprofile.py
 '''
 
 __author__ = "Hans E Plesser, UMB"
 
-import cProfile
-import pstats
-import os
+import sys
 
 from slogstorm import InputHandler
 
-# HEP's laptop
-_GPROF2DOT = '/Library/Frameworks/EPD64.framework/Versions/Current/bin/gprof2dot'
-_DOT = '/usr/local/bin/dot'
-
-# TF02
-#_GPROF2DOT = 'gprof2dot'
-#_DOT = r'I:\tools\Graphviz\bin\dot'
-
 if __name__ == '__main__':
 
-    # turn off all graphics by replacing graphics functions
-    # with mock functions
-    
-    # run_simulation._setup_graphics = Mock()
-    # run_simulation._update_graphics = Mock()
-    # run_simulation._save_graphics = Mock()
-
-    # initialize setup
-    sim = InputHandler(mapfile="mapfile.txt")
-    sim.set_plot_update_interval(40)
-    sim.deploy_animals(
-        [{'loc': (2, 2), 
-          'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]},
-         {'loc': (2, 2), 
-          'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]},
-         {'loc': (2, 2), 
-          'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]},
-         {'loc': (2, 2), 
-          'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]}])
-
-    # profile with direct output to console, short run
-    cProfile.run('sim.run_simulation(100)')
-    
+    # initialize setup, without graphics
+    sim = InputHandler(mapfile="mapfile.txt", headless=True)
     sim.deploy_animals(
-        [{'loc': (3, 3), 
-          'pop': [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}]},
-         {'loc': (3, 3), 
-          'pop': [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}]},
-         {'loc': (3, 3), 
-          'pop': [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}]},
-         {'loc': (3, 3), 
-          'pop': [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}]}])
-
-    # profile with output to file, longer run
-    prof_file = 'biosim.prof'
-    cProfile.run('sim.run_simulation(100)', prof_file)
-
-    # read profile data from file, output statistics in different orders
-    prof = pstats.Stats(prof_file).strip_dirs()
-
-
-#    print '=' * 80
-#    prof.sort_stats('name').print_stats()
-#    
-#    print '=' * 80
-#    prof.sort_stats('cum').print_stats()
-#
-#    print '=' * 80
-#    prof.sort_stats('time').print_stats()
-#
-#    print '=' * 80
-#    prof.sort_stats('calls').print_stats()
-#
-#    print '=' * 80
-#    prof.print_callers()
-#
-#    print '=' * 80
-#    prof.print_callees()
-
-    
-    # finally, invoke gprof2dot and dot to create a figure
-    os.system('{gprof2dot} -f pstats -o {file}.dot {file}'
-              .format(gprof2dot=_GPROF2DOT, file=prof_file))
-    os.system('{dot} -Tpdf -o {file}.pdf {file}.dot'
-              .format(dot=_DOT, file=prof_file))
-    print "Profile graph stored as {file}.pdf".format(file=prof_file)
+        [{'loc': (2, 2),
+          'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 4}])
 
+    # profile a short run, summary to console
+    sim.run_simulation(100, profile='biosim_herbivores.collapsed')
+    print(sim.cpu_profile().report())
 
+    # the carnivores are placed with the herbivores, as (3, 3) is a
+    # mountain
+    sim.deploy_animals(
+        [{'loc': (2, 2),
+          'pop': [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 4}])
+
+    # profile a longer run, and write the samples in both formats
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else 0.005
+    sim.profile_cpu(interval=interval)
+    sim.run_simulation(100)
+    sim.profile_cpu(False)
+    profile = sim.cpu_profile()
+
+    print('=' * 80)
+    print(profile.report(top=25))
+    for phase in sorted(profile.phases()):
+        print('=' * 80)
+        print(phase)
+        for label, own, total in profile.functions(phase)[:5]:
+            print('    {0:50s} {1:8.3f}'.format(label[:50], own))
+
+    profile.write('biosim.collapsed')
+    profile.write('biosim.speedscope.json')
+    print('Profile stored as biosim.collapsed and biosim.speedscope.json')
@@ -0,0 +1,145 @@
+#!/usr/env/bin python
+"""
+This module provides downsampled pyramids of maps, used for drawing.
+
+Level 0 of a Pyramid is the map itself, with one value (or one RGB triple)
+per cell. Every following level sums blocks of 2 x 2 cells of the level
+below, until a single block is left. Mean values are the sums divided by
+the number of map cells in each block, so that maps whose size is not a
+power of two are pooled correctly at the edges.
+
+update() only recomputes the blocks above cells that changed, so that a
+map that changes little between two drawings is cheap to keep up to date.
+When most cells change, all levels are pooled again instead.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import numpy as np
+
+# update() pools all levels again when more than one in this many cells
+# changed, as that is faster than recomputing the blocks one by one
+_REBUILD_FRACTION = 8
+
+
+def _pool(matrix):
+    """
+    Return matrix with the sums over blocks of 2 x 2 cells.
+
+    Odd rows and columns are padded with zeros.
+    """
+
+    (rows, columns) = matrix.shape[:2]
+    padding = [(0, rows % 2), (0, columns % 2)] + [(0, 0)] * (matrix.ndim - 2)
+    matrix = np.pad(matrix, padding, mode='constant')
+    return matrix.reshape((matrix.shape[0] // 2, 2, matrix.shape[1] // 2, 2) +
+                          matrix.shape[2:]).sum(axis=(1, 3))
+
+
+class Pyramid(object):
+    """Sums of a map over blocks of 2**k x 2**k cells, for every level k."""
+
+    def __init__(self, matrix):
+        """
+        Initialize a pyramid.
+
+        Parameters:
+        matrix (array of shape (rows, columns) or (rows, columns, channels),
+                required)
+        """
+
+        matrix = np.array(matrix, dtype=float)
+        if matrix.ndim < 2:
+            raise ValueError('Need a matrix of at least two dimensions')
+        self._levels = [matrix]
+        # Number of map cells in every block
+        self._cells = [np.ones(matrix.shape[:2])]
+        while max(self._levels[-1].shape[:2]) > 1:
+            self._levels.append(_pool(self._levels[-1]))
+            self._cells.append(_pool(self._cells[-1]))
+
+    def levels(self):
+        """Return the number of levels."""
+
+        return len(self._levels)
+
+    def shape(self, level):
+        """Return (<rows>, <columns>) of a level."""
+
+        return self._levels[level].shape[:2]
+
+    def sums(self, level):
+        """Return the block sums of a level."""
+
+        return self._levels[level]
+
+    def mean(self, level):
+        """Return the means over the map cells of every block of a level."""
+
+        cells = self._cells[level]
+        return self._levels[level] / cells.reshape(
+                cells.shape + (1,) * (self._levels[level].ndim - 2))
+
+    def fitting(self, rows, columns):
+        """
+        Return the finest level with at most rows x columns blocks, or the
+        coarsest level if none has.
+
+        Parameters:
+        rows (max number of rows, e.g. the height in pixels, required)
+        columns (max number of columns, required)
+        """
+
+        for level in range(len(self._levels)):
+            shape = self.shape(level)
+            if shape[0] <= rows and shape[1] <= columns:
+                return level
+        return len(self._levels) - 1
+
+    def update(self, matrix):
+        """
+        Replace the map, and recompute the blocks above changed cells.
+
+        Return value: the number of changed cells.
+
+        Parameters:
+        matrix (array with the shape of level 0, required)
+        """
+
+        matrix = np.asarray(matrix, dtype=float)
+        base = self._levels[0]
+        if matrix.shape != base.shape:
+            raise ValueError('Shape must be {}'.format(base.shape))
+        changed = base != matrix
+        if changed.ndim > 2:
+            changed = changed.any(axis=tuple(range(2, changed.ndim)))
+        (rows, columns) = np.nonzero(changed)
+        base[rows, columns] = matrix[rows, columns]
+        count = len(rows)
+        if count > changed.size // _REBUILD_FRACTION:
+            for level in range(1, len(self._levels)):
+                self._levels[level] = _pool(self._levels[level - 1])
+            return count
+
+        for level in range(1, len(self._levels)):
+            if len(rows) == 0:
+                break
+            below = self._levels[level - 1]
+            width = self._levels[level].shape[1]
+            blocks = np.unique((rows // 2) * width + columns // 2)
+            (rows, columns) = np.divmod(blocks, width)
+            total = 0.
+            for step_row in (0, 1):
+                for step_column in (0, 1):
+                    row = 2 * rows + step_row
+                    column = 2 * columns + step_column
+                    inside = ((row < below.shape[0]) &
+                              (column < below.shape[1]))
+                    values = below[np.minimum(row, below.shape[0] - 1),
+                                   np.minimum(column, below.shape[1] - 1)]
+                    total = total + np.where(
+                            inside.reshape(inside.shape +
+                                           (1,) * (values.ndim - 1)),
+                            values, 0.)
+            self._levels[level][rows, columns] = total
+        return count
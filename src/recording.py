@@ -0,0 +1,373 @@
+#!/usr/env/bin python
+"""
+This module provides recording of simulation outputs, and a reader that
+queries them without loading whole runs.
+
+Recorder writes, year by year, the herbivore and carnivore totals and the
+per-cell count matrices to flat binary files in a directory. For every
+chunk of chunk_years recorded years it also writes per-cell summaries:
+the sum and the maximum of the counts over the chunk.
+
+Recording memory maps the files. Indexing it with a species, and
+optionally a year range and a window of rows and columns, gives a
+Selection, which reads nothing until asked:
+
+    recording = Recording('run')
+    window = recording['herbivores', 5000:6000, 10:20, 5:15]
+    window.mean()    # mean count per cell and year
+    window.max()     # max count of any cell and year
+    window.counts()  # memory mapped view of the counts
+
+Years are the simulation years as recorded, and year ranges include the
+start and exclude the stop, as slices. Rows and columns are 0-based map
+indices. Means and maxima are served from the summaries for the chunks
+lying entirely inside the year range, so only the years at the ends of the
+range are read from the counts.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import json
+import os
+import numpy as np
+
+SPECIES = ('herbivores', 'carnivores')
+
+# Files of a recording, and the dtype of their elements
+_FILES = {'years': 'int64',
+          'totals': 'int64',
+          'counts': 'int32',
+          'chunk_sums': 'float64',
+          'chunk_maxima': 'int32'}
+
+_LAYOUT = 'recording.json'
+
+
+def _path(directory, name):
+    """Return the path of one of the files of a recording."""
+
+    return os.path.join(directory, name + '.dat')
+
+
+class Recorder(object):
+    """Writes the totals and count matrices of every year to files."""
+
+    def __init__(self, directory, dimensions, chunk_years=100):
+        """
+        Initialize a recorder. An existing recording in directory is
+        overwritten.
+
+        Parameters:
+        directory (directory for the files, created if missing, required)
+        dimensions (tuple (<rows>, <columns>) of the map, required)
+        chunk_years (number of years summarized together, optional)
+        """
+
+        if chunk_years < 1:
+            raise ValueError('Chunk years must be positive')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._dimensions = tuple(int(n) for n in dimensions)
+        self._chunk_years = int(chunk_years)
+        with open(os.path.join(directory, _LAYOUT), 'w') as layout:
+            json.dump({'rows': self._dimensions[0],
+                       'columns': self._dimensions[1],
+                       'chunk_years': self._chunk_years,
+                       'species': SPECIES}, layout)
+        self._files = dict((name, open(_path(directory, name), 'wb'))
+                           for name in _FILES)
+
+        self._last_year = None
+        self._years_in_chunk = 0
+        shape = (len(SPECIES),) + self._dimensions
+        self._chunk_sum = np.zeros(shape)
+        self._chunk_max = np.zeros(shape, dtype=np.int32)
+
+    def directory(self):
+        """Return the directory of the recording."""
+
+        return self._directory
+
+    def record(self, year, herbivore_counts, carnivore_counts):
+        """
+        Record the counts of a year.
+
+        Parameters:
+        year (the year, later than the last recorded, required)
+        herbivore_counts (matrix with the herbivores in each cell, required)
+        carnivore_counts (matrix with the carnivores in each cell, required)
+        """
+
+        if self._last_year is not None and year <= self._last_year:
+            raise ValueError('Year {0} is not after {1}'
+                             .format(year, self._last_year))
+        counts = np.array([herbivore_counts, carnivore_counts],
+                          dtype=np.int32)
+        if counts.shape[1:] != self._dimensions:
+            raise ValueError('Count matrices must have shape {}'
+                             .format(self._dimensions))
+        np.array([year], dtype=_FILES['years']).tofile(self._files['years'])
+        counts.sum(axis=(1, 2), dtype=_FILES['totals']).tofile(
+                self._files['totals'])
+        counts.tofile(self._files['counts'])
+        self._last_year = year
+
+        self._chunk_sum += counts
+        np.maximum(self._chunk_max, counts, out=self._chunk_max)
+        self._years_in_chunk += 1
+        if self._years_in_chunk == self._chunk_years:
+            self._chunk_sum.tofile(self._files['chunk_sums'])
+            self._chunk_max.tofile(self._files['chunk_maxima'])
+            self._chunk_sum[:] = 0
+            self._chunk_max[:] = 0
+            self._years_in_chunk = 0
+
+    def flush(self):
+        """Write buffered data to the files."""
+
+        for recording_file in self._files.values():
+            recording_file.flush()
+
+    def close(self):
+        """Write buffered data and close the files."""
+
+        for recording_file in self._files.values():
+            if not recording_file.closed:
+                recording_file.close()
+
+
+class Recording(object):
+    """Memory mapped reader of a recording written by Recorder."""
+
+    def __init__(self, directory):
+        """
+        Open a recording.
+
+        Parameters:
+        directory (directory written by Recorder, required)
+        """
+
+        with open(os.path.join(directory, _LAYOUT)) as layout:
+            layout = json.load(layout)
+        self._dimensions = (layout['rows'], layout['columns'])
+        self._chunk_years = layout['chunk_years']
+        self._species = tuple(layout['species'])
+
+        cell_shape = (len(self._species),) + self._dimensions
+        self._years = self._map(directory, 'years', ())
+        # A year is complete once its counts are written
+        n_years = min(len(self._years),
+                      len(self._map(directory, 'counts', cell_shape)))
+        self._years = self._years[:n_years]
+        self._totals = self._map(directory, 'totals',
+                                 (len(self._species),))[:n_years]
+        self._counts = self._map(directory, 'counts', cell_shape)[:n_years]
+        self._chunk_sums = self._map(directory, 'chunk_sums', cell_shape)
+        self._chunk_maxima = self._map(directory, 'chunk_maxima', cell_shape)
+
+    @staticmethod
+    def _map(directory, name, shape):
+        """
+        Return a file of the recording memory mapped, as array of rows of
+        the given shape.
+        """
+
+        dtype = np.dtype(_FILES[name])
+        path = _path(directory, name)
+        rows = os.path.getsize(path) // (dtype.itemsize *
+                                         int(np.prod(shape, dtype=int)))
+        if rows == 0:
+            return np.zeros((0,) + shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(rows,) + shape)
+
+    def dimensions(self):
+        """Return tuple (<rows>, <columns>) of the map."""
+
+        return self._dimensions
+
+    def chunk_years(self):
+        """Return the number of years summarized together."""
+
+        return self._chunk_years
+
+    def years(self):
+        """Return array with the recorded years."""
+
+        return self._years
+
+    def totals(self, species=None):
+        """
+        Return array with the total of every recorded year.
+
+        Parameters:
+        species (name of a species, optional. If omitted, an array of shape
+                 (years, species) is returned.)
+        """
+
+        if species is None:
+            return self._totals
+        return self._totals[:, self._species.index(species)]
+
+    def _rows(self, years):
+        """Return (first, stop) row of the years in slice years."""
+
+        if years.step is not None:
+            raise ValueError('Year ranges cannot have a step')
+        first = 0
+        stop = len(self._years)
+        if years.start is not None:
+            first = int(np.searchsorted(self._years, years.start, 'left'))
+        if years.stop is not None:
+            stop = int(np.searchsorted(self._years, years.stop, 'left'))
+        return (first, max(first, stop))
+
+    def __getitem__(self, key):
+        """
+        Return a Selection.
+
+        Parameters:
+        key (species name, or tuple (<species>, <years>, <rows>, <columns>)
+             where the last three are slices and may be left out, required)
+        """
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 4:
+            raise IndexError('Too many indices')
+        key = key + (slice(None),) * (4 - len(key))
+        (species, years, rows, columns) = key
+        if species not in self._species:
+            raise KeyError('No species called {}'.format(species))
+        rows = slice(*rows.indices(self._dimensions[0]))
+        columns = slice(*columns.indices(self._dimensions[1]))
+        return Selection(self, self._species.index(species),
+                         self._rows(years), rows, columns)
+
+
+class Selection(object):
+    """
+    The counts of one species in a year range and a window of cells.
+
+    Nothing is read until one of the methods is called.
+    """
+
+    def __init__(self, recording, species, rows, window_rows,
+                 window_columns):
+        """
+        Initialize a selection. Use Recording[...] instead.
+
+        Parameters:
+        recording (Recording, required)
+        species (index of the species, required)
+        rows (tuple (<first>, <stop>) of recorded rows, required)
+        window_rows (slice of map rows, required)
+        window_columns (slice of map columns, required)
+        """
+
+        self._recording = recording
+        self._species = species
+        self._rows = rows
+        self._window = (window_rows, window_columns)
+
+    def years(self):
+        """Return array with the years of the selection."""
+
+        return self._recording._years[self._rows[0]:self._rows[1]]
+
+    def shape(self):
+        """Return tuple (<years>, <rows>, <columns>) of the selection."""
+
+        return ((self._rows[1] - self._rows[0],) +
+                tuple(len(range(*s.indices(n))) for s, n in
+                      zip(self._window, self._recording._dimensions)))
+
+    def counts(self):
+        """
+        Return memory mapped view of the counts, of shape (years, rows,
+        columns).
+        """
+
+        return self._recording._counts[self._rows[0]:self._rows[1],
+                                       self._species][(slice(None),) +
+                                                      self._window]
+
+    def totals(self):
+        """Return array with the number of animals in the window each year."""
+
+        return self.counts().sum(axis=(1, 2), dtype=np.int64)
+
+    def _parts(self):
+        """
+        Return (whole chunks, [(first, stop) of rows outside them]).
+
+        whole chunks is a range of the summarized chunks lying entirely
+        inside the selected rows.
+        """
+
+        size = self._recording._chunk_years
+        (first, stop) = self._rows
+        first_chunk = -(-first // size)
+        stop_chunk = min(stop // size, len(self._recording._chunk_sums))
+        if first_chunk >= stop_chunk:
+            return (range(0), [(first, stop)])
+        return (range(first_chunk, stop_chunk),
+                [(first, first_chunk * size), (stop_chunk * size, stop)])
+
+    def _summary(self, name, chunks):
+        """Return summary name of chunks, restricted to the window."""
+
+        summary = getattr(self._recording, name)
+        return summary[chunks.start:chunks.stop, self._species][
+                (slice(None),) + self._window]
+
+    def _raw(self, first, stop):
+        """Return the counts of rows first to stop, in the window."""
+
+        return self._recording._counts[first:stop, self._species][
+                (slice(None),) + self._window]
+
+    def sum_map(self):
+        """Return matrix with the sum over the years of every cell."""
+
+        (chunks, edges) = self._parts()
+        total = np.zeros(self.shape()[1:])
+        if len(chunks):
+            total += self._summary('_chunk_sums', chunks).sum(axis=0)
+        for first, stop in edges:
+            if stop > first:
+                total += self._raw(first, stop).sum(axis=0)
+        return total
+
+    def mean_map(self):
+        """Return matrix with the mean over the years of every cell."""
+
+        if self.shape()[0] == 0:
+            raise ValueError('No years selected')
+        return self.sum_map() / self.shape()[0]
+
+    def mean(self):
+        """Return the mean count per cell and year."""
+
+        return float(self.mean_map().mean())
+
+    def max_map(self):
+        """Return matrix with the max over the years of every cell."""
+
+        if self.shape()[0] == 0:
+            raise ValueError('No years selected')
+        (chunks, edges) = self._parts()
+        maxima = np.zeros(self.shape()[1:], dtype=np.int64)
+        if len(chunks):
+            np.maximum(maxima, self._summary('_chunk_maxima',
+                                             chunks).max(axis=0), out=maxima)
+        for first, stop in edges:
+            if stop > first:
+                np.maximum(maxima, self._raw(first, stop).max(axis=0),
+                           out=maxima)
+        return maxima
+
+    def max(self):
+        """Return the max count of any cell and year."""
+
+        return int(self.max_map().max())
@@ -10,15 +10,32 @@ __author__ = "Aleksander Hykkerud and Daniel Hjertholm"
 
 import numpy as np
 import slump as sl
-import animaltypes as ani
+import hunting as hnt
+import species as spc
 
 class Region(object):
     """
     Represents a square region in the terrain.
     
     Superclass for specific region types.
+    
+    The state is kept in __slots__, so that regions carry no __dict__.
+    
+    The food is kept in a one element array. A Terrain replaces it with a 
+    view onto its food array (see attach_food()), so that regrowth can be 
+    done for the whole map at once.
+    
+    The animals are kept in one list per species, indexed by the row of 
+    the species in the species table.
     """
     
+    __slots__ = ('_animals', '_food_cell', '_livable', '_color', '_events')
+    
+    # Function regrowth(food, fmax, alpha) returning the food after one 
+    # year of regrowth, for scalars as well as arrays. None for regions 
+    # without food.
+    regrowth = None
+    
     def __init__(self, herbivores=None, carnivores=None):
         """
         Initialize a region.
@@ -28,19 +45,17 @@ class Region(object):
         carnivores (list of carnivore objects, optional)
         """
         
-        if herbivores == None:
-            self._herbivores = []
-        else:
-            self._herbivores = herbivores
-        
-        if carnivores == None:
-            self._carnivores = []
-        else:
-            self._carnivores = carnivores
+        self._animals = [[] for species in spc.table()]
+        if herbivores != None:
+            self._animals[spc.HERBIVORES] = herbivores
+        if carnivores != None:
+            self._animals[spc.CARNIVORES] = carnivores
         
-        self._food = 0
+        self._food_cell = np.zeros(1)
         self._livable = False   
         self._color = None 
+        # EventLog the region's events are written to, if any
+        self._events = None
         
     def __str__(self):
         """Return a simple string representation of the region."""
@@ -56,10 +71,46 @@ class Region(object):
         """
         
         return (self.__class__.__name__ + 
-                "({0}, {1}, {2})".format(self._herbivores, 
-                                         self._carnivores, 
+                "({0}, {1}, {2})".format(self.herbivores(), 
+                                         self.carnivores(), 
                                          self._food))
         
+    def _get_food(self):
+        """Return amount of food in region."""
+        
+        return float(self._food_cell[0])
+    
+    def _set_food(self, food):
+        """Set amount of food in region."""
+        
+        self._food_cell[0] = food
+        
+    _food = property(_get_food, _set_food)
+    
+    def attach_food(self, food_cell):
+        """
+        Keep the food in food_cell from now on.
+        
+        The current amount of food is copied to food_cell.
+        
+        Parameters:
+        food_cell (one element array, normally a view onto the food array 
+                   of a terrain, required)
+        """
+        
+        food_cell[0] = self._food_cell[0]
+        self._food_cell = food_cell
+        
+    def attach_events(self, events):
+        """
+        Log births, deaths, kills, migrations and feedings from now on.
+        
+        Parameters:
+        events (eventlog.EventLog object, or None to stop logging, required)
+        """
+        
+        self._events = events
+        
     def color(self):
         """Return color to represent region in map."""
         
@@ -68,12 +119,22 @@ class Region(object):
     def herbivores(self):
         """Return list of herbivores in region."""
 
-        return self._herbivores
+        return self._animals[spc.HERBIVORES]
 
     def carnivores(self):
         """Return list of carnivores in region."""
 
-        return self._carnivores
+        return self._animals[spc.CARNIVORES]
+    
+    def animals(self, species):
+        """
+        Return list of the animals of a species in region.
+        
+        Parameters:
+        species (row of the species in the species table, required)
+        """
+        
+        return self._animals[species]
         
     def move(self, animal, current_year):
         """
@@ -86,10 +147,7 @@ class Region(object):
             return False
         if not self._livable:
             return False
-        if animal.__class__ == ani.Herbivore:
-            self._herbivores.append(animal)
-        elif animal.__class__ == ani.Carnivore:
-            self._carnivores.append(animal)
+        self._animals[animal.species].append(animal)
         animal._last_moved = current_year
         return True    
     
@@ -102,18 +160,12 @@ class Region(object):
         
         if not self._livable:
             raise AttributeError('Cannot place animals in {}'.format(self))
-        if animal.__class__ == ani.Herbivore:
-            self._herbivores.append(animal)
-        elif animal.__class__ == ani.Carnivore:
-            self._carnivores.append(animal)
+        self._animals[animal.species].append(animal)
         
     def dispatch(self, animal):
         """Remove animal from region."""
         
-        if animal.__class__ == ani.Herbivore:
-            self._herbivores.remove(animal)
-        else:
-            self._carnivores.remove(animal)
+        self._animals[animal.species].remove(animal)
             
     def regrowth_cycle(self):
         """
@@ -131,52 +183,119 @@ class Region(object):
         This method is overloaded in certain subclasses.
         """
 
-        for herbivore in sorted(self._herbivores, 
-                                key=lambda herbivore: herbivore.fitness(), 
-                                reverse=True):
-            if herbivore.params['F'] <= self._food:
-                self._food -= herbivore.eat(herbivore.params['F'])
-            elif 0 < self._food < herbivore.params['F']:
-                self._food -= herbivore.eat(self._food)
-        for carnivore in sorted(self._carnivores, 
-                                key=lambda carnivore: carnivore.fitness(), 
-                                reverse=True):
-            carnivore.hunt(self._herbivores)
+        events = self._events
+        food = self._food
+        for grazer in spc.grazers():
+            for animal in sorted(self._animals[grazer.index], 
+                                 key=lambda animal: animal.fitness(), 
+                                 reverse=True):
+                if animal.params['F'] <= food:
+                    eaten = animal.eat(animal.params['F'])
+                elif 0 < food < animal.params['F']:
+                    eaten = animal.eat(food)
+                else:
+                    continue
+                food -= eaten
+                if events is not None:
+                    events.feed(animal, eaten)
+        self._food = food
+        for predator in spc.predators():
+            # What each predator has eaten, of all its prey species
+            intake = {}
+            for prey in predator.prey:
+                if self._animals[predator.index] and self._animals[prey]:
+                    self._predation_cycle(self._animals[predator.index], 
+                                          self._animals[prey], 
+                                          predator.params(), intake)
+    
+    def _predation_cycle(self, predators, victims, params, intake=None):
+        """
+        Let predators hunt victims, in order of descending fitness.
+        
+        Same rules as Carnivore.hunt(), done for the whole region by the 
+        predation kernel in hunting.
+        
+        Parameters:
+        predators (list of the animals hunting, required)
+        victims (list of the animals hunted, killed ones are removed, 
+                 required)
+        params (parameters of the predators, required)
+        intake (dict with the amount each predator has eaten this year, 
+                updated with the kills, optional. Predators eat at most F 
+                a year in total.)
+        """
+        
+        if intake is None:
+            intake = {}
+        carnivores = sorted(predators, 
+                            key=lambda carnivore: carnivore.fitness(), 
+                            reverse=True)
+        prey = sorted(victims, key=lambda herbivore: herbivore.fitness())
+        (killer, eaten, gains) = hnt.hunt_cell(
+                np.array([herbivore.fitness() for herbivore in prey]),
+                np.array([herbivore.weight() for herbivore in prey]),
+                np.array([carnivore.weight() for carnivore in carnivores]),
+                np.array([carnivore.age() for carnivore in carnivores]),
+                np.array([intake.get(carnivore, 0.) 
+                          for carnivore in carnivores]),
+                sl.bit_generator(), params)
+        killed = np.flatnonzero(killer >= 0)
+        if len(killed) == 0:
+            return
+        # Kills in the order they happened for each carnivore, so that 
+        # its weight adds up the same way as in Carnivore.hunt()
+        for j in killed:
+            carnivores[killer[j]].weightgain(params['beta'] * eaten[j])
+            intake[carnivores[killer[j]]] = (
+                    intake.get(carnivores[killer[j]], 0.) + eaten[j])
+            if self._events is not None:
+                self._events.kill(carnivores[killer[j]], prey[j], eaten[j])
+        dead = set(prey[j] for j in killed)
+        victims[:] = [herbivore for herbivore in victims 
+                      if herbivore not in dead]
     
     def breeding_cycle(self):   
         """Do one cycle (one year) of breeding."""
  
-        # Variables that count the number of mature animals in the region.
-        mature_herbs = len([herb for herb in self._herbivores 
-                            if herb.age() > 0])
-        mature_carns = len([carn for carn in self._carnivores 
-                            if carn.age() > 0])
-        for herbivore in self._herbivores:
-            if herbivore.birth(mature_herbs):
-                self.deploy(ani.Herbivore(herbivore.params['w_birth']))
-        for carnivore in self._carnivores:
-            if carnivore.birth(mature_carns):
-                self.deploy(ani.Carnivore(carnivore.params['w_birth']))
+        for animals in self._animals:
+            # The number of mature animals of the species in the region.
+            mature = len([animal for animal in animals if animal.age() > 0])
+            for animal in animals:
+                if animal.birth(mature):
+                    child = animal.__class__(animal.params['w_birth'])
+                    self.deploy(child)
+                    if self._events is not None:
+                        self._events.birth(animal, child)
     
     def aging_cycle(self):
         """Do one cycle (one year) of aging."""
 
-        for animal in self._herbivores + self._carnivores:
-            animal.aging()
+        for animals in self._animals:
+            for animal in animals:
+                animal.aging()
     
     def weightloss_cycle(self):
         """Do one cycle (one year) of weightloss."""
 
-        for animal in self._herbivores + self._carnivores:
-            animal.weightloss()
+        for animals in self._animals:
+            for animal in animals:
+                animal.weightloss()
     
     def death_cycle(self):
         """Do one cycle (one year) of death."""
 
-        self._herbivores[:] = [herbivore for herbivore in self._herbivores 
-                              if not herbivore.death()]
-        self._carnivores[:] = [carnivore for carnivore in self._carnivores 
-                              if not carnivore.death()]
+        if self._events is not None:
+            for animals in self._animals:
+                survivors = []
+                for animal in animals:
+                    if animal.death():
+                        self._events.death(animal)
+                    else:
+                        survivors.append(animal)
+                animals[:] = survivors
+            return
+        for animals in self._animals:
+            animals[:] = [animal for animal in animals if not animal.death()]
         
     def migration_cycle(self, terrain, current_year):
         """
@@ -196,7 +315,13 @@ class Region(object):
         adjacent_cells[1][0] -= 1
         adjacent_cells[2][1] += 1
         adjacent_cells[3][1] -= 1
-        for animal in self._herbivores + self._carnivores:
+        for animal in [animal for animals in self._animals 
+                       for animal in animals]:
+            # Animals that arrived this year cannot move again. Skipping
+            # them keeps the random numbers drawn for this cell independent
+            # of the order in which cells are processed.
+            if animal.last_moved() == current_year:
+                continue
             if animal.migrate():
                 randomint = sl.randint(4)
                 # Checks the cell designated in the list.
@@ -204,10 +329,14 @@ class Region(object):
                 coord = (check_cell[0], check_cell[1])
                 if terrain.terrain_map()[coord].move(animal, current_year):
                     self.dispatch(animal)
+                    if self._events is not None:
+                        self._events.move(animal, coord)
 
 
 class Desert(Region):
     """Represents a square dessert region in the terrain."""
+    
+    __slots__ = ()
 
     def __init__(self):
         """Initialize a dessert region."""
@@ -224,6 +353,8 @@ class Desert(Region):
 
 class Savannah(Region):
     """Represents a square savannah region in the terrain."""
+    
+    __slots__ = ()
 
     def __init__(self, herbivores=None, carnivores=None, food=None):
         """
@@ -253,18 +384,31 @@ class Savannah(Region):
         """
         
         Savannah.params = params
-        Savannah._food = Savannah.params['fmax']
+    
+    @staticmethod
+    def regrowth(food, fmax, alpha):
+        """
+        Return food after one year of regrowth.
+        
+        Parameters:
+        food (amount of food, float or array, required)
+        fmax (max amount of food, float or array, required)
+        alpha (regrowth rate, float or array, required)
+        """
+        
+        return food + alpha * (fmax - food)
     
     def regrowth_cycle(self):
         """Do one cycle (one year) of regrowth."""
 
-        self._food = (self._food + 
-                     self.params['alpha'] * 
-                     (self.params['fmax'] - self._food))
+        self._food = self.regrowth(self._food, self.params['fmax'], 
+                                   self.params['alpha'])
 
 
 class Jungle(Region):
     """Represents a square jungle region in the terrain."""
+    
+    __slots__ = ()
 
     def __init__(self, herbivores=None, carnivores=None, food=None):
         """
@@ -294,16 +438,32 @@ class Jungle(Region):
         """
         
         Jungle.params = params
-        Jungle._food = Jungle.params['fmax']
+    
+    @staticmethod
+    def regrowth(food, fmax, alpha):
+        """
+        Return food after one year of regrowth.
+        
+        The jungle grows back completely every year, so alpha is ignored.
+        
+        Parameters:
+        food (amount of food, float or array, required)
+        fmax (max amount of food, float or array, required)
+        alpha (regrowth rate, not used)
+        """
+        
+        return fmax
     
     def regrowth_cycle(self):
         """Do one cycle (one year) of regrowth."""
 
-        self._food = self.params['fmax']    
+        self._food = self.regrowth(self._food, self.params['fmax'], None)
 
 
 class Mountain(Region):
     """Represents a square mountain region in the terrain."""
+    
+    __slots__ = ()
 
     def __init__(self):
         """Initialize a savannah region."""
@@ -320,6 +480,8 @@ class Mountain(Region):
 
 class Ocean(Region):
     """Represents a square ocean region in the terrain."""
+    
+    __slots__ = ()
 
     def __init__(self):
         """Initialize a ocean region."""
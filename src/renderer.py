@@ -0,0 +1,209 @@
+#!/usr/env/bin python
+"""
+This module provides a rendering worker running in a separate process.
+
+RenderWorker() starts a process that owns its own Graphics object and draws
+compact snapshots of the simulation: the year, the yearly totals since the
+previous snapshot and the two count matrices. Snapshots are handed over
+through a bounded queue. When the queue is full, the snapshot is dropped
+instead of waiting, so the simulation never waits for drawing, except with
+flush() at the end of a run, so that the final state is drawn.
+
+A started worker is stopped at exit, after drawing the queued snapshots,
+unless stop() was called before.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import atexit
+import multiprocessing as mp
+import queue
+
+
+def _render_loop(graphics_class, snapshots, map_rgb, settings):
+    """
+    Draw snapshots from the queue until None is received.
+
+    Runs in the rendering process.
+
+    Parameters:
+    graphics_class (class used to draw, normally slogstorm.Graphics,
+                    required)
+    snapshots (queue of snapshot dicts, required)
+    map_rgb (array of region colors, see Terrain.map_rgb(), required)
+    settings (dict from Graphics.settings() in the simulating process,
+              required)
+    """
+
+    graphics = graphics_class()
+    graphics.apply_settings(settings)
+    # Every snapshot is drawn, so the graph is updated for every year
+    # it contains.
+    graphics.update_interval(1)
+    graphics.draw_map(map_rgb)
+
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        for year, h_count, c_count in zip(snapshot['years'],
+                                          snapshot['herbivores'],
+                                          snapshot['carnivores']):
+            graphics.draw_graph(h_count, c_count, year, snapshot['xlim'])
+        graphics.draw_herbivores(snapshot['herbivore_counts'])
+        graphics.draw_carnivores(snapshot['carnivore_counts'],
+                                 snapshot['year'])
+        graphics.update_graphics()
+        if snapshot['file_name_base'] is not None:
+            graphics.save_image(snapshot['file_name_base'])
+
+
+class RenderWorker(object):
+    """Draws simulation snapshots in a separate process."""
+
+    def __init__(self, graphics_class, map_rgb, settings, queue_size=2):
+        """
+        Initialize a render worker. The process is started by start().
+
+        Parameters:
+        graphics_class (class used to draw, normally slogstorm.Graphics,
+                        required)
+        map_rgb (array of region colors, see Terrain.map_rgb(), required)
+        settings (dict from Graphics.settings(), required)
+        queue_size (max number of snapshots waiting to be drawn, optional)
+        """
+
+        if queue_size < 1:
+            raise ValueError('Queue size must be positive')
+
+        self._context = mp.get_context('spawn')
+        self._snapshots = self._context.Queue(queue_size)
+        self._process = self._context.Process(
+                target=_render_loop,
+                args=(graphics_class, self._snapshots, map_rgb, settings))
+        self._process.daemon = True
+
+        # Yearly totals not yet handed over to the renderer
+        self._years = []
+        self._h_counts = []
+        self._c_counts = []
+
+        # Last dropped snapshot, drawn by stop() if nothing newer was queued
+        self._pending = None
+
+        self._submitted = 0
+        self._dropped = 0
+
+    def start(self):
+        """Start the rendering process."""
+
+        self._process.start()
+        # The process is a daemon, which would be killed at exit with the
+        # snapshots still queued
+        atexit.register(self.stop)
+
+    def is_alive(self):
+        """Return True if the rendering process is running."""
+
+        return self._process.is_alive()
+
+    def record(self, year, herbivore_count, carnivore_count):
+        """
+        Record the totals of one year for the next snapshot.
+
+        Parameters:
+        year (the current year, required)
+        herbivore_count (total number of herbivores, required)
+        carnivore_count (total number of carnivores, required)
+        """
+
+        self._years.append(year)
+        self._h_counts.append(herbivore_count)
+        self._c_counts.append(carnivore_count)
+
+    def submit(self, year, xlim, herbivore_counts, carnivore_counts,
+               file_name_base=None):
+        """
+        Hand a snapshot to the renderer without waiting.
+
+        Return True if the snapshot was queued, False if it was dropped
+        because the renderer is busy. Totals recorded since the last queued
+        snapshot are kept and sent with the next one.
+
+        Parameters:
+        year (the current year, required)
+        xlim (x-axis upper limit of the graph, required)
+        herbivore_counts (matrix of herbivore counts, required)
+        carnivore_counts (matrix of carnivore counts, required)
+        file_name_base (base of image file name, optional. If omitted,
+                        images are not saved.)
+        """
+
+        snapshot = {'year': year,
+                    'xlim': xlim,
+                    'years': self._years,
+                    'herbivores': self._h_counts,
+                    'carnivores': self._c_counts,
+                    'herbivore_counts': herbivore_counts,
+                    'carnivore_counts': carnivore_counts,
+                    'file_name_base': file_name_base}
+        try:
+            self._snapshots.put_nowait(snapshot)
+        except queue.Full:
+            self._dropped += 1
+            self._pending = snapshot
+            return False
+
+        self._pending = None
+        self._submitted += 1
+        self._years = []
+        self._h_counts = []
+        self._c_counts = []
+        return True
+
+    def submitted_frames(self):
+        """Return the number of snapshots handed to the renderer."""
+
+        return self._submitted
+
+    def dropped_frames(self):
+        """Return the number of snapshots dropped under backpressure."""
+
+        return self._dropped
+
+    def flush(self, timeout=None):
+        """
+        Queue the last snapshot if it was dropped, waiting for room, so that
+        the final state is drawn.
+
+        Parameters:
+        timeout (max seconds to wait for the renderer, optional)
+        """
+
+        if self._pending is not None and self._process.is_alive():
+            self._snapshots.put(self._pending, timeout=timeout)
+            self._pending = None
+            self._submitted += 1
+            self._years = []
+            self._h_counts = []
+            self._c_counts = []
+
+    def stop(self, timeout=None):
+        """
+        Let the renderer draw the queued snapshots, then stop it.
+
+        If the last snapshot was dropped, it is queued first, so that the
+        final state is always drawn.
+
+        Parameters:
+        timeout (max seconds to wait for the renderer, optional)
+        """
+
+        atexit.unregister(self.stop)
+        if self._process.is_alive():
+            self.flush(timeout)
+            self._snapshots.put(None, timeout=timeout)
+            self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
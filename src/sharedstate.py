@@ -0,0 +1,323 @@
+#!/usr/env/bin python
+"""
+This module provides terrain state in shared memory.
+
+SharedState() keeps the per-cell food, the terrain codes, the animal count
+matrices and flat per-animal state arrays in one
+multiprocessing.shared_memory block. The block is described by a small,
+picklable descriptor (see descriptor()). Other processes can attach to it
+with SharedState.attach() and read the arrays without any copying or
+serialization.
+
+The block is a one-way mirror, not the simulation's own state: the
+simulation keeps its food and animals in the Terrain, and publish() copies
+them into the block after every year. Other processes can read the state,
+e.g. to visualize or analyse it, but cannot simulate a part of the map in
+it, as changes to the block never reach the Terrain.
+
+The owner of the state writes to it with publish(). Readers should treat
+the arrays as read only. publish() makes the sequence number odd while it
+writes and even when done, so a reader can tell a half-written state from
+a complete one: snapshot() copies the state, retrying until no publish()
+overlapped the copy. Readers of the views themselves check sequence()
+before and after reading.
+
+A species with more animals than the capacity is truncated to the first
+capacity animals, and truncated() tells which species were.
+
+With animals held as objects, the published fitness is the cached one, and
+NaN where it is out of date, so that publishing does not compute it.
+
+In compact mode the per-animal columns are stored as float32 and int32,
+which halves the shared bytes per animal.
+
+multiprocessing.shared_memory is imported when a block is first created
+or attached, not with this module.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import time
+import warnings
+import numpy as np
+
+SPECIES = ('herbivores', 'carnivores')
+ANIMAL_COLUMNS = (('cell', 'int64'),
+                  ('weight', 'float64'),
+                  ('age', 'int64'),
+                  ('fitness', 'float64'))
+COMPACT_DTYPES = {'int64': 'int32', 'float64': 'float32'}
+
+# Positions in the header array
+_YEAR = 0
+_HERBIVORES = 1
+_CARNIVORES = 2
+_CAPACITY = 3
+_SEQUENCE = 4
+_TRUNCATED = 5
+
+
+def _layout(map_dims, capacity, compact=False):
+    """
+    Return list of (field, shape, dtype, offset) and the total size.
+
+    Parameters:
+    map_dims (terrain dimensions (<rows>, <columns>), required)
+    capacity (max number of animals per species, required)
+    compact (if True, use 32 bit per-animal columns, optional)
+    """
+
+    fields = [('header', (6,), 'int64'),
+              ('codes', tuple(map_dims), 'uint8'),
+              ('food', tuple(map_dims), 'float64'),
+              ('herbivore_counts', tuple(map_dims), 'int64'),
+              ('carnivore_counts', tuple(map_dims), 'int64')]
+    for species in SPECIES:
+        for column, dtype in ANIMAL_COLUMNS:
+            if compact:
+                dtype = COMPACT_DTYPES[dtype]
+            fields.append(('{0}_{1}'.format(species, column),
+                           (capacity,), dtype))
+
+    layout = []
+    offset = 0
+    for field, shape, dtype in fields:
+        # Keep every array 8 byte aligned
+        offset += -offset % 8
+        layout.append((field, shape, dtype, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, max(offset, 1)
+
+
+def _open_block(name):
+    """
+    Attach to an existing shared memory block.
+
+    The block is not registered with the resource tracker where this is
+    supported, so that a reader process exiting does not remove it.
+    """
+
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedState(object):
+    """Terrain and animal state held in a shared memory block."""
+
+    def __init__(self, block, layout, owner):
+        """
+        Initialize a shared state object.
+
+        Use SharedState.create() or SharedState.attach() instead of calling
+        this directly.
+
+        Parameters:
+        block (SharedMemory object, required)
+        layout (list of (field, shape, dtype, offset), required)
+        owner (True if this object created the block, required)
+        """
+
+        self._block = block
+        self._layout = layout
+        self._owner = owner
+        self._arrays = dict((field, np.ndarray(shape, dtype=dtype,
+                                               buffer=block.buf,
+                                               offset=offset))
+                            for field, shape, dtype, offset in layout)
+
+    @classmethod
+    def create(cls, map_dims, capacity, compact=False):
+        """
+        Create a new shared memory block for the given terrain size.
+
+        Parameters:
+        map_dims (terrain dimensions (<rows>, <columns>), required)
+        capacity (max number of animals per species, required)
+        compact (if True, store per-animal columns as float32 and int32,
+                 optional)
+        """
+
+        from multiprocessing import shared_memory
+        if capacity < 0 or int(capacity) != capacity:
+            raise ValueError('Capacity must be non-negative int')
+        layout, size = _layout(map_dims, int(capacity), compact)
+        state = cls(shared_memory.SharedMemory(create=True, size=size),
+                    layout, True)
+        state._arrays['header'][:] = 0
+        state._arrays['header'][_CAPACITY] = capacity
+        return state
+
+    @classmethod
+    def attach(cls, descriptor):
+        """
+        Attach to shared state created elsewhere, without copying.
+
+        Parameters:
+        descriptor (dict returned by descriptor(), required)
+        """
+
+        return cls(_open_block(descriptor['name']),
+                   [tuple(field) for field in descriptor['layout']], False)
+
+    def descriptor(self):
+        """
+        Return a small picklable dict describing the shared block.
+
+        Pass it to SharedState.attach() in another process.
+        """
+
+        return {'name': self._block.name, 'layout': list(self._layout)}
+
+    def capacity(self):
+        """Return the max number of animals per species."""
+
+        return int(self._arrays['header'][_CAPACITY])
+
+    def bytes_per_animal(self):
+        """Return the number of shared bytes used per animal."""
+
+        return sum(self._arrays['herbivores_' + column].itemsize
+                   for column, dtype in ANIMAL_COLUMNS)
+
+    def year(self):
+        """Return the year of the last published state."""
+
+        return int(self._arrays['header'][_YEAR])
+
+    def sequence(self):
+        """
+        Return the sequence number of the state, odd while it is written.
+
+        A reader saw a complete state if the number was even before it read
+        and unchanged after.
+        """
+
+        return int(self._arrays['header'][_SEQUENCE])
+
+    def truncated(self):
+        """
+        Return list of the species that had more animals than the capacity
+        in the last published state.
+        """
+
+        flags = int(self._arrays['header'][_TRUNCATED])
+        return [species for k, species in enumerate(SPECIES)
+                if flags & (1 << k)]
+
+    def array(self, field):
+        """
+        Return view of a shared array.
+
+        Parameters:
+        field (one of 'codes', 'food', 'herbivore_counts' and
+               'carnivore_counts', required)
+        """
+
+        if field == 'header' or field not in self._arrays:
+            raise KeyError('No array called {}'.format(field))
+        return self._arrays[field]
+
+    def animals(self, species):
+        """
+        Return dict with views of the per-animal columns of a species.
+
+        The columns are 'cell' (flat map index), 'weight', 'age' and
+        'fitness', and hold one entry per living animal.
+
+        Parameters:
+        species ('herbivores' or 'carnivores', required)
+        """
+
+        if species not in SPECIES:
+            raise ValueError('No species called {}'.format(species))
+        count = self._arrays['header'][_HERBIVORES + SPECIES.index(species)]
+        return dict((column, self._arrays['{0}_{1}'.format(species,
+                                                           column)][:count])
+                    for column, dtype in ANIMAL_COLUMNS)
+
+    def snapshot(self, tries=10000):
+        """
+        Return dict with copies of the arrays, the animal columns of each
+        species and the 'year' of a complete published state.
+
+        Parameters:
+        tries (number of reads before giving up, optional)
+        """
+
+        for attempt in range(tries):
+            before = self.sequence()
+            if before % 2 == 0:
+                state = dict((field, np.array(self._arrays[field]))
+                             for field in ('codes', 'food',
+                                           'herbivore_counts',
+                                           'carnivore_counts'))
+                state['year'] = self.year()
+                for species in SPECIES:
+                    columns = self.animals(species)
+                    state[species] = dict((column, np.array(columns[column]))
+                                          for column in columns)
+                if self.sequence() == before:
+                    return state
+            time.sleep(0)
+        raise RuntimeError('Shared state kept changing while read')
+
+    def publish(self, terrain, year):
+        """
+        Copy the current state of a terrain into the shared block.
+
+        Parameters:
+        terrain (terrain object, required)
+        year (the current year, required)
+        """
+
+        header = self._arrays['header']
+        # Odd while writing
+        header[_SEQUENCE] += 1
+        try:
+            self._write(terrain, year)
+        finally:
+            header[_SEQUENCE] += 1
+
+    def _write(self, terrain, year):
+        """Write the state of a terrain, see publish()."""
+
+        header = self._arrays['header']
+        self._arrays['codes'][:] = (np.asarray(terrain.map_codes())
+                                    .astype('S1').view(np.uint8))
+
+        truncated = 0
+        for species_index, species in enumerate(SPECIES):
+            animals = terrain.animal_columns(species, cached_fitness=True)
+            count = len(animals['cell'])
+            if count > self.capacity():
+                warnings.warn('{0} {1} truncated to the shared capacity {2}'
+                              .format(count, species, self.capacity()))
+                count = self.capacity()
+                truncated |= 1 << species_index
+            for column, dtype in ANIMAL_COLUMNS:
+                self._arrays['{0}_{1}'.format(species, column)][:count] = (
+                        animals[column][:count])
+            header[_HERBIVORES + species_index] = count
+        header[_TRUNCATED] = truncated
+
+        self._arrays['food'][:] = terrain.food()
+        (self._arrays['herbivore_counts'][:],
+         self._arrays['carnivore_counts'][:]) = terrain.count_matrices()
+        header[_YEAR] = year
+
+    def close(self):
+        """Release this process' views of the shared block."""
+
+        self._arrays = {}
+        self._block.close()
+
+    def unlink(self):
+        """Close and remove the shared block. Only the creator may do this."""
+
+        if not self._owner:
+            raise RuntimeError('Only the creator can unlink shared state')
+        self.close()
+        self._block.unlink()
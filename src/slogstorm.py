@@ -5,6 +5,9 @@ This module provides the main simulation classes.
 InputHandler() provides the main user interface. It can be used to start a 
 simulation, generate a terrain, deploy animals, modify parameters etc. 
 
+matplotlib is imported the first time something is drawn, so that headless
+simulations (see InputHandler(headless=True)) start without it.
+
 See the docstrings from the different classes and methods for more detailed
 documentation. 
 '''
@@ -12,14 +15,55 @@ documentation.
 __author__ = "Aleksander Hykkerud and Daniel Hjertholm"
 
 import os
+import shutil
+import tempfile
+import weakref
 import numpy as np
-import matplotlib.pyplot as plt
+import slump as sl
 import regiontypes as lnd
 import animaltypes as ani
+import cohort as coh
+import sharedstate as shs
+import renderer as rnd
+import memprofile as mem
+import cpuprofile as cpu
+import earlystop as stp
+import columnar as col
+import checkpoint as chk
+import eventlog as elg
+import backends as bk
+import species as spc
+import pyramid as pyr
+import recording as rec
+import snapshot as snp
+import telemetry as tel
+
+# matplotlib.pyplot, imported by _pyplot() when first needed
+plt = None
 
 
 class Terrain(object):
-    """Represents the entire terrain."""
+    """
+    Represents the entire terrain.
+    
+    When counter based random streams are in use (see slump.seed_streams()),
+    every cell draws its numbers from the stream of (year, cell, phase), 
+    where cell is the flat index row*columns+column and phase is one of the
+    PHASE_* constants below.
+    
+    The food of all cells is held in one array, and the regions keep their
+    food in views onto it. Regrowth is done with one array expression per
+    region type. fmax and alpha can be set per cell with 
+    set_food_parameters().
+    
+    By default the animals are objects held by the regions. After 
+    use_columnar_storage(), they are instead held in columns, optionally 
+    memory mapped, and the phases are done by columnar.ColumnarAnimals.
+    """
+    
+    PHASE_GROWTH = 0
+    PHASE_MIGRATION = 1
+    PHASE_DECAY = 2
 
     def __init__(self, STRMAP=None, mapfile=None):
         """
@@ -80,11 +124,150 @@ class Terrain(object):
 
         self._map_dims = map_dims
         
+        # Food of every cell, and per cell fmax and alpha. NaN in 
+        # self._fmax / self._alpha means that the parameter of the region 
+        # type is used.
+        self._food = np.zeros(map_dims)
+        self._fmax = np.nan * np.ones(map_dims)
+        self._alpha = np.nan * np.ones(map_dims)
+        
+        # Flat indices of the cells of each region type that regrows
+        self._regrowing = {}
+        flat_food = self._food.reshape(-1)
+        for k, celle in enumerate(self._mapmat.flat):
+            celle.attach_food(flat_food[k:k + 1])
+            if celle.regrowth is not None:
+                self._regrowing.setdefault(celle.__class__, []).append(k)
+        for region_type in self._regrowing:
+            self._regrowing[region_type] = np.array(
+                    self._regrowing[region_type])
+        
+        # Cells animals may enter, and the flat index of the four 
+        # neighbours of every cell
+        self._livable = np.array([celle._livable 
+                                  for celle in self._mapmat.flat])
+        self._neighbours = col.neighbour_table(*map_dims)
+        
+        # ColumnarAnimals holding the animals, if columnar storage is used
+        self._animals = None
+        
+        # EventLog the events are written to, if any
+        self._events = None
+        
+    def use_columnar_storage(self, directory=None, chunk_size=1000000):
+        """
+        Hold the animals in columns instead of region objects.
+        
+        Must be called before animals are deployed.
+        
+        Parameters:
+        directory (directory for memory mapped column files, optional. If 
+                   omitted, the columns are held in memory.)
+        chunk_size (approximate max number of animals held in memory at a 
+                    time, optional)
+        """
+        
+        if sum(self.animal_counts()) > 0:
+            raise RuntimeError('Animals already deployed')
+        self._animals = col.ColumnarAnimals(self, directory, chunk_size)
+        
+    def set_event_log(self, events):
+        """
+        Log births, deaths, kills, migrations, feedings and deployments.
+        
+        Only animals held as objects can be logged.
+        
+        Parameters:
+        events (eventlog.EventLog object, or None to stop logging, required)
+        """
+        
+        if events is not None and self._animals is not None:
+            raise RuntimeError('Events cannot be logged with columnar storage')
+        self._events = events
+        for celle in self._mapmat.flat:
+            celle.attach_events(events)
+    
+    def columnar_animals(self):
+        """Return the ColumnarAnimals object, or None."""
+        
+        return self._animals
+    
+    def deploy(self, index, animal):
+        """
+        Deploy animal in the cell at index.
+        
+        Will raise an error if animal was not accepted.
+        
+        Parameters:
+        index (index (<row>, <column>) of the cell, required)
+        animal (animal object, required)
+        """
+        
+        if self._animals is None:
+            self._mapmat[tuple(index)].deploy(animal)
+            if self._events is not None:
+                self._events.deploy(animal, 
+                                    index[0] * self._map_dims[1] + index[1])
+        else:
+            self._animals.deploy(index, animal)
+        
+    def load_animals(self, columns):
+        """
+        Replace all animals by the animals in columns.
+        
+        Parameters:
+        columns (dict {<species>: dict with cell (flat map index), weight, 
+                 age and fitness arrays}, as returned by animal_columns(), 
+                 required)
+        """
+        
+        if self._animals is not None:
+            self._animals.load(columns)
+            return
+        for species in spc.table():
+            for celle in self._mapmat.flat:
+                del celle.animals(species.index)[:]
+            if species.name not in columns:
+                continue
+            rows = columns[species.name]
+            for cell, weight, age, fitness in zip(rows['cell'], 
+                                                  rows['weight'], 
+                                                  rows['age'], 
+                                                  rows['fitness']):
+                celle = self._mapmat.flat[int(cell)]
+                celle.animals(species.index).append(
+                        species.animal_class.from_state(
+                                float(weight), int(age), float(fitness)))
+        
     def terrain_map(self):
         """Return terrain map."""
         
         return self._mapmat
     
+    def map_codes(self):
+        """
+        Return matrix of map letters.
+        
+        Each element is one of the letters O, M, D, J and S, as given in 
+        the map string.
+        """
+        
+        return self._strmap
+    
+    def map_rgb(self):
+        """
+        Return array of shape (rows, columns, 3) with the color of every 
+        region.
+        
+        The colors are looked up from the map letters, with one region of 
+        each letter giving the color.
+        """
+        
+        (letters, first, inverse) = np.unique(self._strmap, return_index=True,
+                                              return_inverse=True)
+        palette = np.array([self._mapmat.flat[k].color() for k in first])
+        return palette[inverse.reshape(-1)].reshape(self._map_dims + (3,))
+    
     def terrain_dimensions(self):
         """
         Return terrain dimensions.
@@ -94,34 +277,261 @@ class Terrain(object):
 
         return self._map_dims
     
-    def growth(self):
-        """Perform regrowth, nutrition and breeding cycles."""
+    def livable(self):
+        """Return flat bool array, True for cells animals may enter."""
         
-        for row in self.terrain_map():
-            for celle in row:
-                celle.regrowth_cycle()
-                celle.nutrition_cycle()
-                celle.breeding_cycle()
+        return self._livable
+    
+    def neighbours(self):
+        """
+        Return array of shape (cells, 4) with the flat index of the four 
+        neighbours of every cell. See columnar.neighbour_table().
+        """
+        
+        return self._neighbours
+    
+    def food(self):
+        """Return matrix with the amount of food in each cell."""
+        
+        return self._food
+    
+    def set_food_parameters(self, index, fmax=None, alpha=None):
+        """
+        Set fmax and/or alpha of a single cell.
+        
+        Parameters:
+        index (index (<row>, <column>) of the cell, required)
+        fmax (max amount of food in the cell, optional)
+        alpha (regrowth rate of the cell, optional)
+        """
+        
+        index = tuple(index)
+        if self._mapmat[index].regrowth is None:
+            raise ValueError('No food grows in {}'.format(self._mapmat[index]))
+        if fmax is not None:
+            if fmax < 0:
+                raise ValueError('fmax must be non-negative')
+            self._fmax[index] = fmax
+        if alpha is not None:
+            if not 0 <= alpha <= 1:
+                raise ValueError('alpha must be between 0 and 1')
+            self._alpha[index] = alpha
+            
+    def _cell_parameter(self, values, region_type, name, cells):
+        """
+        Return per cell parameter values for cells of a region type.
+        
+        Parameters:
+        values (per cell parameter matrix, NaN where unset, required)
+        region_type (region class, required)
+        name (name of parameter in region_type.params, required)
+        cells (flat indices of the cells, required)
+        """
+        
+        default = region_type.params.get(name, np.nan)
+        values = values.reshape(-1)[cells]
+        return np.where(np.isnan(values), default, values)
+    
+    def regrowth(self):
+        """Do one cycle (one year) of regrowth in all cells."""
+        
+        food = self._food.reshape(-1)
+        for region_type, cells in self._regrowing.items():
+            food[cells] = region_type.regrowth(
+                    food[cells],
+                    self._cell_parameter(self._fmax, region_type, 'fmax', 
+                                         cells),
+                    self._cell_parameter(self._alpha, region_type, 'alpha', 
+                                         cells))
+    
+    def _select_stream(self, year, index, phase):
+        """
+        Select the random stream for a cell, if streams are in use.
+        
+        Parameters:
+        year (the current year, or None if unknown, required)
+        index (index (<row>, <column>) of the cell, required)
+        phase (one of the PHASE_* constants, required)
+        """
+        
+        if year is not None:
+            sl.select_stream(year, 
+                             index[0] * self._map_dims[1] + index[1], 
+                             phase)
+    
+    def _log_cell(self, index):
+        """Set the cell of the following logged events, if logging."""
+        
+        if self._events is not None:
+            self._events.at(index[0] * self._map_dims[1] + index[1])
+    
+    def growth(self, year=None):
+        """
+        Perform regrowth, nutrition and breeding cycles.
+        
+        Parameters:
+        year (the current year, optional. Needed for counter based 
+              random streams.)
+        """
+        
+        self.regrowth()
+        if self._animals is not None:
+            self._animals.growth(year)
+            return
+        if self._events is not None:
+            self._events.growth(year)
+        for index, celle in np.ndenumerate(self.terrain_map()):
+            self._select_stream(year, index, self.PHASE_GROWTH)
+            self._log_cell(index)
+            celle.nutrition_cycle()
+            celle.breeding_cycle()
         
     def migration(self, year):
-        """Perform migration cycle."""
+        """
+        Perform migration cycle.
         
-        for row in self.terrain_map():
-            for celle in row:
-                celle.migration_cycle(self, year)
+        All movers of a species and their directions are drawn at once, 
+        and the animals are then regrouped by their new cells. With 
+        counter based streams, they are drawn for one cell slice at a time 
+        instead, from the stream of the cell, for all species in table 
+        order.
+        
+        Parameters:
+        year (the current year, optional. Needed for counter based 
+              random streams.)
+        """
+        
+        if self._animals is not None:
+            self._animals.migration(year)
+            return
+        table = [(species, ) + self.species_animals(species) 
+                 for species in spc.names()]
+        targets = [None] * len(table)
+        fitness = [np.fromiter((animal.fitness() for animal in animals), 
+                               dtype=float, count=len(animals))
+                   for species, animals, cells in table]
+        if year is None or not sl.streams_enabled():
+            for i, (species, animals, cells) in enumerate(table):
+                targets[i] = col.destinations(cells, fitness[i], 
+                                              spc.row(species).params(),
+                                              self._livable, 
+                                              self._neighbours)
+        else:
+            n_cells = self._map_dims[0] * self._map_dims[1]
+            offsets = [np.searchsorted(cells, np.arange(n_cells + 1)) 
+                       for species, animals, cells in table]
+            for i, (species, animals, cells) in enumerate(table):
+                targets[i] = cells.copy()
+            occupied = np.flatnonzero(sum(np.diff(cell_offsets) 
+                                          for cell_offsets in offsets))
+            for cell in occupied:
+                self._select_stream(year, divmod(cell, self._map_dims[1]), 
+                                    self.PHASE_MIGRATION)
+                for i, (species, animals, cells) in enumerate(table):
+                    (start, stop) = offsets[i][cell:cell + 2]
+                    if stop > start:
+                        targets[i][start:stop] = col.destinations(
+                                cells[start:stop], fitness[i][start:stop], 
+                                spc.row(species).params(), self._livable, 
+                                self._neighbours)
+        for i, (species, animals, cells) in enumerate(table):
+            for k in np.flatnonzero(targets[i] != cells):
+                animals[k]._last_moved = year
+                if self._events is not None:
+                    self._events.at(cells[k])
+                    self._events.move(animals[k], 
+                                      divmod(targets[i][k], 
+                                             self._map_dims[1]))
+            self._regroup(species, animals, cells, targets[i])
+            
+    def species_animals(self, species):
+        """
+        Return object array with all animals of a species, in the order 
+        given by animal_columns(), and array with the cell (flat map index) 
+        of each.
+        
+        Parameters:
+        species (name of the species, e.g. 'herbivores', required)
+        """
+        
+        index = spc.row(species).index
+        lists = [celle.animals(index) for celle in self._mapmat.flat]
+        counts = np.array([len(animals) for animals in lists])
+        animals = np.empty(counts.sum(), dtype=object)
+        animals[:] = [animal for cell_animals in lists 
+                      for animal in cell_animals]
+        return (animals, np.repeat(np.arange(len(lists)), counts))
+            
+    def relocate(self, species, destinations):
+        """
+        Move the animals of a species to new cells.
+        
+        Parameters:
+        species (name of the species, required)
+        destinations (flat map index of the new cell of every animal, in 
+                      the order given by species_animals(), required)
+        """
+        
+        (animals, cells) = self.species_animals(species)
+        self._regroup(species, animals, cells, destinations)
+        
+    def _regroup(self, species, animals, cells, destinations):
+        """
+        Regroup the animals of a species by their new cells.
+        
+        The cell slices are found from bincount offsets, and filled by a 
+        stable sort, so that the animals keep their relative order. Only 
+        the lists of cells animals left or entered are rebuilt.
+        
+        Parameters:
+        species (name of the species, required)
+        animals (object array from species_animals(), required)
+        cells (current cell of every animal, required)
+        destinations (new cell of every animal, required)
+        """
+        
+        destinations = np.asarray(destinations, dtype=np.int64)
+        if not np.any(destinations != cells):
+            return
+        n_cells = len(self._livable)
+        offsets = np.concatenate(
+                ([0], np.cumsum(np.bincount(destinations, 
+                                            minlength=n_cells))))
+        order = np.argsort(destinations, kind='stable')
+        moved = destinations != cells
+        changed = np.union1d(cells[moved], destinations[moved])
+        regions = self._mapmat.reshape(-1)
+        index = spc.row(species).index
+        for k in changed:
+            regions[k].animals(index)[:] = list(
+                    animals[order[offsets[k]:offsets[k + 1]]])
 
-    def decay(self):
-        """Perform aging, weightloss and death cycles."""
+    def decay(self, year=None):
+        """
+        Perform aging, weightloss and death cycles.
         
-        for row in self.terrain_map():
-            for celle in row:
-                celle.aging_cycle()
-                celle.weightloss_cycle()
-                celle.death_cycle()
+        Parameters:
+        year (the current year, optional. Needed for counter based 
+              random streams.)
+        """
+        
+        if self._animals is not None:
+            self._animals.decay(year)
+            return
+        if self._events is not None:
+            self._events.decay(year)
+        for index, celle in np.ndenumerate(self.terrain_map()):
+            self._select_stream(year, index, self.PHASE_DECAY)
+            self._log_cell(index)
+            celle.aging_cycle()
+            celle.weightloss_cycle()
+            celle.death_cycle()
     
     def animal_counts(self):
         "Count herbivores and carnivores this year."""
         
+        if self._animals is not None:
+            return self._animals.animal_counts()
         h_this_y = 0
         c_this_y = 0
         for row in self.terrain_map():
@@ -130,17 +540,175 @@ class Terrain(object):
                 c_this_y += len(celle.carnivores())
         
         return (h_this_y, c_this_y)
+    
+    def species_counts(self):
+        """
+        Return dict {<species name>: <number of animals>}, with every 
+        species in the table.
+        """
+        
+        if self._animals is not None:
+            return self._animals.species_counts()
+        return dict((species.name, 
+                     sum(len(celle.animals(species.index)) 
+                         for celle in self._mapmat.flat))
+                    for species in spc.table())
+    
+    def count_matrices(self):
+        """
+        Return matrices with the number of herbivores and carnivores in 
+        each cell.
+        
+        Format: (<herbivore matrix>, <carnivore matrix>)
+        """
+        
+        if self._animals is not None:
+            return self._animals.count_matrices()
+        herbmat = np.zeros(self._map_dims, dtype=int)
+        carnmat = np.zeros(self._map_dims, dtype=int)
+        for index, celle in np.ndenumerate(self.terrain_map()):
+            herbmat[index] = len(celle.herbivores())
+            carnmat[index] = len(celle.carnivores())
+        return (herbmat, carnmat)
+    
+    def animal_columns(self, species, cached_fitness=False):
+        """
+        Return dict with arrays holding the cell (flat map index), weight, 
+        age and fitness of every animal of a species.
+        
+        Parameters:
+        species (name of the species, e.g. 'herbivores', required)
+        cached_fitness (if True, animals held as objects give their cached 
+                        fitness, and NaN where it is out of date, instead of
+                        computing it, optional)
+        """
         
+        if self._animals is not None:
+            return self._animals.animal_columns(species)
+        index = spc.row(species).index
+        if cached_fitness:
+            rows = [(k, animal.weight(), animal.age(), 
+                     animal.cached_fitness(np.nan))
+                    for k, celle in enumerate(self._mapmat.flat)
+                    for animal in celle.animals(index)]
+        else:
+            rows = [(k, animal.weight(), animal.age(), animal.fitness())
+                    for k, celle in enumerate(self._mapmat.flat)
+                    for animal in celle.animals(index)]
+        return dict((column, np.array([row[i] for row in rows], 
+                                      dtype=dtype))
+                    for i, (column, dtype) in enumerate(col.COLUMNS))
+    
+    def bytes_per_animal(self, sample_size=1000):
+        """
+        Return the estimated number of bytes used per animal.
+        
+        Parameters:
+        sample_size (max number of animal objects measured, optional)
+        """
+        
+        if self._animals is not None:
+            return self._animals.bytes_per_animal()
+        sample = []
+        for celle in self._mapmat.flat:
+            for species in spc.table():
+                sample.extend(celle.animals(species.index))
+            if len(sample) >= sample_size:
+                break
+        sample = sample[:sample_size]
+        if not sample:
+            return 0
+        return (sum(mem.animal_bytes(animal) for animal in sample) / 
+                float(len(sample)))
+        
+
+def _count_matrix(terrain_matrix, species):
+    """
+    Return matrix with the number of animals of a species in each cell.
+    
+    Parameters:
+    terrain_matrix (matrix containing terrain regions, or a matrix that 
+                    already holds animal counts, required)
+    species ('herbivores' or 'carnivores', required)
+    """
+    
+    terrain_matrix = np.asarray(terrain_matrix)
+    if terrain_matrix.dtype != object:
+        return terrain_matrix
+    index = spc.row(species).index
+    return np.fromiter((len(celle.animals(index)) 
+                        for celle in terrain_matrix.flat), 
+                       dtype=int, count=terrain_matrix.size
+                       ).reshape(terrain_matrix.shape)
+
+
+# Maps with more rows or columns than this get automatic tick positions 
+# instead of one tick per cell
+_MAX_TICKS = 30
+
+
+# Classes whose parameters an InputHandler sets for the whole process
+_PARAMETER_CLASSES = (ani.Herbivore, ani.Carnivore, lnd.Jungle, lnd.Savannah)
+
+
+def process_state():
+    """
+    Return the state an InputHandler changes for the whole process, for 
+    set_process_state(): the random generator state, the parameters of 
+    the animal and region classes, and the backend in use.
+    """
+    
+    return (sl.get_state(),
+            [cls.__dict__.get('params') for cls in _PARAMETER_CLASSES],
+            bk.active())
+
+
+def set_process_state(state):
+    """
+    Restore state returned by process_state(), e.g. after running a 
+    simulation in-process.
+    
+    Parameters:
+    state (state returned by process_state(), required)
+    """
+    
+    (random_state, parameters, backend) = state
+    sl.set_state(random_state)
+    for cls, params in zip(_PARAMETER_CLASSES, parameters):
+        if params is not None:
+            cls.update_params(params)
+        elif 'params' in cls.__dict__:
+            del cls.params
+    if backend is not None and backend != bk.active():
+        bk.select(backend)
+
+
+def _pyplot():
+    """Import matplotlib.pyplot on first use, and return it."""
+    
+    global plt
+    if plt is None:
+        import matplotlib.pyplot
+        plt = matplotlib.pyplot
+    return plt
+
 
 class Graphics(object):
-    """Handles the graphics display."""
+    """
+    Handles the graphics display.
+    
+    The figure is created the first time something is drawn.
+    
+    The terrain colors and the animal counts are kept in pyramids (see 
+    pyramid), and each map is drawn at the finest level that has no more 
+    blocks than its subplot has pixels. The count maps show the mean count
+    per cell of each block, so that the color scale does not depend on the
+    level.
+    """
 
     def __init__(self):
         """Initialize a graphics object."""
         
-        plt.ion()
-        # plt.show()
-        
         # Constants used to determine coloring of density maps:
         self._min_colormap_h = 0
         self._max_colormap_h = 60
@@ -167,12 +735,12 @@ class Graphics(object):
         self._ffmpeg_binary = "/opt/local/bin/ffmpeg"
         # self._ffmpeg_binary = r"i:\\tools\ffmpeg-git-win64-static\bin\ffmpeg"
         
-        # Figures and subplots
-        self._fig = plt.figure(figsize=(14, 9))
-        self._graph_subplot = self._fig.add_subplot(2, 2, 1)
-        self._terrain_subplot = self._fig.add_subplot(2, 2, 2)
-        self._herbivore_subplot = self._fig.add_subplot(2, 2, 3)
-        self._carnivore_subplot = self._fig.add_subplot(2, 2, 4)
+        # Figures and subplots, created by _figure_setup()
+        self._fig = None
+        self._graph_subplot = None
+        self._terrain_subplot = None
+        self._herbivore_subplot = None
+        self._carnivore_subplot = None
         
         # Place holder names for plotting
         self._terrain_img_ax = None
@@ -183,6 +751,22 @@ class Graphics(object):
         self._h_colorbar = None
         self._c_colorbar = None
         
+        # Pyramids of the terrain colors and the animal counts
+        self._terrain_pyramid = None
+        self._h_pyramid = None
+        self._c_pyramid = None
+        
+    def _figure_setup(self):
+        """Import matplotlib and create the figure, unless already done."""
+        
+        if self._fig is None:
+            _pyplot().ion()
+            self._fig = plt.figure(figsize=(14, 9))
+            self._graph_subplot = self._fig.add_subplot(2, 2, 1)
+            self._terrain_subplot = self._fig.add_subplot(2, 2, 2)
+            self._herbivore_subplot = self._fig.add_subplot(2, 2, 3)
+            self._carnivore_subplot = self._fig.add_subplot(2, 2, 4)
+        
     def update_interval(self, interval=None):
         """
         Set / get update interval for the graphics.
@@ -203,6 +787,36 @@ class Graphics(object):
             
         return self._update_interval
         
+    def settings(self):
+        """
+        Return dict with the display settings.
+        
+        The dict can be given to apply_settings() of another Graphics 
+        object, e.g. in a rendering process.
+        """
+        
+        return {'update_interval': self._update_interval,
+                'ylim': self._ylim,
+                'min_colormap_h': self._min_colormap_h,
+                'max_colormap_h': self._max_colormap_h,
+                'min_colormap_c': self._min_colormap_c,
+                'max_colormap_c': self._max_colormap_c,
+                'img_base': self._img_base,
+                'img_format': self._img_format}
+    
+    def apply_settings(self, settings):
+        """
+        Apply display settings returned by settings().
+        
+        Parameters:
+        settings (dict containing settings, required)
+        """
+        
+        for k in settings:
+            if not hasattr(self, '_' + k):
+                raise KeyError('No setting called {}'.format(k))
+            setattr(self, '_' + k, settings[k])
+        
     def set_ylim(self, ylim):
         """
         Set _graph_subplot y-axis upper limit.
@@ -214,9 +828,10 @@ class Graphics(object):
         if ylim < 0:
             raise ValueError('Y-axis upper limit must be non-negative')
         self._ylim = ylim
-        plt.subplot(self._graph_subplot)
-        plt.ylim(0, self._ylim)
-        self.update_graphics()
+        if self._fig is not None:
+            plt.sca(self._graph_subplot)
+            plt.ylim(0, self._ylim)
+            self.update_graphics()
                
     def draw_terrain(self, terrain):
         """
@@ -226,18 +841,89 @@ class Graphics(object):
         terrain (terrain object, required)
         """
         if self._terrain_img_ax == None:
-            # Draw terrain
-            plt.subplot(self._terrain_subplot)
-            map_rgb = [[cell.color() for cell in row] 
-                       for row in terrain.terrain_map()]
-            self._terrain_img_ax = self._terrain_subplot.imshow(map_rgb, 
-                                                interpolation='nearest')
+            self.draw_map(terrain.map_rgb())
             
-            # Make ticks start from 1 instead of 0
-            plt.xticks(np.arange(0, terrain.terrain_dimensions()[1]), 
-                       np.arange(1, terrain.terrain_dimensions()[1] + 1))
-            plt.yticks(np.arange(0, terrain.terrain_dimensions()[0]), 
-                       np.arange(1, terrain.terrain_dimensions()[0] + 1)) 
+    def draw_map(self, map_rgb):
+        """
+        Draw a map of the terrain from region colors.
+        
+        Parameters:
+        map_rgb (array of shape (rows, columns, 3), or nested list of 
+                 (r, g, b) tuples, one per cell, required)
+        """
+        if self._terrain_img_ax == None:
+            # Draw terrain
+            self._figure_setup()
+            plt.sca(self._terrain_subplot)
+            self._terrain_pyramid = pyr.Pyramid(map_rgb)
+            self._terrain_img_ax = self._show(self._terrain_subplot, 
+                                              self._terrain_pyramid)
+            self._set_ticks(self._terrain_subplot, 
+                            self._terrain_pyramid.shape(0))
+    
+    def _level(self, subplot, pyramid):
+        """
+        Return the finest level of pyramid that fits the pixels of subplot.
+        """
+        
+        bbox = subplot.get_window_extent()
+        return pyramid.fitting(max(int(bbox.height), 1), 
+                               max(int(bbox.width), 1))
+    
+    def _show(self, subplot, pyramid, **kwargs):
+        """
+        Draw the fitting level of pyramid in subplot, in cell coordinates.
+        
+        Return value: the image.
+        
+        Parameters:
+        subplot (subplot to draw in, required)
+        pyramid (pyramid.Pyramid, required)
+        kwargs (passed on to imshow(), optional)
+        """
+        
+        (rows, columns) = pyramid.shape(0)
+        return subplot.imshow(pyramid.mean(self._level(subplot, pyramid)),
+                              interpolation='nearest', 
+                              extent=(-0.5, columns - 0.5, rows - 0.5, -0.5),
+                              **kwargs)
+    
+    def _redraw(self, image, subplot, pyramid, counts):
+        """
+        Update pyramid with counts, and image with its fitting level.
+        
+        Parameters:
+        image (image returned by _show(), required)
+        subplot (subplot of the image, required)
+        pyramid (pyramid.Pyramid, required)
+        counts (matrix of animal counts, required)
+        """
+        
+        pyramid.update(counts)
+        image.set_data(pyramid.mean(self._level(subplot, pyramid)))
+    
+    def _set_ticks(self, subplot, map_dims):
+        """
+        Label the axes of a map with cell numbers, starting from 1.
+        
+        Parameters:
+        subplot (subplot of the map, required)
+        map_dims (tuple (<rows>, <columns>), required)
+        """
+        
+        if max(map_dims) <= _MAX_TICKS:
+            plt.sca(subplot)
+            plt.xticks(np.arange(0, map_dims[1]), 
+                       np.arange(1, map_dims[1] + 1))
+            plt.yticks(np.arange(0, map_dims[0]), 
+                       np.arange(1, map_dims[0] + 1))
+            return
+        import matplotlib.ticker
+        for axis in (subplot.xaxis, subplot.yaxis):
+            axis.set_major_locator(matplotlib.ticker.MaxNLocator(
+                    integer=True))
+            axis.set_major_formatter(matplotlib.ticker.FuncFormatter(
+                    lambda value, position: '{:d}'.format(int(value) + 1)))
 
     def graph_setup(self, current_year, xlim):
         """
@@ -248,7 +934,8 @@ class Graphics(object):
         xlim (upper x-limit for _graph_subplot)
         """
         
-        plt.subplot(self._graph_subplot)
+        self._figure_setup()
+        plt.sca(self._graph_subplot)
         
         # Set axis limits
         plt.xlim(0, xlim)
@@ -280,88 +967,76 @@ class Graphics(object):
         Set up and draw herbivore intensity map.
         
         Parameters:
-        tarrain_matrix (matrix containing terrain regions, required)
+        tarrain_matrix (matrix containing terrain regions, or matrix of
+                        animal counts, required)
         vmin (lower colorbar value, optional)
         vmax (upper colorbar value, optional)
         """
         
-        plt.subplot(self._herbivore_subplot)
+        self._figure_setup()
+        plt.sca(self._herbivore_subplot)
         
         if vmin != None: 
             self._min_colormap_h = vmin
         if vmax != None: 
             self._max_colormap_h = vmax
-        if vmin >= vmax and vmin is not None and vmax is not None:
+        if vmin is not None and vmax is not None and vmin >= vmax:
             raise ValueError('vmax cannot be less or equal to vmin')
-        # Create matrix of animal counts
-        herbilen = []
-        for row in terrain_matrix:
-            row_counter = []
-            for celle in row:
-                row_counter.append(len(celle.herbivores()))
-            herbilen.append(row_counter)
+        # Create pyramid of animal counts
+        self._h_pyramid = pyr.Pyramid(_count_matrix(terrain_matrix, 
+                                                    'herbivores'))
         
         # Draw map
-        self._h_img_ax = self._herbivore_subplot.imshow(herbilen, 
-                                               interpolation='nearest',
-                                               vmin=self._min_colormap_h, 
-                                               vmax=self._max_colormap_h)
+        self._h_img_ax = self._show(self._herbivore_subplot, self._h_pyramid,
+                                    vmin=self._min_colormap_h, 
+                                    vmax=self._max_colormap_h)
         
         # Make ticks start from 1 instead of 0
-        plt.xticks(np.arange(0, np.shape(terrain_matrix)[1]), 
-                   np.arange(1, np.shape(terrain_matrix)[1]+1))
-        plt.yticks(np.arange(0, np.shape(terrain_matrix)[0]), 
-                   np.arange(1, np.shape(terrain_matrix)[0]+1))
+        self._set_ticks(self._herbivore_subplot, self._h_pyramid.shape(0))
         
         # Draw colorbar
         if self._h_colorbar == None:
             self._h_colorbar = plt.colorbar(self._h_img_ax)
         else:
-            self._h_colorbar.update_bruteforce(self._h_img_ax)
+            self._h_colorbar.update_normal(self._h_img_ax)
         
     def cmap_setup(self, terrain_matrix, vmin=None, vmax=None):
         """
         Set up and draw carnivore intensity map.
         
         Parameters:
-        tarrain_matrix (matrix containing terrain regions, required)
+        tarrain_matrix (matrix containing terrain regions, or matrix of
+                        animal counts, required)
         vmin (lower colorbar value, optional)
         vmax (upper colorbar value, optional)
         """
         
-        plt.subplot(self._carnivore_subplot)
+        self._figure_setup()
+        plt.sca(self._carnivore_subplot)
 
         if vmin != None: 
             self._min_colormap_c = vmin
         if vmax != None: 
             self._max_colormap_c = vmax
-        if vmin >= vmax and vmin is not None and vmax is not None:
+        if vmin is not None and vmax is not None and vmin >= vmax:
             raise ValueError('vmax cannot be less or equal to vmin')
-        # Create matrix of animal counts
-        carnilen = []
-        for row in terrain_matrix:
-            row_counter = []
-            for celle in row:
-                row_counter.append(len(celle.carnivores()))
-            carnilen.append(row_counter)
+        # Create pyramid of animal counts
+        self._c_pyramid = pyr.Pyramid(_count_matrix(terrain_matrix, 
+                                                    'carnivores'))
             
         # Draw map
-        self._c_img_ax = self._carnivore_subplot.imshow(carnilen, 
-                                               interpolation='nearest', 
-                                               vmin=self._min_colormap_c, 
-                                               vmax=self._max_colormap_c)
+        self._c_img_ax = self._show(self._carnivore_subplot, self._c_pyramid,
+                                    vmin=self._min_colormap_c, 
+                                    vmax=self._max_colormap_c)
         
         # Make ticks start from 1 instead of 0
-        plt.xticks(np.arange(0, np.shape(terrain_matrix)[1]), 
-                   np.arange(1, np.shape(terrain_matrix)[1]+1))
-        plt.yticks(np.arange(0, np.shape(terrain_matrix)[0]), 
-                   np.arange(1, np.shape(terrain_matrix)[0]+1))
+        self._set_ticks(self._carnivore_subplot, self._c_pyramid.shape(0))
         
         # Draw colorbar
         if self._c_colorbar == None:
             self._c_colorbar = plt.colorbar(self._c_img_ax)
         else:
-            self._c_colorbar.update_bruteforce(self._c_img_ax)
+            self._c_colorbar.update_normal(self._c_img_ax)
     
     def draw_graph(self, herbivore_count, carnivore_count, current_year, xlim):
         """
@@ -374,7 +1049,8 @@ class Graphics(object):
         xlim (x-axis upper limit, required)
         """
         
-        plt.subplot(self._graph_subplot)
+        self._figure_setup()
+        plt.sca(self._graph_subplot)
     
         # Animal counts are stored temporary in lists until it is 
         # time to update the _graph_subplot.
@@ -408,46 +1084,40 @@ class Graphics(object):
         Draw herbivore intensity map.
         
         Parameters:
-        terrain_matrix (matrix containing terrain regions, required)
+        terrain_matrix (matrix containing terrain regions, or matrix of
+                        animal counts, required)
         year (the current year, required)
         """
         
-        plt.subplot(self._herbivore_subplot)
+        self._figure_setup()
+        plt.sca(self._herbivore_subplot)
         
         if self._h_img_ax is None:
             self.hmap_setup(terrain_matrix)
         else:
-            herbilen = []
-            for row in terrain_matrix:
-                row_counter = []
-                for celle in row:
-                    row_counter.append(len(celle.herbivores()))
-                herbilen.append(row_counter)
-            
-            self._h_img_ax.set_data(herbilen)
+            self._redraw(self._h_img_ax, self._herbivore_subplot, 
+                         self._h_pyramid, 
+                         _count_matrix(terrain_matrix, 'herbivores'))
 
     def draw_carnivores(self, terrain_matrix, year):
         """
         Draw carnivore intensity map.
         
         Parameters:
-        terrain_matrix (matrix containing terrain regions, required)
+        terrain_matrix (matrix containing terrain regions, or matrix of
+                        animal counts, required)
         year (the current year, required)
         """
         
-        plt.subplot(self._carnivore_subplot)
+        self._figure_setup()
+        plt.sca(self._carnivore_subplot)
         
         if self._c_img_ax is None:
             self.cmap_setup(terrain_matrix)
         else:
-            carnilen = []
-            for row in terrain_matrix:
-                row_counter = []
-                for celle in row:
-                    row_counter.append(len(celle.carnivores()))
-                carnilen.append(row_counter)
-            
-            self._c_img_ax.set_data(carnilen)
+            self._redraw(self._c_img_ax, self._carnivore_subplot, 
+                         self._c_pyramid, 
+                         _count_matrix(terrain_matrix, 'carnivores'))
             
             # Show current year
             plt.xlabel("Year: {}".format(year))
@@ -455,6 +1125,7 @@ class Graphics(object):
     def update_graphics(self):
         """Update the graphics display."""
         
+        self._figure_setup()
         plt.draw()
 
     def save_image(self, file_name_base=None):
@@ -468,6 +1139,7 @@ class Graphics(object):
         
         if file_name_base is not None:
             self._img_base = file_name_base
+        self._figure_setup()
         plt.savefig('{0}_{1:05d}.{2}'.format(self._img_base, 
                                              self._img_counter, 
                                              self._img_format))
@@ -492,25 +1164,74 @@ class Graphics(object):
 class Simulator(object):
     """Handles the _simulation."""
 
-    def __init__(self, terrain, graphics):
+    def __init__(self, terrain, graphics, headless=False):
         """
         Initialize simulator object.
         
         Parameters:
         terrain (terrain object to use in simulation, required)
         graphics (graphics object to use in simulation, required)
+        headless (if True, nothing is drawn unless a render worker is 
+                  started, optional)
         """
         
         self._graphics = graphics
+        self._headless = headless
         self._terrain = terrain
-        self._h_this_y = 0
-        self._c_this_y = 0
+        # Animals of each species after the last simulated year
+        self._counts = dict.fromkeys(spc.names(), 0)
         self._year = 0
         
+        # Number of fitness recomputations avoided by the lazy fitness
+        # evaluation, one entry per simulated year.
+        self._avoided_fitness = []
+        
+        # SharedState object the terrain state is published to, if any.
+        self._shared_state = None
+        
+        # RenderWorker drawing in a separate process, if any.
+        self._renderer = None
+        
+        # Records peak memory per phase while started by profile_memory().
+        self._memory_profiler = mem.PhaseMemoryProfiler()
+        
+        # Samples the stack per phase while started by profile_cpu().
+        self._cpu_profiler = cpu.SamplingProfiler()
+        
+        # Criteria for ending a run early, see set_stop_criteria().
+        self._stop_criteria = []
+        
+        # Checkpointer writing a checkpoint every _checkpoint_interval 
+        # years, if any.
+        self._checkpointer = None
+        self._checkpoint_interval = None
+        
+        # EventLog the events are written to, if any
+        self._event_log = None
+        
+        # recording.Recorder the counts of every year are written to, if any
+        self._recorder = None
+        
+        # snapshot.Exporter writing the animals every _snapshot_interval 
+        # years, if any.
+        self._exporter = None
+        self._snapshot_interval = None
+        
+        # telemetry.Telemetry reporting the progress of runs, if any
+        self._telemetry = None
+        
     def run_simulation(self, years, file_name_base=None):
         """
         Run the main simulation loop.
         
+        The run ends early if all animals are extinct on a graphics update
+        year, or if one of the criteria given to set_stop_criteria() is met.
+        
+        Return value: dict with the first and last simulated year 
+        ('start_year', 'end_year'), the number of simulated years ('years'),
+        and the reason for stopping early and the year it happened 
+        ('stop_reason', 'stop_year', both None if the run was not stopped).
+        
         Parameters:
         years (number of years to simulate, required)
         file_name_base (str containing base of image file name, optional.
@@ -525,70 +1246,431 @@ class Simulator(object):
         if type(years) != int:
             raise TypeError('Years must be integer')
         
+        result = {'start_year': self._year + 1,
+                  'end_year': self._year,
+                  'years': 0,
+                  'stop_reason': None,
+                  'stop_year': None}
+        for criterion in self._stop_criteria:
+            criterion.reset(*self._terrain.animal_counts())
+        if self._telemetry is not None:
+            self._telemetry.reset(self._year + 1, self._year + years)
+        
         xlim = self._year + years
         for self._year in range(self._year + 1, self._year + 1 + years):      
-            self._terrain.growth()
-            self._terrain.migration(self._year)
-            self._terrain.decay()
+            ani.Animal.reset_fitness_counters()
+            self._run_phase('growth', self._terrain.growth)
+            self._run_phase('migration', self._terrain.migration)
+            self._run_phase('decay', self._terrain.decay)
+            self._avoided_fitness.append(
+                    ani.Animal.fitness_counters()['avoided'])
+            
+            self._counts = self._terrain.species_counts()
+            h_this_y = self._counts['herbivores']
+            c_this_y = self._counts['carnivores']
+            result['end_year'] = self._year
+            result['years'] += 1
+            if self._telemetry is not None:
+                self._telemetry.update(self._year, h_this_y, c_this_y)
+            if self._shared_state is not None:
+                self._shared_state.publish(self._terrain, self._year)
+            if (self._checkpointer is not None and 
+                self._year % self._checkpoint_interval == 0):
+                self._checkpointer.save(self._terrain, self._year)
+                if self._event_log is not None:
+                    self._event_log.sync(self._terrain, self._year)
+            if self._recorder is not None:
+                self._recorder.record(self._year,
+                                      *self._terrain.count_matrices())
+            if (self._exporter is not None and 
+                self._year % self._snapshot_interval == 0):
+                self._exporter.export(self._terrain, self._year)
+            update_year = self._year % self._graphics.update_interval() == 0
+
+            if self._renderer is not None:
+                self._renderer.record(self._year, h_this_y, c_this_y)
+                if update_year:
+                    (herbmat, carnmat) = self._terrain.count_matrices()
+                    self._renderer.submit(self._year, xlim, herbmat, carnmat,
+                                          file_name_base)
+            elif not self._headless:
+                self._graphics.draw_graph(h_this_y, 
+                                          c_this_y, 
+                                          self._year, 
+                                          xlim)
+                if update_year: 
+                    (herbmat, carnmat) = self._terrain.count_matrices()
+                    self._graphics.draw_terrain(self._terrain)
+                    self._graphics.draw_herbivores(herbmat)
+                    self._graphics.draw_carnivores(carnmat, self._year)
+                    self._graphics.update_graphics()  
+                    if file_name_base is not None:
+                        self._graphics.save_image(file_name_base)
             
-            (h_this_y, c_this_y) = self._terrain.animal_counts()
-
-            self._graphics.draw_graph(h_this_y, 
-                                      c_this_y, 
-                                      self._year, 
-                                      xlim)
-            if (self._year) % self._graphics.update_interval() == 0: 
-                self._graphics.draw_terrain(self._terrain)
-                self._graphics.draw_herbivores(self._terrain.terrain_map())
-                self._graphics.draw_carnivores(self._terrain.terrain_map(), 
-                                               self._year)
-                self._graphics.update_graphics()  
-                if file_name_base is not None:
-                    self._graphics.save_image(file_name_base)
-                if h_this_y == 0 and c_this_y == 0:
-                    break
+            stop_reason = None
+            if update_year and self.animal_count() == 0:
+                stop_reason = 'all animals extinct'
+            for criterion in self._stop_criteria:
+                reason = criterion.update(self._year, h_this_y, c_this_y)
+                if stop_reason is None:
+                    stop_reason = reason
+            if stop_reason is not None:
+                result['stop_reason'] = stop_reason
+                result['stop_year'] = self._year
+                break
+        
+        if self._event_log is not None:
+            self._event_log.flush()
+        if self._recorder is not None:
+            self._recorder.flush()
+        if self._renderer is not None:
+            self._renderer.flush()
+        if self._telemetry is not None:
+            self._telemetry.finish()
+        return result
+              
+    def set_stop_criteria(self, criteria):
+        """
+        Set criteria for ending runs early.
+        
+        Parameters:
+        criteria (list of earlystop.Criterion objects, required. An empty
+                  list removes all criteria.)
+        """
+        
+        self._stop_criteria = list(criteria)
+    
+    def enable_checkpoints(self, checkpointer, interval):
+        """
+        Write checkpoints while simulating.
+        
+        Parameters:
+        checkpointer (checkpoint.Checkpointer object, or None to stop 
+                      writing checkpoints, required)
+        interval (a checkpoint is written every interval years, required)
+        """
+        
+        if interval < 1 or int(interval) != interval:
+            raise ValueError('Checkpoint interval must be a positive int')
+        self._checkpointer = checkpointer
+        self._checkpoint_interval = int(interval)
+        
+    def restore_checkpoint(self, year):
+        """
+        Set the terrain and current year to a checkpointed year.
+        
+        Parameters:
+        year (a checkpointed year, required)
+        """
+        
+        if self._checkpointer is None:
+            raise RuntimeError('Checkpoints are not enabled')
+        self._checkpointer.restore(self._terrain, year)
+        self._year = year
+        self._counts = self._terrain.species_counts()
+    
+    def enable_event_log(self, events):
+        """
+        Log the events of the simulation.
+        
+        Checkpoints must be enabled. A checkpoint of the current year is 
+        written, so that replay can start from it.
+        
+        Parameters:
+        events (eventlog.EventLog object, required)
+        """
+        
+        if self._checkpointer is None:
+            raise RuntimeError('Checkpoints are not enabled')
+        self.close_event_log()
+        self._terrain.set_event_log(events)
+        self._checkpointer.save(self._terrain, self._year)
+        events.sync(self._terrain, self._year)
+        self._event_log = events
+        
+    def close_event_log(self):
+        """Stop logging events, and close the log."""
+        
+        if self._event_log is not None:
+            self._terrain.set_event_log(None)
+            self._event_log.close()
+            self._event_log = None
+    
+    def set_telemetry(self, telemetry):
+        """
+        Report the progress of runs.
+        
+        Parameters:
+        telemetry (telemetry.Telemetry object, or None to stop reporting,
+                   required)
+        """
+        
+        self._telemetry = telemetry
+    
+    def enable_snapshots(self, exporter, interval):
+        """
+        Write snapshots of the animals while simulating.
+        
+        Parameters:
+        exporter (snapshot.Exporter object, or None to stop writing 
+                  snapshots, required)
+        interval (a snapshot is written every interval years, required)
+        """
+        
+        if interval < 1 or int(interval) != interval:
+            raise ValueError('Snapshot interval must be a positive int')
+        self._exporter = exporter
+        self._snapshot_interval = int(interval)
+    
+    def enable_recording(self, recorder):
+        """
+        Record the animal counts of every simulated year.
+        
+        Parameters:
+        recorder (recording.Recorder object, required)
+        """
+        
+        self.close_recording()
+        self._recorder = recorder
+        
+    def close_recording(self):
+        """Stop recording, and close the recording files."""
+        
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+        
+    def replay(self, year, log_path):
+        """
+        Set the terrain and current year to a year of a logged run, from 
+        the checkpoints and the event log.
+        
+        Parameters:
+        year (the year to rebuild, required)
+        log_path (path of the event log, required)
+        """
+        
+        if self._checkpointer is None:
+            raise RuntimeError('Checkpoints are not enabled')
+        if self._event_log is not None:
+            raise RuntimeError('Cannot replay while logging events')
+        elg.replay(self._terrain, self._checkpointer, log_path, year)
+        self._year = year
+        self._counts = self._terrain.species_counts()
+    
+    def _run_phase(self, phase, step):
+        """
+        Run one phase of the current year, recording its peak memory use 
+        while memory profiling is on, and attributing CPU samples to it.
+        
+        Parameters:
+        phase (name of the phase, required)
+        step (terrain method doing the phase, required)
+        """
+        
+        self._cpu_profiler.run(phase, self._memory_profiler.run, phase, 
+                               step, self._year)
+              
+    def start_render_worker(self, queue_size=2):
+        """
+        Draw the graphics in a separate process from now on.
+        
+        The simulation hands snapshots to the renderer without waiting, and
+        drops them when the renderer falls behind. At the end of a run, the
+        last snapshot is queued even if the renderer is behind, and the 
+        renderer finishes drawing before the program exits.
+        
+        Parameters:
+        queue_size (max number of snapshots waiting to be drawn, optional)
+        """
+        
+        self.stop_render_worker()
+        map_rgb = self._terrain.map_rgb()
+        self._renderer = rnd.RenderWorker(self._graphics.__class__, map_rgb,
+                                          self._graphics.settings(), 
+                                          queue_size)
+        self._renderer.start()
+        return self._renderer
+    
+    def stop_render_worker(self):
+        """Let the render worker finish drawing, and stop it."""
+        
+        if self._renderer is not None:
+            self._renderer.stop()
+            self._renderer = None
+    
+    def share_state(self, capacity, compact=False):
+        """
+        Publish the terrain state to shared memory after every year.
+        
+        The shared block is a read-only copy of the terrain state, see 
+        sharedstate. Changes made to it by other processes are not seen 
+        by the simulation.
+        
+        Return value: descriptor that other processes can pass to 
+        sharedstate.SharedState.attach().
+        
+        Parameters:
+        capacity (max number of animals per species, required)
+        compact (if True, per-animal state is shared as 32 bit values, 
+                 optional)
+        """
+        
+        self.release_shared_state()
+        self._shared_state = shs.SharedState.create(
+                self._terrain.terrain_dimensions(), capacity, compact)
+        self._shared_state.publish(self._terrain, self._year)
+        return self._shared_state.descriptor()
+    
+    def shared_state(self):
+        """Return the SharedState object in use, or None."""
+        
+        return self._shared_state
+    
+    def release_shared_state(self):
+        """Stop publishing to shared memory and remove the shared block."""
+        
+        if self._shared_state is not None:
+            self._shared_state.unlink()
+            self._shared_state = None
+              
+    def profile_memory(self, enabled=True):
+        """
+        Start or stop recording the peak memory use of each phase.
+        
+        Starting clears the peaks recorded earlier. Tracing memory with 
+        tracemalloc slows the simulation down.
+        
+        Parameters:
+        enabled (True to start, False to stop, optional)
+        """
+        
+        if enabled and not self._memory_profiler.running():
+            self._memory_profiler.reset()
+            self._memory_profiler.start()
+        elif not enabled:
+            self._memory_profiler.stop()
+    
+    def profile_cpu(self, enabled=True, interval=None):
+        """
+        Start or stop sampling the call stack, per phase.
+        
+        Starting clears the samples taken earlier. Samples are taken on 
+        SIGPROF, or by a separate thread where that is not possible, see 
+        cpuprofile, and slow the simulation down little.
+        
+        Parameters:
+        enabled (True to start, False to stop, optional)
+        interval (seconds between samples, optional. If omitted, the 
+                  interval of the last profiling is used.)
+        """
+        
+        if enabled and not self._cpu_profiler.running():
+            if interval is not None:
+                self._cpu_profiler = cpu.SamplingProfiler(interval)
+            self._cpu_profiler.reset()
+            self._cpu_profiler.start()
+        elif not enabled:
+            self._cpu_profiler.stop()
+    
+    def cpu_profile(self):
+        """Return the cpuprofile.SamplingProfiler with the samples."""
+        
+        return self._cpu_profiler
+    
+    def memory_report(self, sample_size=1000):
+        """
+        Return dict describing the memory used by the simulation.
+        
+        The dict contains the number of animals and regions, the estimated
+        bytes per animal and per region, their total, and the peak bytes
+        allocated during each phase in the last memory profiling run.
+        
+        Parameters:
+        sample_size (max number of animals measured, optional)
+        """
+        
+        regions = list(self._terrain.terrain_map().flat)
+        report = {'animals': sum(self._terrain.animal_counts()),
+                  'regions': len(regions),
+                  'bytes_per_animal': 
+                      self._terrain.bytes_per_animal(sample_size),
+                  'bytes_per_region': 0,
+                  'phase_peaks': self._memory_profiler.peaks()}
+        if regions:
+            report['bytes_per_region'] = (sum(mem.region_bytes(celle) 
+                                              for celle in regions) / 
+                                          float(len(regions)))
+        report['total_bytes'] = int(report['animals'] * 
+                                    report['bytes_per_animal'] +
+                                    report['regions'] * 
+                                    report['bytes_per_region'])
+        if self._shared_state is not None:
+            report['shared_bytes_per_animal'] = (
+                    self._shared_state.bytes_per_animal())
+        return report
               
     def current_year(self):
         """Return the current year."""
         
         return self._year
         
+    def avoided_fitness_recomputations(self):
+        """
+        Return list with the number of fitness recomputations avoided by 
+        the lazy fitness evaluation, one entry per simulated year.
+        """
+        
+        return self._avoided_fitness
+        
     def animal_count(self):
-        """Return total animal count."""
+        """Return total animal count, of all species."""
         
-        return self._h_this_y + self._c_this_y
+        return sum(self._counts.values())
     
     def count_by_species(self):
-        """Return animal count by species."""
+        """Return animal count by species, with every species."""
         
-        return {'herbivores': self._h_this_y, 'carnivores': self._c_this_y}
+        return dict(self._counts)
     
     def count_by_cell(self):
         """Return herbivore and carnivore counts for each cell."""
         
-        herbmat = np.zeros(np.shape(self._terrain.terrain_map()))
-        carnmat = np.zeros(np.shape(self._terrain.terrain_map()))
-        for row in range(np.shape(self._terrain.terrain_map())[0]):
-            for column in range(np.shape(self._terrain.terrain_map())[1]):
-                herbcount = len(self._terrain.terrain_map()[row, column]
-                                .herbivores())
-                carncount = len(self._terrain.terrain_map()[row, column]
-                                .carnivores()) 
-                herbmat[row, column] = herbcount
-                carnmat[row, column] = carncount
-        return {'herbivores': herbmat, 'carnivores': carnmat}
+        (herbmat, carnmat) = self._terrain.count_matrices()
+        return {'herbivores': herbmat.astype(float), 
+                'carnivores': carnmat.astype(float)}
 
 
 class InputHandler(object):
     """Handles the user input and serves as the main user interface."""
     
-    def __init__(self, mapstr=None, mapfile=None):
+    def __init__(self, mapstr=None, mapfile=None, headless=False, 
+                 storage=None, storage_dir=None, chunk_size=1000000,
+                 engine=None):
         """
         Initialize InputHandler object.
         
         Parameters:
         mapstr (string describing the map. See below)
         mapfile (location of file containing mapstr)
+        headless (if True, the simulation is not drawn and matplotlib is 
+                  not imported, unless a render worker is started, optional)
+        storage ('objects' to hold animals as objects in the regions,
+                 'memory' to hold them in columns in memory, or 'memmap' 
+                 to hold them in memory mapped column files, optional. If 
+                 omitted, the storage of the engine is used.)
+        storage_dir (directory for the memory mapped files, optional. If 
+                     omitted, a temporary directory is created, which is 
+                     removed by close(), or when the InputHandler is 
+                     garbage collected or the program exits.)
+        chunk_size (approximate max number of animals held in memory at a 
+                    time with 'memmap' storage, optional)
+        engine (compute backend, one of 'python', 'cython', 'numpy' and 
+                'numba', optional. The engine is used by the whole process.
+                If omitted, the engine in use is kept, and if there is 
+                none, 'cython' is used when built, else 'python'. An engine 
+                that is not available falls back to one that is, see 
+                backends.)
         
         One of the parameters must be given.
         
@@ -648,11 +1730,32 @@ class InputHandler(object):
         self._default_params_s = {'fmax': 150, 'alpha': 0.8}
         lnd.Savannah.update_params(self._default_params_s)
         
+        # The engine applies to the whole process, as the parameters above
+        if engine is not None or bk.active() is None:
+            bk.select(engine)
+        if storage is None:
+            storage = bk.storage(bk.active())
+        
         # Initialize Graphics() and Terrain() objects and deliver them to 
         # the Simulator() 
         self._graphics = Graphics()
         self._terrain = Terrain(mapstr, mapfile)
-        self._simulation = Simulator(self._terrain, self._graphics)
+        # Removes the temporary storage directory, if one is created
+        self._remove_storage_dir = None
+        if storage == 'memory':
+            self._terrain.use_columnar_storage(None, chunk_size)
+        elif storage == 'memmap':
+            if storage_dir is None:
+                storage_dir = tempfile.mkdtemp(prefix='slogstorm')
+                self._remove_storage_dir = weakref.finalize(
+                        self, shutil.rmtree, storage_dir, True)
+            self._terrain.use_columnar_storage(storage_dir, chunk_size)
+        elif storage != 'objects':
+            raise ValueError('No storage called {}'.format(storage))
+        self._simulation = Simulator(self._terrain, self._graphics, headless)
+        
+        # Telemetry set by enable_telemetry(), if any
+        self._telemetry = None
 
     def _convert_indices(self, indices):
         """
@@ -666,17 +1769,332 @@ class InputHandler(object):
         
         return (indices[0]-1, indices[1]-1)
 
-    def run_simulation(self, years, file_name_base=None):
+    def engine(self):
+        """
+        Return the name of the compute backend in use. It is shared by the
+        whole process, so it is the one last selected by any InputHandler.
+        """
+
+        return bk.active()
+
+    def run_simulation(self, years, file_name_base=None, profile=None):
         """
         Run the main _simulation loop in the simulator object.
         
+        Return value: dict describing the run, including the reason and 
+        year if it was stopped early. See Simulator.run_simulation().
+        
         Parameters:
         years (number of years to simulate, required)
         file_name_base (str containing base of image file name, optional.
                         If omitted, images are not saved.)
+        profile (path of a file to write a sampling CPU profile of the run
+                 to, optional. Paths ending with .json get speedscope JSON, 
+                 others collapsed stacks. See cpu_profile() for more.)
+        """
+        
+        if profile is None:
+            return self._simulation.run_simulation(years, file_name_base)
+        self._simulation.profile_cpu()
+        try:
+            return self._simulation.run_simulation(years, file_name_base)
+        finally:
+            self._simulation.profile_cpu(False)
+            self._simulation.cpu_profile().write(profile)
+    
+    def set_stop_criteria(self, extinction=None, stationary_window=None, 
+                          cycle_window=None, max_period=20, tolerance=0.05,
+                          criteria=None):
+        """
+        Set criteria for ending runs early. Criteria not given are removed.
+        
+        Parameters:
+        extinction ('all', 'any', 'herbivores' or 'carnivores' to stop when
+                    the given animals are extinct, checked every year, 
+                    optional)
+        stationary_window (stop when the counts have been stationary for 
+                           this many years, optional)
+        cycle_window (stop when the counts have repeated themselves with a 
+                      fixed period for this many years, optional)
+        max_period (longest cycle period in years looked for, optional)
+        tolerance (relative tolerance for stationarity and cycles, 
+                   optional)
+        criteria (list of other earlystop.Criterion objects, optional)
+        """
+        
+        criteria = list(criteria or [])
+        if extinction is not None:
+            criteria.append(stp.Extinction(extinction))
+        if stationary_window is not None:
+            criteria.append(stp.Stationarity(stationary_window, tolerance))
+        if cycle_window is not None:
+            criteria.append(stp.StableCycle(cycle_window, max_period, 
+                                            tolerance))
+        self._simulation.set_stop_criteria(criteria)
+        
+    def enable_checkpoints(self, directory, interval=10, base_interval=None):
+        """
+        Write a checkpoint to directory every interval years.
+        
+        The first checkpoint holds the full state, the following ones only
+        the cells that changed. See checkpoint.Checkpointer.
+        
+        Parameters:
+        directory (directory for the checkpoint files, required)
+        interval (years between checkpoints, optional)
+        base_interval (write a full checkpoint every base_interval 
+                       checkpoints, optional)
+        """
+        
+        self._simulation.enable_checkpoints(
+                chk.Checkpointer(directory, base_interval), interval)
+        
+    def restore_checkpoint(self, year):
+        """
+        Go back (or forward) to a checkpointed year.
+        
+        Parameters:
+        year (a checkpointed year, required)
         """
         
-        self._simulation.run_simulation(years, file_name_base)
+        self._simulation.restore_checkpoint(year)
+        
+    def enable_event_log(self, path, buffer_size=65536):
+        """
+        Write births, deaths, kills, migrations and feedings to a binary 
+        event log, so that any year can be rebuilt with replay().
+        
+        Checkpoints must be enabled, see enable_checkpoints(). Only 
+        'objects' storage can be logged.
+        
+        Parameters:
+        path (path of the log file, required)
+        buffer_size (number of events buffered before they are written, 
+                     optional)
+        """
+        
+        # Check before the log file is created
+        if self._terrain.columnar_animals() is not None:
+            raise RuntimeError('Events cannot be logged with columnar storage')
+        self._simulation.enable_event_log(elg.EventLog(path, buffer_size))
+        
+    def close_event_log(self):
+        """Stop logging events, and close the log."""
+        
+        self._simulation.close_event_log()
+        
+    def enable_telemetry(self, callback=None, path=None, port=None, 
+                         interval=1.0, sinks=None):
+        """
+        Report the current year, simulated years and animals per second, 
+        the population and the estimated time left while simulating. See
+        the telemetry module for the reports.
+        
+        Return value: the telemetry.Telemetry object, whose sinks() give
+        e.g. the port of the HTTP endpoint.
+        
+        Parameters:
+        callback (function called with every report, optional)
+        path (file each report is appended to as a line of JSON, optional)
+        port (serve the latest report over HTTP on this local port, 
+              optional. With 0, a free port is chosen.)
+        interval (min seconds between reports, optional)
+        sinks (list of other telemetry.Sink objects, optional)
+        """
+        
+        self.disable_telemetry()
+        sinks = list(sinks or [])
+        if callback is not None:
+            sinks.append(tel.CallbackSink(callback))
+        if path is not None:
+            sinks.append(tel.JsonLinesSink(path))
+        if port is not None:
+            sinks.append(tel.HttpSink(port))
+        telemetry = tel.Telemetry(sinks, interval)
+        self._simulation.set_telemetry(telemetry)
+        self._telemetry = telemetry
+        return telemetry
+        
+    def disable_telemetry(self):
+        """Stop reporting progress, and close the sinks."""
+        
+        if self._telemetry is not None:
+            self._simulation.set_telemetry(None)
+            self._telemetry.close()
+            self._telemetry = None
+        
+    def enable_snapshots(self, directory, interval=10, sample_size=None, 
+                         seed=None):
+        """
+        Write the cell, weight, age and fitness of every animal to a 
+        compressed file in directory every interval years. Read the files
+        with snapshot.read().
+        
+        Parameters:
+        directory (directory for the snapshot files, required)
+        interval (years between snapshots, optional)
+        sample_size (write a uniform random sample of at most sample_size 
+                     animals of each species, optional. If omitted, all 
+                     animals are written.)
+        seed (seed of the random samples, optional)
+        """
+        
+        self._simulation.enable_snapshots(
+                snp.Exporter(directory, sample_size, seed), interval)
+        
+    def disable_snapshots(self):
+        """Stop writing snapshots."""
+        
+        self._simulation.enable_snapshots(None, 1)
+        
+    def enable_recording(self, directory, chunk_years=100):
+        """
+        Write the herbivore and carnivore counts of every cell to directory
+        each simulated year, to be read with recording.Recording.
+        
+        Parameters:
+        directory (directory for the recording, required. An existing
+                   recording in it is overwritten.)
+        chunk_years (years summarized together for fast means and maxima,
+                     optional)
+        """
+        
+        self._simulation.enable_recording(
+                rec.Recorder(directory, self._terrain.terrain_dimensions(),
+                             chunk_years))
+        
+    def close_recording(self):
+        """Stop recording, and close the recording files."""
+        
+        self._simulation.close_recording()
+        
+    def close(self):
+        """
+        Remove the temporary directory created for 'memmap' storage, if any.
+        
+        The animals are lost, so the InputHandler cannot be used afterwards.
+        A storage_dir given to the InputHandler is left as it is.
+        """
+        
+        if self._remove_storage_dir is not None:
+            self._remove_storage_dir()
+        
+    def replay(self, year, log_path):
+        """
+        Rebuild the state at the end of a year of a logged run.
+        
+        Faster than simulating again. Use a new InputHandler with the same 
+        map and parameters as the logged run, and enable checkpoints with 
+        the checkpoint directory of that run.
+        
+        Parameters:
+        year (the year to rebuild, required)
+        log_path (path of the event log, required)
+        """
+        
+        self._simulation.replay(year, log_path)
+        
+    def cohort_simulator(self, **kwargs):
+        """
+        Return a cohort based simulator for the same terrain.
+        
+        The cohort simulator uses the same map and the same parameter 
+        dictionaries as this InputHandler, but holds animal counts binned
+        by age and weight instead of individual animals. Animals already 
+        deployed are not transferred.
+        
+        Parameters:
+        kwargs (keyword arguments passed on to CohortSimulator, optional)
+        """
+        
+        return coh.CohortSimulator(self._terrain, **kwargs)
+        
+    def start_render_worker(self, queue_size=2):
+        """
+        Draw the graphics in a separate process.
+        
+        The simulation loop never waits for drawing. If the renderer falls
+        behind, plot updates are dropped.
+        
+        Return value: the RenderWorker object.
+        
+        Parameters:
+        queue_size (max number of plot updates waiting to be drawn, 
+                    optional)
+        """
+        
+        return self._simulation.start_render_worker(queue_size)
+    
+    def stop_render_worker(self):
+        """Stop drawing in a separate process."""
+        
+        self._simulation.stop_render_worker()
+    
+    def share_state(self, capacity=100000, compact=False):
+        """
+        Copy the simulation state to shared memory after every year, for 
+        other processes to read.
+        
+        The shared state is a one-way mirror: the simulation keeps its own 
+        state, and does not see changes made to the shared block.
+        
+        Return value: descriptor to pass to sharedstate.SharedState.attach()
+        in reader processes, e.g. visualizers.
+        
+        Parameters:
+        capacity (max number of animals per species, optional)
+        compact (if True, per-animal state is shared as 32 bit values, 
+                 optional)
+        """
+        
+        return self._simulation.share_state(capacity, compact)
+    
+    def release_shared_state(self):
+        """Remove the shared memory block created by share_state()."""
+        
+        self._simulation.release_shared_state()
+    
+    def profile_memory(self, enabled=True):
+        """
+        Start or stop recording the peak memory use of each phase.
+        
+        Parameters:
+        enabled (True to start, False to stop, optional)
+        """
+        
+        self._simulation.profile_memory(enabled)
+    
+    def profile_cpu(self, enabled=True, interval=0.005):
+        """
+        Start or stop sampling the call stack every interval seconds, per 
+        phase. Unlike cProfile, sampling does not slow down the many small
+        calls of the simulation.
+        
+        Parameters:
+        enabled (True to start, False to stop, optional)
+        interval (seconds between samples, optional)
+        """
+        
+        self._simulation.profile_cpu(enabled, interval)
+    
+    def cpu_profile(self):
+        """
+        Return the cpuprofile.SamplingProfiler holding the samples of the 
+        last CPU profiling, with report(), write() and the samples per 
+        phase.
+        """
+        
+        return self._simulation.cpu_profile()
+    
+    def memory_report(self):
+        """
+        Return dict with bytes per animal, bytes per region and the peak 
+        bytes allocated during each phase of the simulation.
+        
+        See Simulator.memory_report() for details.
+        """
+        
+        return self._simulation.memory_report()
         
     def deploy_animals(self, deployments):
         """
@@ -702,15 +2120,10 @@ class InputHandler(object):
                     if k not in ['species', 'age', 'weight']:
                         raise KeyError('No parameter called {}'.
                                              format(k))
-                if animal['species'] == 'Herbivore':
-                    self._terrain.terrain_map()[coord].deploy(
-                            ani.Herbivore(animal['weight'], animal['age']))
-                elif animal['species'] == 'Carnivore':
-                    self._terrain.terrain_map()[coord].deploy(
-                            ani.Carnivore(animal['weight'], animal['age']))
-                else:
-                    raise ValueError('No species called {}'.
-                                     format(animal['species']))
+                species = spc.by_class_name(animal['species'])
+                self._terrain.deploy(
+                        coord, 
+                        species.animal_class(animal['weight'], animal['age']))
 
     def set_herbivore_parameters(self, parameters):
         """
@@ -766,6 +2179,20 @@ class InputHandler(object):
         self._default_params_j.update(parameters)   
         lnd.Jungle.update_params(self._default_params_j)
         
+    def set_food_parameters(self, loc, fmax=None, alpha=None):
+        """
+        Set fmax and/or alpha of a single jungle or savannah cell.
+        
+        Parameters:
+        loc (location (<row>, <column>) of the cell, counting from 1, 
+             required)
+        fmax (max amount of food in the cell, optional)
+        alpha (regrowth rate of the cell, optional)
+        """
+        
+        self._terrain.set_food_parameters(self._convert_indices(loc), 
+                                          fmax, alpha)
+        
     def set_savannah_parameters(self, parameters):
         """
         Set savannah parameters.
@@ -3,23 +3,167 @@
 This module provides a random generator interface.
 
 NumPy's random generators is used by default, but may be replaced by another.
+
+By default all numbers are drawn from the global numpy.random state. After
+seed_streams() has been called, numbers are instead drawn from counter based
+Philox streams. Every (year, cell, phase) then has its own independent
+stream, selected with select_stream(), so the numbers drawn for one cell do
+not depend on how many other cells were processed before it, or in which
+order.
 """
 
 __author__ = "Aleksander Hykkerud and Daniel Hjertholm"
 
 import numpy.random as nrandom
 
+# Philox key used for counter based streams, and the currently selected
+# stream. _stream_key is None when the global numpy.random state is used.
+_stream_key = None
+_stream = None
+
 def seed(seedvalue):
-    """Set the seed value for the random generator."""
-    
+    """
+    Set the seed value for the random generator.
+
+    Counter based streams are switched off.
+    """
+
+    global _stream_key, _stream
+    _stream_key = None
+    _stream = None
     nrandom.seed(seedvalue)
 
-def random():
-    """Return a (pseudo)random float in the interval [0, 1)."""
+def seed_streams(seedvalue):
+    """
+    Switch to counter based streams keyed by seedvalue.
+
+    Until select_stream() is called, numbers are drawn from the stream for
+    (year, cell, phase) = (0, 0, 0).
+
+    Parameters:
+    seedvalue (non-negative int, required)
+    """
+
+    global _stream_key, _stream
+    if seedvalue < 0 or int(seedvalue) != seedvalue:
+        raise ValueError('Seed must be non-negative int')
+    seedvalue = int(seedvalue)
+    _stream_key = [seedvalue & 0xFFFFFFFFFFFFFFFF,
+                   (seedvalue >> 64) & 0xFFFFFFFFFFFFFFFF]
+    _stream = stream(0, 0, 0)
+
+def get_state():
+    """
+    Return the state of the random generator, for set_state().
+
+    Includes whether counter based streams are in use, and the position in
+    the selected stream.
+    """
+
+    stream_state = None
+    if _stream is not None:
+        stream_state = _stream.bit_generator.state
+    return (_stream_key, stream_state, nrandom.get_state())
+
+def set_state(state):
+    """
+    Set the random generator to a state returned by get_state().
+
+    Parameters:
+    state (state returned by get_state(), required)
+    """
+
+    global _stream_key, _stream
+    (_stream_key, stream_state, global_state) = state
+    nrandom.set_state(global_state)
+    _stream = None
+    if stream_state is not None:
+        _stream = nrandom.Generator(nrandom.Philox(key=_stream_key))
+        _stream.bit_generator.state = stream_state
+
+def streams_enabled():
+    """Return True if counter based streams are in use."""
+
+    return _stream_key is not None
+
+def stream(year, cell, phase):
+    """
+    Return a new generator for the stream of (year, cell, phase).
+
+    The stream is a Philox generator with the key given to seed_streams()
+    and the counter starting at (0, year, cell, phase). Streams never
+    overlap unless more than 2**64 blocks are drawn from one of them.
+
+    Parameters:
+    year (non-negative int, required)
+    cell (non-negative int, e.g. flat map index, required)
+    phase (non-negative int identifying the phase of the year, required)
+    """
+
+    if _stream_key is None:
+        raise RuntimeError('Counter based streams are not seeded')
+    return nrandom.Generator(nrandom.Philox(key=_stream_key,
+                                            counter=[0, year, cell, phase]))
+
+def select_stream(year, cell, phase):
+    """
+    Draw the following numbers from the stream of (year, cell, phase).
+
+    Does nothing unless counter based streams are in use.
+    """
+
+    global _stream
+    if _stream_key is not None:
+        _stream = stream(year, cell, phase)
+
+def bit_generator():
+    """
+    Return the NumPy bit generator numbers are currently drawn from.
+
+    Doubles drawn from it, e.g. by a compiled kernel, continue the sequence
+    of random().
+    """
+
+    if _stream is None:
+        return nrandom.get_bit_generator()
+    return _stream.bit_generator
+
+def random(size=None):
+    """
+    Return a (pseudo)random float in the interval [0, 1).
     
-    return nrandom.random()
+    Parameters:
+    size (if given, an array of size floats is returned, optional)
+    """
+
+    if _stream is None:
+        return nrandom.random(size)
+    return _stream.random(size)
 
-def randint(vmax):
-    """Return a (pseudo)randomly selected int between 0 and vmax."""
+def randint(vmax, size=None):
+    """
+    Return a (pseudo)randomly selected int between 0 and vmax.
     
-    return nrandom.randint(vmax)        
\ No newline at end of file
+    Parameters:
+    vmax (upper limit, not included, required)
+    size (if given, an array of size ints is returned, optional)
+    """
+
+    if _stream is None:
+        return nrandom.randint(vmax, size=size)
+    if size is None:
+        return int(_stream.integers(vmax))
+    return _stream.integers(vmax, size=size)
+
+def binomial(trials, prob):
+    """
+    Return (pseudo)random number(s) of successes in binomial trials.
+
+    Parameters:
+    trials (int or array of ints, number of trials, required)
+    prob (float or array of floats, success probability, required)
+    """
+
+    if _stream is None:
+        return nrandom.binomial(trials, prob)
+    return _stream.binomial(trials, prob)
@@ -0,0 +1,213 @@
+#!/usr/env/bin python
+"""
+This module provides periodic snapshots of the individual animals.
+
+Exporter writes, for every species, the cell (flat map index), weight, age
+and fitness of the animals of a terrain to a compressed file, as one array
+per column. Files are named snapshot_<year>.npz, and hold
+
+    year, dims                  the year and the map dimensions
+    <species>_population        the number of animals of the species
+    <species>_<column>          the columns, sorted by cell
+
+With sample_size given, only a uniform random sample of at most
+sample_size animals per species is written, drawn by reservoir sampling
+over chunks of the columns. The cost of a snapshot is then bounded on huge
+populations, and the distributions of weight, age and fitness in the
+sample are unbiased estimates of those of the population. The sample is
+drawn with a random generator of its own, so snapshots do not change the
+simulation.
+
+read() returns a snapshot as a dict of columns per species.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import os
+import re
+import numpy as np
+import columnar as col
+import species as spc
+
+COLUMNS = tuple(column for column, dtype in col.COLUMNS)
+
+_FILE_NAME = re.compile(r'^snapshot_(\d+)\.npz$')
+
+
+class Reservoir(object):
+    """A uniform random sample of fixed size from a stream of rows."""
+
+    def __init__(self, size, generator):
+        """
+        Initialize an empty reservoir.
+
+        Parameters:
+        size (max number of rows kept, required)
+        generator (numpy.random.Generator drawing the sample, required)
+        """
+
+        if size < 1:
+            raise ValueError('Sample size must be positive')
+        self._size = size
+        self._generator = generator
+        self._seen = 0
+        # Position in the stream of every kept row
+        self._rows = np.zeros(size, dtype=np.int64)
+        self._columns = None
+
+    def seen(self):
+        """Return the number of rows added."""
+
+        return self._seen
+
+    def add(self, columns):
+        """
+        Add a chunk of rows.
+
+        Each row added so far is kept with probability size / seen
+        (Algorithm R, done for a whole chunk at a time).
+
+        Parameters:
+        columns (dict of columns of equal length, required)
+        """
+
+        n_rows = len(columns[COLUMNS[0]])
+        if self._columns is None:
+            self._columns = dict(
+                    (column, np.zeros(self._size, dtype=columns[column].dtype))
+                    for column in COLUMNS)
+        # Fill the reservoir first
+        filled = min(max(self._size - self._seen, 0), n_rows)
+        positions = np.arange(self._seen, self._seen + filled)
+        chunk_rows = np.arange(filled)
+
+        # Row number i of the stream replaces a random kept row with
+        # probability size / (i + 1)
+        stream_rows = np.arange(self._seen + filled, self._seen + n_rows)
+        slots = self._generator.integers(0, stream_rows + 1)
+        hits = np.flatnonzero(slots < self._size)
+        positions = np.concatenate((positions, slots[hits]))
+        chunk_rows = np.concatenate((chunk_rows, filled + hits))
+        # When a slot is hit more than once, the last row stays
+        (positions, last) = np.unique(positions[::-1], return_index=True)
+        chunk_rows = chunk_rows[::-1][last]
+
+        self._rows[positions] = self._seen + chunk_rows
+        for column in COLUMNS:
+            self._columns[column][positions] = \
+                np.asarray(columns[column])[chunk_rows]
+        self._seen += n_rows
+
+    def sample(self):
+        """Return dict with the columns of the kept rows, in stream order."""
+
+        kept = min(self._size, self._seen)
+        if self._columns is None:
+            return dict((column, np.zeros(0, dtype=dtype))
+                        for column, dtype in col.COLUMNS)
+        order = np.argsort(self._rows[:kept], kind='stable')
+        return dict((column, self._columns[column][:kept][order])
+                    for column in COLUMNS)
+
+
+class Exporter(object):
+    """Writes snapshots of the animals of a terrain to a directory."""
+
+    def __init__(self, directory, sample_size=None, seed=None,
+                 chunk_size=1000000):
+        """
+        Initialize an exporter.
+
+        Parameters:
+        directory (directory for the snapshot files, created if missing,
+                   required)
+        sample_size (max number of animals of each species written,
+                     optional. If omitted, all animals are written.)
+        seed (seed of the random sample, optional)
+        chunk_size (number of rows read at a time when sampling, optional)
+        """
+
+        if sample_size is not None and sample_size < 1:
+            raise ValueError('Sample size must be positive')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._sample_size = sample_size
+        self._generator = np.random.default_rng(seed)
+        self._chunk_size = chunk_size
+
+    def path(self, year):
+        """Return path of the snapshot of a year."""
+
+        return os.path.join(self._directory,
+                            'snapshot_{0:06d}.npz'.format(year))
+
+    def _sample(self, columns):
+        """Return dict with a random sample of the rows of columns."""
+
+        reservoir = Reservoir(self._sample_size, self._generator)
+        total = len(columns[COLUMNS[0]])
+        for start in range(0, total, self._chunk_size):
+            stop = min(start + self._chunk_size, total)
+            reservoir.add(dict((column, columns[column][start:stop])
+                               for column in COLUMNS))
+        return reservoir.sample()
+
+    def export(self, terrain, year):
+        """
+        Write a snapshot of a terrain.
+
+        Return value: the path of the snapshot.
+
+        Parameters:
+        terrain (terrain object, required)
+        year (the current year, required)
+        """
+
+        arrays = {'year': year,
+                  'dims': np.array(terrain.terrain_dimensions())}
+        for species in spc.names():
+            columns = terrain.animal_columns(species)
+            arrays[species + '_population'] = len(columns['cell'])
+            if (self._sample_size is not None and
+                len(columns['cell']) > self._sample_size):
+                columns = self._sample(columns)
+            for column in COLUMNS:
+                arrays[species + '_' + column] = np.asarray(columns[column])
+        path = self.path(year)
+        np.savez_compressed(path, **arrays)
+        return path
+
+
+def years(directory):
+    """Return sorted list of the years with a snapshot in directory."""
+
+    return sorted(int(match.group(1)) for match in
+                  (_FILE_NAME.match(name) for name in os.listdir(directory))
+                  if match)
+
+
+def read(path):
+    """
+    Return a snapshot.
+
+    The snapshot is a dict with 'year', 'dims', 'population': a dict with
+    the number of animals of each species, and for each species a dict with
+    the columns cell, weight, age and fitness. With sampling, the columns
+    hold fewer rows than the population.
+
+    Parameters:
+    path (path of a snapshot file, required)
+    """
+
+    with np.load(path) as data:
+        snapshot = {'year': int(data['year']), 'dims': data['dims'],
+                    'population': {}}
+        names = [name[:-len('_population')] for name in data.files
+                 if name.endswith('_population')]
+        for species in names:
+            snapshot['population'][species] = \
+                int(data[species + '_population'])
+            snapshot[species] = dict((column, data[species + '_' + column])
+                                     for column in COLUMNS)
+    return snapshot
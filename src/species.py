@@ -0,0 +1,148 @@
+#!/usr/env/bin python
+"""
+This module provides the table of species.
+
+Every species is a row of the table, with its name, the animal class
+holding its parameters, its diet, and for predators the species it preys
+on. The index of a row is set as the class attribute species of the animal
+class. Regions keep one list of animals, and ColumnarAnimals one column
+store, per row, indexed by it, so that the phases of a year loop over the
+table instead of branching on the class of each animal.
+
+Within a cell, the grazers eat the food in table order. Then the
+predators hunt in table order, each hunting its prey species in the order
+given.
+
+More species are added with register(), before any Terrain is created.
+The animal class of a grazer must provide eat(), as Herbivore does.
+
+Checkpoints, shared state and the cohort engine only cover herbivores and
+carnivores.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import animaltypes as ani
+
+GRAZER = 'grazer'
+PREDATOR = 'predator'
+
+
+class Species(object):
+    """A row of the species table."""
+
+    def __init__(self, index, name, animal_class, diet, prey):
+        """
+        Initialize a species. Use register() to add a species to the table.
+
+        Parameters:
+        index (row of the species in the table, required)
+        name (plural name, e.g. 'herbivores', required)
+        animal_class (subclass of animaltypes.Animal, required)
+        diet (GRAZER or PREDATOR, required)
+        prey (tuple with the indices of the prey species, required)
+        """
+
+        self.index = index
+        self.name = name
+        self.animal_class = animal_class
+        self.diet = diet
+        self.prey = prey
+
+    def __repr__(self):
+        """Return a string representation of the species."""
+
+        return 'Species({0!r}, {1}, {2!r}, {3})'.format(
+                self.name, self.animal_class.__name__, self.diet,
+                tuple(_table[k].name for k in self.prey))
+
+    def params(self):
+        """Return the parameter dict of the species."""
+
+        return self.animal_class.params
+
+
+_table = []
+
+
+def register(name, animal_class, diet, prey=()):
+    """
+    Add a species to the table.
+
+    Return value: the new Species.
+
+    Parameters:
+    name (plural name, e.g. 'herbivores', required)
+    animal_class (subclass of animaltypes.Animal, required)
+    diet (GRAZER or PREDATOR, required)
+    prey (names of the species a predator hunts, in order, required for
+          predators)
+    """
+
+    if name in names():
+        raise ValueError('Species {} is already registered'.format(name))
+    if diet not in (GRAZER, PREDATOR):
+        raise ValueError('Diet must be {0} or {1}'.format(GRAZER, PREDATOR))
+    if (diet == PREDATOR) != bool(prey):
+        raise ValueError('Predators, and only predators, must have prey')
+    species = Species(len(_table), name, animal_class, diet,
+                      tuple(row(prey_name).index for prey_name in prey))
+    animal_class.species = species.index
+    _table.append(species)
+    return species
+
+
+def table():
+    """Return tuple with all species, in table order."""
+
+    return tuple(_table)
+
+
+def names():
+    """Return tuple with the names of all species, in table order."""
+
+    return tuple(species.name for species in _table)
+
+
+def row(name):
+    """Return the species called name."""
+
+    for species in _table:
+        if species.name == name:
+            return species
+    raise KeyError('No species called {}'.format(name))
+
+
+def by_class_name(class_name):
+    """
+    Return the species whose animal class is called class_name, as used by
+    InputHandler.deploy_animals().
+    """
+
+    for species in _table:
+        if species.animal_class.__name__ == class_name:
+            return species
+    raise ValueError('No species called {}'.format(class_name))
+
+
+def grazers():
+    """Return tuple with the grazing species, in table order."""
+
+    return tuple(species for species in _table if species.diet == GRAZER)
+
+
+def predators():
+    """Return tuple with the predator species, in table order."""
+
+    return tuple(species for species in _table if species.diet == PREDATOR)
+
+
+def of(animal):
+    """Return the species of an animal."""
+
+    return _table[animal.species]
+
+
+HERBIVORES = register('herbivores', ani.Herbivore, GRAZER).index
+CARNIVORES = register('carnivores', ani.Carnivore, PREDATOR,
+                      ('herbivores',)).index
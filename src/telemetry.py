@@ -0,0 +1,333 @@
+#!/usr/env/bin python
+"""
+This module provides progress and throughput telemetry for long runs.
+
+Telemetry is given the herbivore and carnivore counts after every
+simulated year, like the early stop criteria. At most once every interval
+seconds, and when a run ends, it sends a report to its sinks: a dict with
+
+    year                        the last simulated year
+    start_year, end_year        the first and last year of the run
+    years_done                  years simulated so far in the run
+    herbivores, carnivores      the counts after the last year
+    population                  their sum
+    years_per_second            simulated years per second since the
+                                previous report
+    animal_updates_per_second   animals simulated per second since the
+                                previous report, counting every animal
+                                alive after a year once
+    elapsed_seconds             seconds since the run started
+    eta_seconds                 estimated seconds left, from the mean rate
+                                of the run so far
+    finished                    True in the last report of a run
+
+Updates that do not report only add to two counters and read the clock,
+so telemetry can be left on.
+
+Sinks:
+    CallbackSink        calls a function with each report
+    JsonLinesSink       appends each report as a line of JSON to a file
+    HttpSink            serves the latest report over HTTP, as JSON at /
+                        and as Prometheus text at /metrics
+
+http.server is imported by the first HttpSink, not with this module.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import json
+import threading
+import time
+
+# Report entries exported by HttpSink at /metrics, as biosim_<name>
+_METRICS = ('year', 'years_done', 'herbivores', 'carnivores', 'population',
+            'years_per_second', 'animal_updates_per_second',
+            'elapsed_seconds', 'eta_seconds')
+
+
+class Sink(object):
+    """
+    Superclass for telemetry sinks.
+
+    Subclasses override emit(), and close() if they hold resources.
+    """
+
+    def emit(self, report):
+        """
+        Handle a report.
+
+        Parameters:
+        report (dict, see the module docstring, required)
+        """
+
+        pass
+
+    def close(self):
+        """Release the resources of the sink."""
+
+        pass
+
+
+class CallbackSink(Sink):
+    """Calls a function with every report."""
+
+    def __init__(self, callback):
+        """
+        Initialize a callback sink.
+
+        Parameters:
+        callback (function taking a report dict, required)
+        """
+
+        self._callback = callback
+
+    def emit(self, report):
+        """
+        Call the callback with a report.
+
+        Parameters:
+        report (dict, see the module docstring, required)
+        """
+
+        self._callback(report)
+
+
+class JsonLinesSink(Sink):
+    """Appends every report as a line of JSON to a file."""
+
+    def __init__(self, path):
+        """
+        Initialize a JSON lines sink.
+
+        Parameters:
+        path (path of the file, required. Reports are appended to it.)
+        """
+
+        self._file = open(path, 'a')
+
+    def emit(self, report):
+        """
+        Write a report, and flush it so that it can be followed at once.
+
+        Parameters:
+        report (dict, see the module docstring, required)
+        """
+
+        self._file.write(json.dumps(report, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        """Close the file."""
+
+        self._file.close()
+
+
+def _http_server(address):
+    """
+    Return a threading HTTP server answering requests with the latest
+    report of the sink set as its attribute sink.
+
+    Parameters:
+    address (tuple (<host>, <port>), required)
+    """
+
+    import http.server as hts
+
+    class _Handler(hts.BaseHTTPRequestHandler):
+        """Answers requests with the latest report of the server's sink."""
+
+        def do_GET(self):
+            """Send the latest report, as JSON or as Prometheus text."""
+
+            report = self.server.sink.latest()
+            if self.path.rstrip('/') == '/metrics':
+                lines = ['biosim_{0} {1}'.format(name, report[name])
+                         for name in _METRICS
+                         if report.get(name) is not None]
+                lines.append('biosim_finished {}'.format(
+                        int(bool(report.get('finished')))))
+                body = '\n'.join(lines) + '\n'
+                content_type = 'text/plain; version=0.0.4'
+            else:
+                body = json.dumps(report, sort_keys=True)
+                content_type = 'application/json'
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """Do not log requests."""
+
+            pass
+
+    return hts.ThreadingHTTPServer(address, _Handler)
+
+
+class HttpSink(Sink):
+    """Serves the latest report over HTTP from a background thread."""
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        """
+        Initialize an HTTP sink, and start serving.
+
+        Parameters:
+        port (port to listen on, optional. If omitted, a free port is
+              chosen, see port().)
+        host (address to listen on, optional)
+        """
+
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._server = _http_server((host, port))
+        self._server.daemon_threads = True
+        self._server.sink = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='telemetry-http')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def port(self):
+        """Return the port the sink listens on."""
+
+        return self._server.server_address[1]
+
+    def latest(self):
+        """Return the latest report, or an empty dict."""
+
+        with self._lock:
+            return self._latest
+
+    def emit(self, report):
+        """
+        Make a report the one served.
+
+        Parameters:
+        report (dict, see the module docstring, required)
+        """
+
+        with self._lock:
+            self._latest = report
+
+    def close(self):
+        """Stop serving."""
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class Telemetry(object):
+    """Measures the progress of runs, and reports it to sinks."""
+
+    def __init__(self, sinks, interval=1.0, clock=time.time):
+        """
+        Initialize telemetry.
+
+        Parameters:
+        sinks (list of Sink objects, required)
+        interval (min seconds between two reports within a run, optional.
+                  With 0, every year is reported.)
+        clock (function returning the time in seconds, optional)
+        """
+
+        if interval < 0:
+            raise ValueError('Interval cannot be negative')
+        self._sinks = list(sinks)
+        self._interval = interval
+        self._clock = clock
+        self._start_year = None
+        self._end_year = None
+
+    def sinks(self):
+        """Return list of the sinks."""
+
+        return list(self._sinks)
+
+    def reset(self, start_year, end_year):
+        """
+        Prepare for a new simulation run.
+
+        Parameters:
+        start_year (first year to simulate, required)
+        end_year (last year to simulate, required)
+        """
+
+        self._start_year = start_year
+        self._end_year = end_year
+        self._started = self._clock()
+        self._last_report = self._started
+        self._years = 0
+        self._animal_updates = 0
+        # Counters at the last report
+        self._reported_years = 0
+        self._reported_updates = 0
+        self._state = None
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Count a simulated year, and report if interval seconds have passed
+        since the last report.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        self._years += 1
+        self._animal_updates += herbivores + carnivores
+        self._state = (year, herbivores, carnivores)
+        now = self._clock()
+        if now - self._last_report >= self._interval:
+            self._report(now, False)
+
+    def finish(self):
+        """Send the last report of a run."""
+
+        if self._state is not None:
+            self._report(self._clock(), True)
+
+    def _report(self, now, finished):
+        """Send a report to all sinks."""
+
+        (year, herbivores, carnivores) = self._state
+        window = now - self._last_report
+        elapsed = now - self._started
+        years_left = self._end_year - year
+        if finished or years_left == 0:
+            eta = 0.
+        elif elapsed > 0:
+            eta = years_left * elapsed / self._years
+        else:
+            eta = None
+        rates = [None, None]
+        if window > 0:
+            rates = [(self._years - self._reported_years) / window,
+                     (self._animal_updates - self._reported_updates) /
+                     window]
+        report = {'year': year,
+                  'start_year': self._start_year,
+                  'end_year': self._end_year,
+                  'years_done': self._years,
+                  'herbivores': herbivores,
+                  'carnivores': carnivores,
+                  'population': herbivores + carnivores,
+                  'years_per_second': rates[0],
+                  'animal_updates_per_second': rates[1],
+                  'elapsed_seconds': elapsed,
+                  'eta_seconds': eta,
+                  'finished': finished}
+        for sink in self._sinks:
+            sink.emit(report)
+        self._last_report = now
+        self._reported_years = self._years
+        self._reported_updates = self._animal_updates
+
+    def close(self):
+        """Close all sinks."""
+
+        for sink in self._sinks:
+            sink.close()
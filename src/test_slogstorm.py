@@ -3,10 +3,16 @@
 
 __author__ = "Aleksander Hykkerud and Daniel Hjertholm"
 
+import gc
+import shutil
 import unittest
+import urllib.request
 import mock
 
 import slogstormpakke.slogstorm as slog
+import slogstormpakke.calibration as cal
+import slogstormpakke.hunting as hnt
+import slogstormpakke.validation as val
 
 
 class BioSimTests(unittest.TestCase):
@@ -28,7 +34,8 @@ class BioSimTests(unittest.TestCase):
         slog.sl.random = self.orig_random
         slog.sl.randint = self.orig_randint
         
-        slog.plt.close()
+        if slog.plt is not None:
+            slog.plt.close()
         
         # generate default InputHandler for use in tests
         self.hi = slog.InputHandler(mapstr="OOO\nOJO\nOMO\nOOO")
@@ -64,6 +71,12 @@ class BioSimTests(unittest.TestCase):
                              'omega': 0.01,
                              'F': 10})
     
+    def _temp_directory(self):
+        """Return a new temporary directory, removed after the test."""
+        directory = slog.tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        return directory
+    
     def test_create_input_handler(self):
         """Ensure that we can create a input handler object."""
         self.assertIsInstance(self.hi, slog.InputHandler)
@@ -427,20 +440,45 @@ class BioSimTests(unittest.TestCase):
         martini = slog.ani.Carnivore(8, 25)
         martonio = slog.ani.Carnivore(8, 25)
 
-        martine.update_fitness = mock.Mock(return_value=None)
-        martin.update_fitness = mock.Mock(return_value=None)
-        martini.update_fitness = mock.Mock(return_value=None)
-        martonio.update_fitness = mock.Mock(return_value=None)
+        # Animals have __slots__, so the method is replaced on the class.
+        with mock.patch.object(slog.ani.Animal, 'update_fitness') as update:
+            martine.aging()
+            self.assertEqual(update.call_count, 1)
+            martin.weightloss()
+            self.assertEqual(update.call_count, 2)
+            martini.weightgain(5)
+            self.assertEqual(update.call_count, 3)
+            martonio.birthloss()
+            self.assertEqual(update.call_count, 4)
         
+    def test_fitness_is_lazy(self):
+        """test that fitness is only recomputed when read after a change."""
+        slog.ani.Animal.reset_fitness_counters()
+        martine = slog.ani.Herbivore(14, 23)
         martine.aging()
-        martin.weightloss()
-        martini.weightgain(5)
-        martonio.birthloss()
+        martine.weightloss()
+        martine.weightgain(5)
+        self.assertEqual(slog.ani.Animal.fitness_counters()['recomputations'], 0)
+        fitness = martine.fitness()
+        self.assertEqual(martine.fitness(), fitness)
+        counters = slog.ani.Animal.fitness_counters()
+        self.assertEqual(counters['invalidations'], 3)
+        self.assertEqual(counters['recomputations'], 1)
+        self.assertEqual(counters['avoided'], 3)
+        self.assertAlmostEqual(fitness, slog.ani.Herbivore(martine.weight(), 24).fitness(), 5)
         
-        self.assertTrue(martine.update_fitness.called)
-        self.assertTrue(martin.update_fitness.called)
-        self.assertTrue(martini.update_fitness.called)
-        self.assertTrue(martonio.update_fitness.called)
+        # Computing at birth and at every change would take 3000 
+        # computations, against 2000 lazy ones
+        herd = [slog.ani.Herbivore(14, 23) for k in range(1000)]
+        slog.ani.Animal.reset_fitness_counters()
+        for animal in herd:
+            animal.fitness()
+            animal.aging()
+            animal.weightloss()
+            animal.fitness()
+        counters = slog.ani.Animal.fitness_counters()
+        self.assertEqual(counters['recomputations'], 2000)
+        self.assertEqual(counters['avoided'], 1000)
         
     def test_last_moved_update(self):
         """test last moved function in animal."""
@@ -465,7 +503,1021 @@ class BioSimTests(unittest.TestCase):
                 slog.sl.random = mock.Mock(return_value=rtest)
                 self.assertEqual(fivel.migrate(), expected)
                 
+
+    def test_cohort_simulator(self):
+        """Ensure that the cohort simulator deploys, runs and counts animals."""
+        slog.sl.seed(154789)
+        cs = self.hi.cohort_simulator()
+        cs.deploy_animals(
+            [{'loc': (2, 2), 
+              'pop': 10 * [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]},
+             {'loc': (2, 2), 
+              'pop': 2 * [{'species': 'Carnivore', 'age': 3, 'weight': 20.}]}])
+        self.assertEqual(cs.count_by_species(), {'herbivores': 10, 'carnivores': 2})
+        self.assertEqual(cs.count_by_cell()['herbivores'][1, 1], 10)
+        self.assertEqual(cs.count_by_cell()['herbivores'].shape, (4, 3))
+        cs.run_simulation(5)
+        self.assertEqual(cs.current_year(), 5)
+        self.assertEqual(type(cs.animal_count()), int)
+        self.assertRaises(AttributeError, cs.deploy_animals, [{'loc': (1, 1), 
+              'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]}])
+        self.assertRaises(ValueError, cs.deploy_animals, [{'loc': (2, 2), 
+              'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 1}]}])
+        
+    def test_cohort_rebin_keeps_animals(self):
+        """Ensure that moving cohorts between weight bins keeps all animals."""
+        weights = slog.np.linspace(0, 100, 51)
+        counts = slog.np.zeros((3, 4, 51), dtype=int)
+        counts[1, 2, 10] = 1000
+        counts[2, 0, 50] = 7
+        new_counts = slog.coh._rebin(counts, weights + 3.3, weights)
+        self.assertEqual(new_counts.sum(), counts.sum())
+        self.assertEqual(new_counts[1, 2, 11:13].sum(), 1000)
+        self.assertEqual(new_counts[2, 0, 50], 7)
+
+    def test_cohort_replicates(self):
+        """Ensure that replicates are simulated side by side and recorded."""
+        slog.sl.seed(154789)
+        cs = self.hi.cohort_simulator(replicates=6)
+        cs.deploy_animals(
+            [{'loc': (2, 2), 
+              'pop': 20 * [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]}])
+        self.assertEqual(list(cs.count_by_species()['herbivores']), 6 * [20])
+        cs.run_simulation(8, record_cells=True)
+        history = cs.count_history()
+        self.assertEqual(history['herbivores'].shape, (6, 8))
+        self.assertEqual(list(history['herbivores'][:, -1]), 
+                         list(cs.count_by_species()['herbivores']))
+        self.assertTrue(len(set(history['herbivores'][:, -1])) > 1)
+        self.assertEqual(cs.cell_history()['carnivores'].shape, (6, 8, 4, 3))
+        self.assertEqual(cs.count_by_cell()['herbivores'].shape, (6, 4, 3))
+        self.assertRaises(ValueError, self.hi.cohort_simulator, replicates=0)
+
+    def test_counter_based_streams(self):
+        """Ensure that counter based streams depend only on their keys."""
+        slog.sl.seed_streams(2012)
+        first = [slog.sl.stream(5, 17, 1).random() for i in range(2)]
+        slog.sl.select_stream(5, 17, 1)
+        self.assertEqual(first[0], slog.sl.random())
+        self.assertNotEqual(first[0], slog.sl.stream(5, 17, 2).random())
+        self.assertNotEqual(first[0], slog.sl.stream(6, 17, 1).random())
+        
+        # Migration in a cell does not depend on the animals elsewhere
+        counts = []
+        for others in [0, 30]:
+            hi = slog.InputHandler(mapstr="OOOOOO\nOJJJJO\nOJJJJO\nOOOOOO", 
+                                   headless=True)
+            hi.deploy_animals([{'loc': (2, 2), 'pop': 
+                [{'species': 'Herbivore', 'age': 5, 'weight': 40.}] * 50}])
+            if others:
+                hi.deploy_animals([{'loc': (3, 4), 'pop': 
+                    [{'species': 'Herbivore', 'age': 5, 'weight': 40.}, 
+                     {'species': 'Carnivore', 'age': 5, 'weight': 40.}] * 
+                    others}])
+            hi._terrain.migration(3)
+            counts.append(hi._terrain.count_matrices()[0])
+        self.assertLess(counts[0][1, 1], 50)
+        for index in [(1, 1), (1, 2), (2, 1)]:
+            self.assertEqual(counts[0][index], counts[1][index])
+        slog.sl.seed(2012)
+        self.assertFalse(slog.sl.streams_enabled())
+        
+    def test_streams_reproduce_simulation(self):
+        """Ensure that a simulation with counter based streams is reproducible."""
+        def f(ar1=None, ar2=None, ar3=None, ar4=None):
+            pass
+        
+        results = []
+        for run in range(2):
+            hi = slog.InputHandler(mapstr="OOOO\nOJSO\nOSJO\nOOOO")
+            for method in ['draw_carnivores', 'draw_herbivores', 'draw_graph', 
+                           'draw_terrain', 'update_graphics']:
+                setattr(hi._graphics, method, f)
+            hi.deploy_animals(
+                [{'loc': (2, 2), 
+                  'pop': 10 * [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}]},
+                 {'loc': (3, 3), 
+                  'pop': 3 * [{'species': 'Carnivore', 'age': 10, 'weight': 20.}]}])
+            slog.sl.seed_streams(42)
+            hi.run_simulation(10)
+            results.append(hi._simulation.count_by_cell())
+        slog.sl.seed(42)
+        for species in ['herbivores', 'carnivores']:
+            self.assertTrue((results[0][species] == results[1][species]).all())
+
+    def test_shared_state(self):
+        """Ensure that the terrain state can be read from shared memory."""
+        self.hi.deploy_animals(
+            [{'loc': (2, 2), 
+              'pop': [{'species': 'Herbivore', 'age': 10, 'weight': 12.5},
+                      {'species': 'Herbivore', 'age': 3, 'weight': 8.5},
+                      {'species': 'Carnivore', 'age': 5, 'weight': 20.}]}])
+        descriptor = self.hi.share_state(capacity=50)
+        reader = slog.shs.SharedState.attach(descriptor)
+        self.assertEqual(reader.year(), 0)
+        self.assertEqual(reader.array('herbivore_counts')[1, 1], 2)
+        self.assertEqual(reader.array('food')[1, 1], 300)
+        self.assertEqual(chr(reader.array('codes')[2, 1]), 'M')
+        herbivores = reader.animals('herbivores')
+        self.assertEqual(list(herbivores['age']), [10, 3])
+        self.assertEqual(list(herbivores['cell']), [4, 4])
+        self.assertAlmostEqual(reader.animals('carnivores')['weight'][0], 20.)
+        self.assertRaises(RuntimeError, reader.unlink)
+        reader.close()
+        self.hi.release_shared_state()
+        self.assertEqual(self.hi._simulation.shared_state(), None)
+        
+        
+        # Publishing neither computes fitness nor fails on overflow
+        state = slog.shs.SharedState.create((4, 3), 1)
+        sequence = state.sequence()
+        with mock.patch.object(slog.ani.Animal, 'fitness') as fitness:
+            with mock.patch.object(slog.shs.warnings, 'warn') as warn:
+                state.publish(self.hi._terrain, 1)
+        self.assertEqual(fitness.call_count, 0)
+        self.assertEqual(warn.call_count, 1)
+        self.assertEqual(state.truncated(), ['herbivores'])
+        self.assertEqual(len(state.animals('herbivores')['age']), 1)
+        self.assertTrue(slog.np.isnan(state.animals('herbivores')['fitness'][0]))
+        self.assertEqual(state.sequence(), sequence + 2)
+        
+        # A reader never copies a state that is being written
+        write = state._write
+        def publish_while_read(terrain, year):
+            self.assertEqual(state.sequence() % 2, 1)
+            self.assertRaises(RuntimeError, state.snapshot, tries=3)
+            write(terrain, year)
+        with mock.patch.object(state, '_write', publish_while_read):
+            state.publish(self.hi._terrain, 2)
+        snapshot = state.snapshot()
+        self.assertEqual(snapshot['year'], 2)
+        self.assertEqual(list(snapshot['carnivores']['age']), [5])
+        state.unlink()
+
+    def test_render_worker_drops_frames(self):
+        """Ensure that the render worker drops snapshots instead of waiting."""
+        settings = self.hi._graphics.settings()
+        self.assertEqual(settings['ylim'], 4000)
+        self.hi._graphics.apply_settings({'ylim': 300})
+        self.assertEqual(self.hi._graphics._ylim, 300)
+        self.assertRaises(KeyError, self.hi._graphics.apply_settings, {'zlim': 3})
+        
+        worker = slog.rnd.RenderWorker(slog.Graphics, [[(0, 0, 0)]], settings, 
+                                       queue_size=1)
+        (herbmat, carnmat) = self.hi._terrain.count_matrices()
+        worker.record(1, 10, 2)
+        self.assertTrue(worker.submit(1, 10, herbmat, carnmat))
+        worker.record(2, 11, 3)
+        self.assertFalse(worker.submit(2, 10, herbmat, carnmat))
+        self.assertEqual(worker.submitted_frames(), 1)
+        self.assertEqual(worker.dropped_frames(), 1)
+        self.assertEqual(worker._years, [2])
+        self.assertFalse(worker.is_alive())
+        
+        # A started worker is stopped at exit, and flush() queues the 
+        # dropped snapshot once there is room
+        with mock.patch.object(slog.rnd.atexit, 'register') as register:
+            with mock.patch.object(worker._process, 'start'):
+                worker.start()
+        register.assert_called_once_with(worker.stop)
+        self.assertEqual(worker._snapshots.get(timeout=10)['year'], 1)
+        with mock.patch.object(worker._process, 'is_alive', 
+                               return_value=True):
+            worker.flush()
+        self.assertEqual(worker.submitted_frames(), 2)
+        self.assertEqual(worker._snapshots.get(timeout=10)['years'], [2])
+        self.assertEqual(worker._years, [])
+        
+        # Every run ends with a flush
+        self.hi._simulation._renderer = mock.Mock()
+        self.hi.run_simulation(2)
+        self.hi._simulation._renderer.flush.assert_called_once_with()
+        self.hi._simulation._renderer = None
+
+    def test_headless_draws_nothing(self):
+        """Ensure that a headless simulation never creates a figure."""
+        hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True)
+        hi.set_plot_update_interval(1)
+        hi.set_graph_ylim(100)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': [
+                    {'species': 'Herbivore', 'age': 10, 'weight': 12.5}]}])
+        hi.run_simulation(3)
+        self.assertIsNone(hi._graphics._fig)
+        self.assertEqual(hi._simulation.current_year(), 3)
+
+    def test_memory_report(self):
+        """Ensure that memory is accounted per animal, region and phase."""
+        herbivore = slog.ani.Herbivore(10, 5)
+        self.assertFalse(hasattr(herbivore, '__dict__'))
+        self.assertFalse(hasattr(self.hi._terrain.terrain_map()[1, 1], 
+                                 '__dict__'))
+        
+        self.hi.deploy_animals([{'loc': (2, 2), 'pop': 
+                [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 5}])
+        for method in ['draw_carnivores', 'draw_herbivores', 'draw_graph', 
+                       'draw_terrain', 'update_graphics']:
+            setattr(self.hi._graphics, method, lambda *args: None)
+        self.hi.profile_memory()
+        self.hi.run_simulation(2)
+        self.hi.profile_memory(False)
+        
+        report = self.hi.memory_report()
+        self.assertEqual(report['regions'], 12)
+        self.assertEqual(report['animals'], 
+                         self.hi._terrain.animal_counts()[0])
+        self.assertGreater(report['bytes_per_animal'], 0)
+        self.assertGreater(report['bytes_per_region'], 0)
+        self.assertEqual(sorted(report['phase_peaks']), 
+                         ['decay', 'growth', 'migration'])
+        
+        self.hi.share_state(10, compact=True)
+        self.assertEqual(self.hi.memory_report()['shared_bytes_per_animal'], 
+                         16)
+        self.hi.release_shared_state()
+
+    def test_vectorized_regrowth(self):
+        """Ensure that terrain regrowth matches regrowth of single regions."""
+        hi = slog.InputHandler(mapstr="OOOO\nOJSO\nOSDO\nOOOO")
+        terrain = hi._terrain
+        regions = terrain.terrain_map()
+        self.assertEqual(regions[1, 1]._food, 300)
+        self.assertEqual(terrain.food()[1, 2], 150)
+        
+        # Regions are views onto the food array of the terrain
+        regions[1, 2]._food = 10
+        self.assertEqual(terrain.food()[1, 2], 10)
+        regions[1, 1]._food = 20
+        terrain.food()[2, 1] = 30
+        
+        savannah = slog.lnd.Savannah(food=10)
+        savannah.regrowth_cycle()
+        terrain.regrowth()
+        self.assertEqual(regions[1, 1]._food, 300)
+        self.assertAlmostEqual(regions[1, 2]._food, savannah._food)
+        self.assertAlmostEqual(regions[2, 1]._food, 30 + 0.8 * 120)
+        self.assertEqual(terrain.food()[2, 2], 0)
+        
+        hi.set_food_parameters((2, 3), fmax=50, alpha=0.5)
+        terrain.regrowth()
+        self.assertAlmostEqual(regions[1, 2]._food, 
+                               savannah._food + 0.5 * (50 - savannah._food))
+        self.assertAlmostEqual(regions[2, 1]._food, 
+                               126 + 0.8 * (150 - 126))
+        self.assertRaises(ValueError, hi.set_food_parameters, (3, 3), 10)
+        self.assertRaises(ValueError, hi.set_food_parameters, (2, 3), 
+                          None, 2)
+
+    def test_early_stop(self):
+        """Ensure that runs stop early when a criterion is met."""
+        extinction = slog.stp.Extinction('any')
+        extinction.reset(10, 0)
+        self.assertIsNone(extinction.update(1, 5, 0))
+        self.assertIsNone(extinction.update(2, 5, 3))
+        self.assertEqual(extinction.update(3, 5, 0), 'carnivores extinct')
+        self.assertRaises(ValueError, slog.stp.Extinction, 'foxes')
+        
+        stationarity = slog.stp.Stationarity(window=5, tolerance=0.1)
+        reasons = [stationarity.update(year, 100 + year % 2, 10) 
+                   for year in range(5)]
+        self.assertEqual(reasons[:4], 4 * [None])
+        self.assertEqual(reasons[4], 'stationary for 5 years')
+        
+        cycle = slog.stp.StableCycle(window=12, max_period=5, tolerance=0.01)
+        series = [(100, 10), (200, 30), (50, 20)] * 6
+        reasons = [cycle.update(year, h, c) 
+                   for year, (h, c) in enumerate(series)]
+        self.assertEqual(reasons[-1], 'stable cycle with period 3 years')
+        self.assertIsNone(reasons[15])
+        # Constant counts do not cycle, neither do extinct species
+        for counts in [(100, 10), (0, 0)]:
+            cycle = slog.stp.StableCycle(window=12, max_period=5, 
+                                         tolerance=0.01)
+            self.assertEqual([cycle.update(year, *counts) 
+                              for year in range(30)], 30 * [None])
+        
+        class StopAtThree(slog.stp.Criterion):
+            def update(self, year, herbivores, carnivores):
+                if year == 3:
+                    return 'year three'
+        
+        hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': [
+                    {'species': 'Herbivore', 'age': 10, 'weight': 12.5}]}])
+        hi._simulation.set_stop_criteria([StopAtThree()])
+        result = hi.run_simulation(10)
+        self.assertEqual(result['stop_reason'], 'year three')
+        self.assertEqual(result['stop_year'], 3)
+        self.assertEqual(result['years'], 3)
+        self.assertEqual(hi._simulation.current_year(), 3)
+        self.assertEqual(hi._simulation.count_by_species()['herbivores'],
+                         hi._terrain.animal_counts()[0])
+        
+        hi.set_stop_criteria()
+        result = hi.run_simulation(2)
+        self.assertEqual((result['start_year'], result['end_year']), (4, 5))
+        self.assertIsNone(result['stop_reason'])
+
+    def test_calibration(self):
+        """Ensure that ABC-SMC calibration returns posterior samples."""
+        distance = cal.TrajectoryDistance([(10, 1), (10, 1), (10, 1)], 0.5)
+        self.assertIsNone(distance.update(1, 10, 1))
+        self.assertEqual(distance.update(2, 20, 1), 
+                         'distance above tolerance')
+        distance.reset(0, 0)
+        distance.update(1, 10, 1)
+        # Two years without animals, each adding (10/10)**2 + (1/1)**2
+        self.assertAlmostEqual(distance.finish(), (4 / 3.) ** 0.5)
+        
+        observed = [(5 + year, 0) for year in range(4)]
+        deployments = [{'loc': (2, 2), 'pop': 
+                [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 5}]
+        calibrator = cal.Calibrator(observed, 
+                                    {'herbivores': {'beta': (0.2, 0.6)}}, 
+                                    deployments, mapstr="OOOO\nOJJO\nOOOO",
+                                    processes=1, seed=3)
+        result = calibrator.run(particles=4, generations=2, batch_size=4)
+        self.assertEqual(len(result['samples']), 4)
+        self.assertAlmostEqual(result['weights'].sum(), 1)
+        self.assertEqual(result['tolerances'][0], float('inf'))
+        self.assertLessEqual(result['distances'].max(), 
+                             result['tolerances'][1])
+        for sample in result['samples']:
+            self.assertTrue(0.2 <= sample['herbivores']['beta'] <= 0.6)
+        self.assertGreaterEqual(result['simulations'], 8)
+        self.assertGreater(result['simulations_per_second'], 0)
+        self.assertFalse(result['exhausted'])
+        
+        # A budget too small for the second generation ends the run with
+        # the first, and the caller's random stream, parameters and 
+        # backend are left alone
+        slog.sl.seed(11)
+        expected = slog.np.random.random()
+        slog.sl.seed(11)
+        params = slog.ani.Herbivore.params
+        slog.bk.select('numpy')
+        result = calibrator.run(particles=4, generations=3, batch_size=4,
+                                max_simulations=6)
+        self.assertEqual(slog.sl.random(), expected)
+        self.assertIs(slog.ani.Herbivore.params, params)
+        self.assertEqual(params['beta'], 0.4)
+        self.assertEqual(slog.bk.active(), 'numpy')
+        slog.bk.select()
+        self.assertTrue(result['exhausted'])
+        self.assertEqual(result['simulations'], 6)
+        self.assertEqual(result['tolerances'], [float('inf')])
+        self.assertEqual(len(result['samples']), 4)
+        self.assertRaises(ValueError, calibrator.run, particles=4, 
+                          max_simulations=3)
+        self.assertRaises(KeyError, cal.Calibrator, observed, 
+                          {'foxes': {'beta': (0, 1)}}, deployments, 
+                          mapstr="OOOO\nOJJO\nOOOO")
+
+    def test_columnar_storage(self):
+        """Ensure that memory mapped columnar storage works like objects."""
+        herbivore = slog.ani.Herbivore(23.5, 7)
+        self.assertAlmostEqual(
+                slog.col.fitness(herbivore.params, slog.np.array([23.5]), 
+                                 slog.np.array([7]))[0],
+                herbivore.fitness(), places=5)
+        
+        results = []
+        for storage in ['memory', 'memmap']:
+            slog.sl.seed(4)
+            hi = slog.InputHandler(mapstr="OOOOO\nOJJSO\nOSJDO\nOOOOO", 
+                                   headless=True, storage=storage, 
+                                   chunk_size=15)
+            self.assertRaises(AttributeError, hi.deploy_animals, 
+                              [{'loc': (1, 1), 'pop': [{'species': 
+                                'Herbivore', 'age': 1, 'weight': 10}]}])
+            self.assertRaises(ValueError, hi.deploy_animals, 
+                              [{'loc': (2, 2), 'pop': [{'species': 
+                                'Herbivore', 'age': 1, 'weight': 1}]}])
+            hi.deploy_animals([{'loc': (2, 2), 'pop': 
+                [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 20 + 
+                [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 3}])
+            self.assertEqual(hi._terrain.animal_counts(), (20, 3))
+            hi.run_simulation(6)
+            
+            (herbmat, carnmat) = hi._terrain.count_matrices()
+            (herbs, carns) = hi._terrain.animal_counts()
+            self.assertEqual((herbmat.sum(), carnmat.sum()), (herbs, carns))
+            self.assertEqual(herbmat[0].sum() + herbmat[:, 0].sum(), 0)
+            self.assertGreater(herbs, 0)
+            columns = hi._terrain.animal_columns('herbivores')
+            self.assertTrue(slog.np.all(slog.np.diff(columns['cell']) >= 0))
+            self.assertEqual(hi._simulation.count_by_species(), 
+                             {'herbivores': herbs, 'carnivores': carns})
+            results.append((herbmat, carnmat, 
+                            slog.np.array(columns['weight'])))
+            
+        paths = hi._terrain.columnar_animals().store('herbivores').paths()
+        self.assertEqual(len(paths), 4)
+        for memory, memmap in zip(*results):
+            self.assertTrue(slog.np.array_equal(memory, memmap))
         
+        # The temporary directory is removed on close(), or when the 
+        # InputHandler is garbage collected. A given one is kept.
+        hi.close()
+        self.assertFalse(slog.os.path.exists(slog.os.path.dirname(paths[0])))
+        hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True, 
+                               storage='memmap')
+        directory = slog.os.path.dirname(
+                hi._terrain.columnar_animals().store('herbivores').paths()[0])
+        self.assertTrue(slog.os.path.isdir(directory))
+        del hi
+        gc.collect()
+        self.assertFalse(slog.os.path.exists(directory))
+        directory = self._temp_directory()
+        hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True, 
+                               storage='memmap', storage_dir=directory)
+        hi.close()
+        self.assertTrue(slog.os.path.isdir(directory))
+        self.assertRaises(ValueError, slog.InputHandler, mapstr="OOO\nOJO\nOOO",
+                          storage='disk')
+        
+    def test_vectorized_migration(self):
+        """Ensure that migration moves animals to neighbouring livable cells."""
+        table = slog.col.neighbour_table(3, 4)
+        self.assertEqual(table.shape, (12, 4))
+        self.assertEqual(list(table[5]), [9, 1, 6, 4])
+        self.assertEqual(list(table[0]), [4, 0, 1, 0])
+        
+        hi = slog.InputHandler(mapstr="OOOOO\nOJJMO\nOSJDO\nOOOOO", 
+                               headless=True)
+        terrain = hi._terrain
+        hi.set_herbivore_parameters({'mu': 10})
+        hi.deploy_animals([{'loc': (2, 3), 'pop': 
+            [{'species': 'Herbivore', 'age': 10, 'weight': 40}] * 200}])
+        terrain.migration(1)
+        (herbmat, carnmat) = terrain.count_matrices()
+        self.assertEqual(herbmat.sum(), 200)
+        self.assertEqual(herbmat[1, 3] + herbmat[0].sum(), 0)
+        self.assertEqual(herbmat[1, 2] + herbmat[1, 1] + herbmat[2, 2], 200)
+        self.assertGreater(herbmat[1, 1], 0)
+        self.assertTrue(all(animal.last_moved() == 1 
+                            for animal in terrain.terrain_map()[1, 1]
+                            .herbivores()))
+        
+        animals = terrain.species_animals('herbivores')[0]
+        terrain.relocate('herbivores', [7] * len(animals))
+        self.assertEqual(terrain.terrain_map()[1, 2].herbivores(), 
+                         list(animals))
+        
+    def test_csr_offsets(self):
+        """Ensure that column store offsets mark the slice of every cell."""
+        merged = slog.col._merge_sorted(
+                {'cell': slog.np.array([1, 1, 3]), 'age': slog.np.array([1, 2, 3])},
+                {'cell': slog.np.array([0, 1, 4]), 'age': slog.np.array([4, 5, 6])})
+        self.assertEqual(list(merged['cell']), [0, 1, 1, 1, 3, 4])
+        self.assertEqual(list(merged['age']), [4, 1, 2, 5, 3, 6])
+        
+        slog.sl.seed(3)
+        hi = slog.InputHandler(mapstr="OOOOO\nOJJSO\nOSJDO\nOOOOO", 
+                               headless=True, storage='memory', 
+                               chunk_size=10)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': 
+            [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 20 + 
+            [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 3}])
+        hi.run_simulation(5)
+        for species, matrix in zip(slog.col.SPECIES, 
+                                   hi._terrain.count_matrices()):
+            store = hi._terrain.columnar_animals().store(species)
+            offsets = store.offsets()
+            self.assertEqual(offsets[-1], store.count())
+            self.assertTrue(slog.np.array_equal(slog.np.diff(offsets), 
+                                                matrix.reshape(-1)))
+            cells = store.cells()
+            for cell in range(len(offsets) - 1):
+                self.assertTrue(slog.np.all(
+                        cells[offsets[cell]:offsets[cell + 1]] == cell))
+        
+    def test_predation_kernel(self):
+        """Ensure that the predation kernel follows Carnivore.hunt()."""
+        params = dict(slog.ani.Carnivore.params, F=20., DeltaPhiMax=0.5)
+        carnivore = slog.ani.Carnivore(10, 5)
+        self.assertAlmostEqual(hnt.fitness_scalar(params, 10, 5), 
+                               carnivore.fitness(), places=5)
+        
+        # Carnivore fitness is 0.73 before and 0.85 after the first kill
+        prey_fitness = slog.np.array([0.1, 0.6, 0.7, 0.95])
+        prey_weight = slog.np.array([15., 10., 10., 10.])
+        # Seed 24 draws 0.63, 0.28, 0.03 and 0.84
+        draws = slog.np.random.Generator(slog.np.random.Philox(24)).random(4)
+        for kernel in set([hnt.hunt_cell, hnt.hunt_cell_python]):
+            bit_generator = slog.np.random.Philox(24)
+            (killer, eaten, gains) = kernel(
+                    prey_fitness, prey_weight, slog.np.array([10., 10.]), 
+                    slog.np.array([5, 5]), slog.np.zeros(2), bit_generator, 
+                    params)
+            # The first carnivore surely kills the first prey, without a 
+            # draw. The second escapes, and only 5 of the third is eaten 
+            # before F is reached. The second carnivore gets the second 
+            # prey, and stops at the last, which is fitter.
+            self.assertEqual(killer.tolist(), [0, 1, 0, -1])
+            self.assertEqual(eaten.tolist(), [15., 10., 5., 0.])
+            self.assertAlmostEqual(gains[0], 15.)
+            self.assertAlmostEqual(gains[1], 7.5)
+            # Only the three uncertain kills drew a number
+            self.assertEqual(slog.np.random.Generator(bit_generator).random(),
+                             draws[3])
+            # Carnivores that have eaten F already this year do not hunt
+            (killer, eaten, gains) = kernel(
+                    prey_fitness, prey_weight, slog.np.array([10., 10.]), 
+                    slog.np.array([5, 5]), slog.np.array([20., 20.]), 
+                    bit_generator, params)
+            self.assertEqual(killer.tolist(), [-1, -1, -1, -1])
+            self.assertEqual(gains.tolist(), [0., 0.])
+        
+        # The kernel continues the numbers of slump.random()
+        slog.sl.seed(3)
+        first = slog.sl.random(2)
+        slog.sl.seed(3)
+        self.assertEqual(slog.np.random.Generator(
+                slog.sl.bit_generator()).random(2).tolist(), first.tolist())
+        
+    def test_delta_checkpoints(self):
+        """Ensure that checkpointed years are rebuilt exactly."""
+        directory = self._temp_directory()
+        slog.sl.seed(2)
+        hi = slog.InputHandler(mapstr="OOOOOO\nOJJSMO\nOSJDMO\nOOOOOO", 
+                               headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': 
+            [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 20 + 
+            [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 3}])
+        hi.enable_checkpoints(directory, interval=2)
+        checkpointer = hi._simulation._checkpointer
+        hi.run_simulation(4)
+        year_4 = checkpointer.state(hi._terrain, 4)
+        hi.run_simulation(2)
+        self.assertEqual(checkpointer.checkpoints(), 
+                         [(2, 'base'), (4, 'delta'), (6, 'delta')])
+        
+        hi.restore_checkpoint(4)
+        self.assertEqual(hi._simulation.current_year(), 4)
+        restored = checkpointer.state(hi._terrain, 4)
+        self.assertTrue(slog.np.array_equal(restored['food'], 
+                                            year_4['food']))
+        for species in slog.chk.SPECIES:
+            for column in slog.chk.COLUMNS:
+                self.assertTrue(slog.np.array_equal(
+                        restored[species][column], year_4[species][column]))
+        
+        checkpointer.merge(4, prune=True)
+        self.assertEqual(checkpointer.checkpoints(), 
+                         [(4, 'base'), (6, 'delta')])
+        self.assertTrue(slog.np.array_equal(
+                checkpointer.load(4)['herbivores']['weight'], 
+                year_4['herbivores']['weight']))
+        self.assertRaises(KeyError, checkpointer.load, 2)
+        hi.run_simulation(2)
+        
+    def test_checkpoints_after_restore(self):
+        """Ensure that checkpoints of a timeline left by a restore are gone."""
+        directory = self._temp_directory()
+        mapstr = "OOOOOO\nOJJODO\nOOOOOO"
+        pop = [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 10
+        slog.sl.seed(6)
+        hi = slog.InputHandler(mapstr=mapstr, headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': pop}])
+        hi.enable_checkpoints(directory, interval=1)
+        hi.run_simulation(3)
+        hi.restore_checkpoint(1)
+        hi.deploy_animals([{'loc': (2, 5), 'pop': pop}])
+        hi.run_simulation(1)
+        year_2 = hi._terrain.animal_columns('herbivores')
+        
+        fresh = slog.InputHandler(mapstr=mapstr, headless=True)
+        fresh.enable_checkpoints(directory, interval=1)
+        self.assertEqual(fresh._simulation._checkpointer.years(), [1, 2])
+        self.assertRaises(KeyError, fresh.restore_checkpoint, 3)
+        fresh.restore_checkpoint(2)
+        restored = fresh._terrain.animal_columns('herbivores')
+        for column in slog.chk.COLUMNS:
+            self.assertTrue(slog.np.array_equal(restored[column], 
+                                                year_2[column]))
+        
+        # A delta written against another year is refused
+        checkpointer = fresh._simulation._checkpointer
+        shutil.copy(checkpointer._path('delta', 2), 
+                    checkpointer._path('delta', 3))
+        self.assertRaises(ValueError, checkpointer.load, 3)
+        
+    def test_event_log_replay(self):
+        """Ensure that replay rebuilds a logged year exactly."""
+        directory = self._temp_directory()
+        path = slog.os.path.join(directory, 'events.log')
+        mapstr = "OOOOOO\nOJJSMO\nOSJDMO\nOOOOOO"
+        slog.sl.seed(5)
+        hi = slog.InputHandler(mapstr=mapstr, headless=True)
+        hi.enable_checkpoints(directory, interval=3)
+        hi.enable_event_log(path, buffer_size=10)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': 
+            [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 20 + 
+            [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 3}])
+        hi.run_simulation(4)
+        year_4 = slog.chk.Checkpointer.state(hi._terrain, 4)
+        hi.run_simulation(1)
+        hi.close_event_log()
+        
+        kinds = slog.elg.read(path)['kind']
+        for kind in [slog.elg.SYNC, slog.elg.GROWTH, slog.elg.DECAY, 
+                     slog.elg.DEPLOY, slog.elg.FEED, slog.elg.BIRTH, 
+                     slog.elg.MOVE]:
+            self.assertIn(kind, kinds)
+        
+        replayed = slog.InputHandler(mapstr=mapstr, headless=True)
+        replayed.enable_checkpoints(directory, interval=3)
+        replayed.replay(4, path)
+        self.assertEqual(replayed._simulation.current_year(), 4)
+        state = slog.chk.Checkpointer.state(replayed._terrain, 4)
+        self.assertTrue(slog.np.array_equal(state['food'], year_4['food']))
+        for species in slog.chk.SPECIES:
+            for column in slog.chk.COLUMNS:
+                self.assertTrue(slog.np.array_equal(
+                        state[species][column], year_4[species][column]))
+        
+        columnar = slog.InputHandler(mapstr=mapstr, headless=True, 
+                                     storage='memory')
+        columnar.enable_checkpoints(self._temp_directory())
+        self.assertRaises(RuntimeError, columnar.enable_event_log, path)
+        self.assertEqual(slog.elg.read(path)['kind'].tolist(), kinds.tolist())
+
+    def test_backends(self):
+        """Ensure that engines are selected, reported and fall back."""
+        self.assertTrue(slog.bk.available()['python'])
+        self.assertRaises(ValueError, slog.InputHandler, mapstr="OOO\nOJO\nOOO",
+                          headless=True, engine='fortran')
+
+        hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True,
+                               engine='python')
+        self.assertEqual(hi.engine(), 'python')
+        self.assertEqual(slog.bk.active(), 'python')
+        self.assertFalse(slog.bk.hnt.compiled())
+        self.assertIsNone(hi._terrain.columnar_animals())
+
+        with mock.patch.dict(slog.bk._loaded, {'numba': None}):
+            with self.assertWarns(UserWarning):
+                hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True,
+                                       engine='numba')
+        self.assertEqual(hi.engine(), 'numpy')
+        self.assertIsNotNone(hi._terrain.columnar_animals())
+        
+        # Without an engine, the one in use is kept. It is shared, so every
+        # InputHandler reports the one selected last.
+        other = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True)
+        self.assertEqual(other.engine(), 'numpy')
+        other = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True,
+                                  engine='python')
+        self.assertEqual(hi.engine(), 'python')
+        slog.bk.select()
+
+    def test_validation(self):
+        """Ensure that backends are compared by their distributions."""
+        self.assertEqual(val.ks_2samp([1, 2, 3], [1, 2, 3]), (0., 1.))
+        (statistic, p_value) = val.ks_2samp(range(20), range(15, 35))
+        self.assertAlmostEqual(statistic, 0.75)
+        self.assertLess(p_value, 0.001)
+        self.assertEqual(val.extinction_year([3, 0, 2, 0, 1], 2), 3)
+        self.assertEqual(val.extinction_year([3, 2, 1]), 3)
+        years = slog.np.arange(100)
+        self.assertEqual(val.cycle_period(
+                10 + slog.np.sin(2 * slog.np.pi * years / 7.), 20), 7)
+        self.assertEqual(val.cycle_period(slog.np.ones(100), 20), 0)
+        
+        scenario = {'mapstr': "OOOO\nOJSO\nOOOO",
+                    'stages': [([{'loc': (2, 2), 'pop': 
+                        [{'species': 'Herbivore', 'age': 5, 
+                          'weight': 20.}] * 5}], 10), 
+                               ([{'loc': (2, 3), 'pop': 
+                        [{'species': 'Carnivore', 'age': 5, 
+                          'weight': 20.}] * 2}], 10)]}
+        # The caller's parameters and backend are left alone
+        self.hi.set_herbivore_parameters({'beta': 0.5})
+        params = slog.ani.Herbivore.params
+        slog.bk.select('numpy')
+        result = val.Validator('python', scenario=scenario, seeds=3, 
+                               processes=1, sample_every=5, 
+                               max_period=4).run()
+        self.assertEqual(slog.bk.active(), 'numpy')
+        self.assertIs(slog.ani.Herbivore.params, params)
+        self.assertEqual(params['beta'], 0.5)
+        slog.bk.select()
+        self.assertTrue(result['passed'])
+        self.assertEqual(len(result['tests']), 12)
+        for test in result['tests']:
+            self.assertEqual(test['statistic'], 0.)
+            self.assertEqual(test['reference'], test['candidate'])
+
+    def test_species_table(self):
+        """Ensure that a third species runs through the generic phases."""
+        class Fox(slog.ani.Carnivore):
+            __slots__ = ()
+            params = dict(slog.ani.Carnivore.params, F=5.)
+        
+        with mock.patch.object(slog.spc, '_table', list(slog.spc._table)):
+            self.assertRaises(ValueError, slog.spc.register, 'herbivores', 
+                              Fox, slog.spc.PREDATOR, ('herbivores',))
+            self.assertRaises(ValueError, slog.spc.register, 'foxes', Fox, 
+                              slog.spc.GRAZER, ('herbivores',))
+            self.assertRaises(KeyError, slog.spc.register, 'foxes', Fox, 
+                              slog.spc.PREDATOR, ('rabbits',))
+            foxes = slog.spc.register('foxes', Fox, slog.spc.PREDATOR, 
+                                      ('herbivores',))
+            self.assertEqual(slog.spc.names(), 
+                             ('herbivores', 'carnivores', 'foxes'))
+            self.assertEqual([species.name for species 
+                              in slog.spc.predators()], 
+                             ['carnivores', 'foxes'])
+            
+            for storage in ['objects', 'memory']:
+                slog.sl.seed(4)
+                hi = slog.InputHandler(mapstr="OOOO\nOJJO\nOOOO", 
+                                       headless=True, storage=storage)
+                hi.deploy_animals([{'loc': (2, 2), 'pop': 
+                    [{'species': 'Herbivore', 'age': 5, 'weight': 20.}] * 40 + 
+                    [{'species': 'Fox', 'age': 5, 'weight': 20.}] * 10}])
+                hi.run_simulation(3)
+                columns = hi._terrain.animal_columns('foxes')
+                self.assertGreater(len(columns['cell']), 0)
+                self.assertEqual(hi._terrain.animal_counts()[1], 0)
+                if storage == 'objects':
+                    for celle in hi._terrain.terrain_map().flat:
+                        for animal in celle.animals(foxes.index):
+                            self.assertIsInstance(animal, Fox)
+                
+                # Foxes alone are not extinct, and are counted
+                hi = slog.InputHandler(mapstr="OOOO\nOJJO\nOOOO", 
+                                       headless=True, storage=storage)
+                hi.set_plot_update_interval(1)
+                hi.deploy_animals([{'loc': (2, 2), 'pop': 
+                    [{'species': 'Fox', 'age': 5, 'weight': 20.}] * 10}])
+                result = hi.run_simulation(2)
+                self.assertIsNone(result['stop_reason'])
+                counts = hi._simulation.count_by_species()
+                self.assertEqual(sorted(counts), 
+                                 ['carnivores', 'foxes', 'herbivores'])
+                self.assertGreater(counts['foxes'], 0)
+                self.assertEqual(hi._simulation.animal_count(), 
+                                 counts['foxes'])
+        self.assertEqual(slog.spc.names(), ('herbivores', 'carnivores'))
+
+    def test_several_prey_species(self):
+        """Ensure that predators eat at most F a year of all prey species."""
+        class Rabbit(slog.ani.Herbivore):
+            __slots__ = ()
+            params = dict(slog.ani.Herbivore.params, gamma=0.)
+        
+        class Wolf(slog.ani.Carnivore):
+            __slots__ = ()
+            params = dict(slog.ani.Carnivore.params, F=10., DeltaPhiMax=1e-6,
+                          gamma=0.)
+        
+        with mock.patch.object(slog.spc, '_table', list(slog.spc._table)):
+            slog.spc.register('rabbits', Rabbit, slog.spc.GRAZER)
+            slog.spc.register('wolves', Wolf, slog.spc.PREDATOR, 
+                              ('herbivores', 'rabbits'))
+            for storage in ['objects', 'memory']:
+                slog.sl.seed(5)
+                hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", 
+                                       headless=True, storage=storage)
+                # Old, light prey is surely killed. Each wolf fills up on 
+                # herbivores, and has no appetite left for rabbits.
+                hi.deploy_animals([{'loc': (2, 2), 'pop': 
+                    [{'species': 'Herbivore', 'age': 60, 'weight': 8.}] * 20 +
+                    [{'species': 'Rabbit', 'age': 60, 'weight': 8.}] * 20 + 
+                    [{'species': 'Wolf', 'age': 5, 'weight': 50.}] * 3}])
+                if storage == 'objects':
+                    hi._terrain.terrain_map()[1, 1].nutrition_cycle()
+                else:
+                    hi._terrain.columnar_animals().growth()
+                gains = hi._terrain.animal_columns('wolves')['weight'] - 50.
+                self.assertTrue(slog.np.allclose(gains, Wolf.params['beta'] * 
+                                                 Wolf.params['F']))
+                self.assertEqual(
+                        len(hi._terrain.animal_columns('rabbits')['cell']), 
+                        20)
+        
+    def test_render_pyramids(self):
+        """Ensure that maps are drawn from pooled, updated pyramids."""
+        counts = slog.np.arange(35.).reshape(5, 7)
+        pyramid = slog.pyr.Pyramid(counts)
+        self.assertEqual([pyramid.shape(k) for k in range(pyramid.levels())], 
+                         [(5, 7), (3, 4), (2, 2), (1, 1)])
+        counts[4, 6] = 100.
+        counts[0, 0] = 7.
+        self.assertEqual(pyramid.update(counts), 2)
+        rebuilt = slog.pyr.Pyramid(counts)
+        for k in range(pyramid.levels()):
+            self.assertTrue(slog.np.array_equal(pyramid.sums(k), 
+                                                rebuilt.sums(k)))
+        self.assertAlmostEqual(pyramid.mean(3)[0, 0], counts.mean())
+        self.assertEqual(pyramid.mean(1)[2, 3], 100.)
+        self.assertEqual(pyramid.fitting(3, 4), 1)
+        
+        terrain = self.hi._terrain
+        self.assertTrue(slog.np.array_equal(
+                terrain.map_rgb(), 
+                [[celle.color() for celle in row] 
+                 for row in terrain.terrain_map()]))
+        
+        graphics = slog.Graphics()
+        graphics.hmap_setup(slog.np.ones((800, 800)))
+        level = graphics._level(graphics._herbivore_subplot, 
+                                graphics._h_pyramid)
+        self.assertGreater(level, 0)
+        self.assertEqual(graphics._h_img_ax.get_array().shape, 
+                         graphics._h_pyramid.shape(level))
+        graphics.draw_herbivores(2 * slog.np.ones((800, 800)))
+        self.assertTrue(slog.np.all(graphics._h_img_ax.get_array() == 2))
+
+    def test_recording(self):
+        """Ensure that recorded counts are sliced and summarized exactly."""
+        directory = self._temp_directory()
+        slog.sl.seed(3)
+        hi = slog.InputHandler(mapstr="OOOOOO\nOJJSMO\nOSJDMO\nOOOOOO",
+                               headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop':
+            [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 20 +
+            [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 3}])
+        hi.enable_recording(directory, chunk_years=3)
+        totals = []
+        for year in range(10):
+            hi.run_simulation(1)
+            totals.append(hi._terrain.animal_counts())
+        hi.close_recording()
+
+        recording = slog.rec.Recording(directory)
+        self.assertEqual(recording.years().tolist(), list(range(1, 11)))
+        self.assertEqual(recording.totals().tolist(),
+                         [list(counts) for counts in totals])
+        window = recording['herbivores', 2:10, 1:3, 1:4]
+        self.assertEqual(window.shape(), (8, 2, 3))
+        self.assertEqual(window.years().tolist(), list(range(2, 10)))
+        counts = slog.np.array(window.counts())
+        self.assertTrue(slog.np.allclose(window.mean_map(),
+                                         counts.mean(axis=0)))
+        self.assertTrue(slog.np.array_equal(window.max_map(),
+                                            counts.max(axis=0)))
+        self.assertAlmostEqual(window.mean(), counts.mean())
+        self.assertEqual(window.max(), counts.max())
+        self.assertEqual(window._parts()[0], range(1, 3))
+        self.assertEqual(recording['carnivores'].totals().tolist(),
+                         [counts[1] for counts in totals])
+        self.assertRaises(KeyError, recording.__getitem__, 'wolves')
+        self.assertRaises(ValueError, recording['herbivores', 20:].mean)
+
+    def test_snapshots(self):
+        """Ensure that snapshots hold all animals, or a bounded sample."""
+        mapstr = "OOOOOO\nOJJSMO\nOSJDMO\nOOOOOO"
+        pop = ([{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 40 +
+               [{'species': 'Carnivore', 'age': 10, 'weight': 22.5}] * 3)
+        counts = []
+        for storage in ('objects', 'memory'):
+            directory = self._temp_directory()
+            slog.sl.seed(4)
+            hi = slog.InputHandler(mapstr=mapstr, headless=True,
+                                   storage=storage)
+            hi.deploy_animals([{'loc': (2, 2), 'pop': pop}])
+            hi.enable_snapshots(directory, interval=2, sample_size=10,
+                                seed=1)
+            hi.run_simulation(4)
+            self.assertEqual(slog.snp.years(directory), [2, 4])
+            snapshot = slog.snp.read(slog.os.path.join(
+                    directory, 'snapshot_000004.npz'))
+            population = hi._terrain.animal_columns('herbivores')
+            self.assertEqual(snapshot['population']['herbivores'],
+                             len(population['cell']))
+            self.assertGreater(len(population['cell']), 10)
+            self.assertEqual(len(snapshot['herbivores']['weight']), 10)
+            self.assertTrue(slog.np.all(slog.np.diff(
+                    snapshot['herbivores']['cell']) >= 0))
+            self.assertTrue(slog.np.all(slog.np.isin(
+                    snapshot['herbivores']['weight'], population['weight'])))
+            counts.append(hi._terrain.animal_counts())
+
+            path = slog.snp.Exporter(directory).export(hi._terrain, 4)
+            snapshot = slog.snp.read(path)
+            for column in slog.snp.COLUMNS:
+                self.assertTrue(slog.np.array_equal(
+                        snapshot['carnivores'][column],
+                        hi._terrain.animal_columns('carnivores')[column]))
+
+        slog.sl.seed(4)
+        hi = slog.InputHandler(mapstr=mapstr, headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop': pop}])
+        hi.run_simulation(4)
+        self.assertEqual(hi._terrain.animal_counts(), counts[0])
+
+    def test_telemetry(self):
+        """Ensure that runs report progress and throughput to all sinks."""
+        clock = mock.Mock(side_effect=[0., 1., 1.5, 3., 4., 4.])
+        reports = []
+        telemetry = slog.tel.Telemetry([slog.tel.CallbackSink(reports.append)],
+                                       interval=2., clock=clock)
+        telemetry.reset(1, 10)
+        for year, counts in zip((1, 2, 3), ((10, 2), (20, 4), (30, 6))):
+            telemetry.update(year, *counts)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]['year'], 3)
+        self.assertEqual(reports[0]['population'], 36)
+        self.assertEqual(reports[0]['years_per_second'], 1.)
+        self.assertEqual(reports[0]['animal_updates_per_second'], 24.)
+        self.assertEqual(reports[0]['eta_seconds'], 7.)
+        telemetry.update(4, 0, 0)
+        telemetry.finish()
+        self.assertEqual(len(reports), 2)
+        self.assertTrue(reports[1]['finished'])
+        self.assertEqual(reports[1]['eta_seconds'], 0.)
+
+        path = slog.os.path.join(self._temp_directory(), 'telemetry.jsonl')
+        reports = []
+        hi = slog.InputHandler(mapstr="OOO\nOJO\nOOO", headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop':
+            [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 5}])
+        telemetry = hi.enable_telemetry(callback=reports.append, path=path,
+                                        port=0, interval=0)
+        hi.run_simulation(3)
+        self.assertEqual([report['year'] for report in reports],
+                         [1, 2, 3, 3])
+        self.assertEqual(reports[-1]['population'],
+                         sum(hi._terrain.animal_counts()))
+        with open(path) as lines:
+            self.assertEqual([slog.tel.json.loads(line) for line in lines],
+                             reports)
+        url = 'http://127.0.0.1:{}/'.format(telemetry.sinks()[2].port())
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(slog.tel.json.loads(response.read()),
+                             reports[-1])
+        with urllib.request.urlopen(url + 'metrics') as response:
+            self.assertIn('biosim_year 3\n', response.read().decode())
+        hi.disable_telemetry()
+        self.assertIsNone(hi._simulation._telemetry)
+
+    def test_cpu_profile(self):
+        """Ensure that stack samples are attributed to phases and written."""
+        profiler = slog.cpu.SamplingProfiler(interval=0.001)
+        profiler._target = slog.cpu.threading.current_thread().ident
+        profiler.run('growth', profiler.sample)
+        profiler.sample()
+        self.assertEqual(profiler.samples(), 2)
+        self.assertEqual(sorted(profiler.phases()), ['growth', 'other'])
+        lines = profiler.collapsed().splitlines()
+        self.assertTrue(lines[0].startswith('growth;'))
+        self.assertIn('test_cpu_profile (test_slogstorm.py:', lines[0])
+        self.assertNotIn('cpuprofile.py', profiler.collapsed())
+        self.assertEqual(profiler.functions('growth')[0][0],
+                         lines[0].split(';')[-1].rsplit(' ', 1)[0])
+        
+        # Phases get their share of the time, also when NumPy holds up 
+        # the samples
+        def spin(seconds):
+            end = slog.cpu.time.perf_counter() + seconds
+            while slog.cpu.time.perf_counter() < end:
+                pass
+        
+        def sort(values, times):
+            for k in range(times):
+                slog.np.sort(values)
+        
+        profiler = slog.cpu.SamplingProfiler(interval=0.001)
+        values = slog.np.random.random(2000000)
+        clock = slog.cpu.time.perf_counter
+        profiler.start()
+        self.assertFalse(profiler.sampling_thread())
+        started = clock()
+        profiler.run('python', spin, 0.15)
+        middle = clock()
+        profiler.run('numpy', sort, values, 4)
+        ended = clock()
+        profiler.stop()
+        self.assertFalse(profiler.running())
+        share = (middle - started) / (ended - started)
+        phases = profiler.phases()
+        self.assertAlmostEqual(phases['python'] / profiler.seconds(), share, 
+                               delta=0.05)
+        self.assertAlmostEqual(phases['numpy'] / profiler.seconds(), 
+                               1 - share, delta=0.05)
+        self.assertAlmostEqual(profiler.seconds(), ended - started, 
+                               delta=0.05 * (ended - started))
+
+        path = slog.os.path.join(self._temp_directory(), 'profile.json')
+        hi = slog.InputHandler(mapstr="OOOO\nOJSO\nOOOO", headless=True)
+        hi.deploy_animals([{'loc': (2, 2), 'pop':
+            [{'species': 'Herbivore', 'age': 10, 'weight': 12.5}] * 50}])
+        hi.profile_cpu(interval=0.0005)
+        self.assertTrue(hi.cpu_profile().running())
+        hi.run_simulation(5, profile=path)
+        self.assertFalse(hi.cpu_profile().running())
+        with open(path) as output:
+            speedscope = slog.cpu.json.load(output)
+        self.assertEqual(speedscope['shared']['frames'] == [],
+                         hi.cpu_profile().samples() == 0)
+        for profile in speedscope['profiles']:
+            self.assertIn(profile['name'],
+                          ('growth', 'migration', 'decay', 'other'))
+            self.assertEqual(len(profile['samples']),
+                             len(profile['weights']))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 
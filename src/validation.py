@@ -0,0 +1,357 @@
+#!/usr/env/bin python
+"""
+This module provides statistical validation of compute backends.
+
+Backends other than the reference draw their random numbers differently,
+so they cannot be checked against exact values. Validator() instead runs a
+scenario with the reference and a candidate backend over many seeds, and
+compares the distributions of
+
+    - the herbivore and carnivore counts every sample_every years
+    - the year each species died out
+    - the period of the population cycles
+
+between the two with two-sample Kolmogorov-Smirnov tests. The candidate
+passes when no test rejects at level alpha, Bonferroni corrected for the
+number of tests that can reject. The runtime speedup of the candidate is
+reported too.
+
+Runs are simulated in parallel worker processes, as the backend in use
+holds for a whole process.
+
+Example:
+
+    result = Validator('numpy', seeds=100).run()
+    print(report(result))
+
+Run as a script from the directory containing slogstorm.py and
+mapfile.txt, with the candidate backend as argument.
+"""
+
+__author__ = "Aleksander Hykkerud and Daniel Hjertholm"
+
+import multiprocessing as mp
+import sys
+import time
+import numpy as np
+import slump as sl
+import earlystop as stp
+import slogstorm as slog
+
+# The deployments of profile_sim, with the carnivores placed in the same
+# cell as the herbivores, as (3, 3) is a mountain.
+SCENARIOS = {
+    'profile_sim': {
+        'mapfile': 'mapfile.txt',
+        'stages': [
+            ([{'loc': (2, 2), 'pop': [{'species': 'Herbivore', 'age': 10,
+                                       'weight': 12.5}] * 4}], 100),
+            ([{'loc': (2, 2), 'pop': [{'species': 'Carnivore', 'age': 10,
+                                       'weight': 22.5}] * 4}], 100)]}}
+
+
+def ks_2samp(first, second):
+    """
+    Return (statistic, p-value) of the two-sample Kolmogorov-Smirnov test.
+
+    The p-value is the asymptotic one, with the correction of Stephens
+    (1970) for small samples.
+
+    Parameters:
+    first (sequence of numbers, required)
+    second (sequence of numbers, required)
+    """
+
+    first = np.sort(np.asarray(first, dtype=float))
+    second = np.sort(np.asarray(second, dtype=float))
+    values = np.concatenate([first, second])
+    difference = (np.searchsorted(first, values, side='right') / len(first) -
+                  np.searchsorted(second, values, side='right') /
+                  len(second))
+    statistic = float(np.max(np.abs(difference)))
+
+    size = np.sqrt(len(first) * len(second) / float(len(first) +
+                                                     len(second)))
+    lam = (size + 0.12 + 0.11 / size) * statistic
+    if lam < 0.3:
+        return (statistic, 1.)
+    j = np.arange(1, 101)
+    p_value = 2 * np.sum((-1) ** (j - 1) * np.exp(-2 * j ** 2 * lam ** 2))
+    return (statistic, float(min(max(p_value, 0.), 1.)))
+
+
+def extinction_year(counts, start=0):
+    """
+    Return the first year from start on with no animals, or len(counts) if
+    there is none.
+
+    Parameters:
+    counts (counts after each year, required)
+    start (first year to look at, optional)
+    """
+
+    empty = np.flatnonzero(np.asarray(counts)[start:] == 0)
+    if len(empty) == 0:
+        return len(counts)
+    return start + int(empty[0])
+
+
+def cycle_period(counts, max_period=40):
+    """
+    Return the period of cycles in counts, or 0 if there are none.
+
+    The period is the lag of the highest positive peak of the
+    autocorrelation, between 2 and max_period years.
+
+    Parameters:
+    counts (counts after each year, required)
+    max_period (longest period in years looked for, optional)
+    """
+
+    counts = np.asarray(counts, dtype=float)
+    if len(counts) < 2 * max_period:
+        raise ValueError('Need at least twice max_period years')
+    counts = counts - counts.mean()
+    variance = np.dot(counts, counts)
+    if variance == 0:
+        return 0
+    lags = np.arange(1, max_period + 2)
+    correlation = np.array([np.dot(counts[:-lag], counts[lag:])
+                            for lag in lags]) / variance
+    peaks = [i for i in range(1, len(lags) - 1)
+             if correlation[i] > 0 and
+             correlation[i - 1] < correlation[i] >= correlation[i + 1]]
+    if not peaks:
+        return 0
+    return int(lags[max(peaks, key=lambda i: correlation[i])])
+
+
+class _Recorder(stp.Criterion):
+    """Records the counts of every year, and never stops a run."""
+
+    def __init__(self):
+        """Initialize an empty recorder."""
+
+        self.counts = []
+
+    def update(self, year, herbivores, carnivores):
+        """
+        Record the counts of a year.
+
+        Parameters:
+        year (the current year, required)
+        herbivores (total number of herbivores this year, required)
+        carnivores (total number of carnivores this year, required)
+        """
+
+        self.counts.append((herbivores, carnivores))
+        return None
+
+
+def _simulate(task):
+    """
+    Simulate a scenario once.
+
+    Runs in a worker process, or in the calling process when there is a
+    single one. The random generator, the parameters and the backend are
+    restored afterwards, see slogstorm.process_state().
+
+    Return value: (counts, seconds), where counts is an array of shape
+    (years, 2) with the herbivore and carnivore counts after each year.
+    Years after the animals died out are counted as 0.
+
+    Parameters:
+    task (tuple (engine, scenario, seed), required)
+    """
+
+    (engine, scenario, seed) = task
+    start = time.time()
+    state = slog.process_state()
+    sl.seed(seed)
+    try:
+        sim = slog.InputHandler(mapstr=scenario.get('mapstr'),
+                                mapfile=scenario.get('mapfile'),
+                                headless=True, engine=engine)
+        recorder = _Recorder()
+        sim.set_stop_criteria(criteria=[recorder])
+        years = 0
+        for deployments, stage_years in scenario['stages']:
+            years += stage_years
+            sim.deploy_animals(deployments)
+            sim.run_simulation(stage_years)
+            recorder.counts.extend([(0, 0)] *
+                                   (years - len(recorder.counts)))
+    finally:
+        slog.set_process_state(state)
+    return (np.array(recorder.counts), time.time() - start)
+
+
+class Validator(object):
+    """Compares a candidate backend statistically with a reference."""
+
+    def __init__(self, candidate, reference='python',
+                 scenario='profile_sim', seeds=50, processes=None,
+                 sample_every=20, max_period=40, alpha=0.05, seed=0):
+        """
+        Initialize a validator.
+
+        Parameters:
+        candidate (name of the backend to validate, required)
+        reference (name of the reference backend, optional)
+        scenario (name of one of SCENARIOS, or dict with 'mapstr' or
+                  'mapfile', and 'stages': a list of (<deployments>,
+                  <years>) simulated in turn, optional)
+        seeds (number of runs with each backend, optional)
+        processes (number of worker processes, optional. If omitted, one
+                   per CPU is used. With 1, runs are simulated in this
+                   process.)
+        sample_every (years between the compared counts, optional)
+        max_period (longest cycle period in years looked for, optional)
+        alpha (significance level of all tests together, optional)
+        seed (seed of the first run, optional)
+        """
+
+        if seeds < 2:
+            raise ValueError('Need at least two seeds')
+        if not 0 < alpha < 1:
+            raise ValueError('Alpha must be in (0, 1)')
+        if not isinstance(scenario, dict):
+            scenario = SCENARIOS[scenario]
+        self._candidate = candidate
+        self._reference = reference
+        self._scenario = scenario
+        self._seeds = range(seed, seed + seeds)
+        self._processes = processes or mp.cpu_count()
+        self._sample_every = sample_every
+        self._max_period = max_period
+        self._alpha = alpha
+
+    def _last_stage(self):
+        """Return the first year of the last stage of the scenario."""
+
+        return sum(years for deployments, years
+                   in self._scenario['stages'][:-1])
+
+    def _statistics(self, runs):
+        """
+        Return dict {<name>: <values, one per run>} of the compared
+        statistics.
+
+        Parameters:
+        runs (list of count arrays, required)
+        """
+
+        counts = np.array(runs)
+        statistics = {}
+        for year in range(self._sample_every - 1, counts.shape[1],
+                          self._sample_every):
+            statistics['herbivores year {}'.format(year + 1)] = \
+                counts[:, year, 0]
+            statistics['carnivores year {}'.format(year + 1)] = \
+                counts[:, year, 1]
+        start = self._last_stage()
+        for index, species in enumerate(['herbivores', 'carnivores']):
+            statistics['{} extinction year'.format(species)] = [
+                    extinction_year(run[:, index], start) for run in runs]
+            statistics['{} cycle period'.format(species)] = [
+                    cycle_period(run[start:, index], self._max_period)
+                    for run in runs]
+        return statistics
+
+    def run(self):
+        """
+        Run the validation.
+
+        Return value: dict with
+            'passed': True if no test rejected
+            'tests': list of dicts with the 'name', 'statistic', 'p_value'
+                     and 'passed' of each test, and the 'reference' and
+                     'candidate' mean of the compared values
+            'level': significance level of each test
+            'reference', 'candidate': names of the backends used
+            'reference_seconds', 'candidate_seconds': total runtime
+            'speedup': reference over candidate runtime
+            'seconds': wall clock time
+        """
+
+        start = time.time()
+        tasks = [(engine, self._scenario, seed)
+                 for engine in (self._reference, self._candidate)
+                 for seed in self._seeds]
+        if self._processes == 1:
+            results = [_simulate(task) for task in tasks]
+        else:
+            pool = mp.get_context('spawn').Pool(self._processes)
+            try:
+                results = pool.map(_simulate, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        runs = len(self._seeds)
+        reference = self._statistics([counts for counts, seconds
+                                      in results[:runs]])
+        candidate = self._statistics([counts for counts, seconds
+                                      in results[runs:]])
+        # Values that are the same in every run, such as counts before a
+        # species is deployed, cannot differ and are not counted
+        varying = [name for name in reference
+                   if len(set(reference[name]) | set(candidate[name])) > 1]
+        level = self._alpha / max(len(varying), 1)
+        tests = []
+        for name in sorted(reference):
+            (statistic, p_value) = ks_2samp(reference[name], candidate[name])
+            tests.append({'name': name,
+                          'statistic': statistic,
+                          'p_value': p_value,
+                          'passed': p_value >= level,
+                          'reference': float(np.mean(reference[name])),
+                          'candidate': float(np.mean(candidate[name]))})
+
+        reference_seconds = sum(seconds for counts, seconds
+                                in results[:runs])
+        candidate_seconds = sum(seconds for counts, seconds
+                                in results[runs:])
+        return {'passed': all(test['passed'] for test in tests),
+                'tests': tests,
+                'level': level,
+                'reference': self._reference,
+                'candidate': self._candidate,
+                'reference_seconds': reference_seconds,
+                'candidate_seconds': candidate_seconds,
+                'speedup': reference_seconds / candidate_seconds,
+                'seconds': time.time() - start}
+
+
+def report(result):
+    """
+    Return the result of Validator.run() as text.
+
+    Parameters:
+    result (dict returned by Validator.run(), required)
+    """
+
+    lines = ['{0:28s} {1:>10s} {2:>10s} {3:>6s} {4:>8s}'
+             .format('statistic', result['reference'], result['candidate'],
+                     'D', 'p')]
+    for test in result['tests']:
+        lines.append('{0:28s} {1:10.1f} {2:10.1f} {3:6.3f} {4:8.4f}{5}'
+                     .format(test['name'], test['reference'],
+                             test['candidate'], test['statistic'],
+                             test['p_value'],
+                             '' if test['passed'] else '  REJECTED'))
+    lines.append('level per test {0:.5f}: {1}'
+                 .format(result['level'],
+                         'PASSED' if result['passed'] else 'FAILED'))
+    lines.append('speedup {0:.2f}x ({1:.1f} s against {2:.1f} s)'
+                 .format(result['speedup'], result['candidate_seconds'],
+                         result['reference_seconds']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    result = Validator(sys.argv[1]).run()
+    print(report(result))
+    if not result['passed']:
+        sys.exit(1)